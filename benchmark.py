@@ -0,0 +1,241 @@
+"""Benchmarks for the sentiment scoring pipeline
+
+Generates a synthetic library and corpus, times each stage of the
+pipeline separately and the full SentimentFactory.run_suite, and saves
+the results as JSON. Passing --baseline compares the run with an
+earlier results file, for catching regressions between versions.
+
+usage: python benchmark.py --phrases 20000 --texts 1000 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import sentiment
+
+
+def make_vocabulary(size, rng):
+	"""Makes size distinct lowercase pseudo-words"""
+	letters = 'abcdefghijklmnopqrstuvwxyz'
+	vocabulary = set()
+	while len(vocabulary) < size:
+		vocabulary.add(''.join(
+			rng.choice(letters) for _ in xrange(rng.randint(3, 9))))
+	return sorted(vocabulary)
+
+def make_library(vocabulary, num_phrases, max_phrase_words, rng):
+	"""Makes library of num_phrases phrases of 1 to max_phrase_words
+	words, with scores from -3 to 3, in get_library_from_file() format"""
+	library = {}
+	while len(library) < num_phrases:
+		phrase = ' '.join(rng.choice(vocabulary)
+			for _ in xrange(rng.randint(1, max_phrase_words)))
+		if phrase not in library:
+			library[phrase] = (rng.choice([-3, -2, -1, 1, 2, 3]), len(library))
+	return library
+
+def make_corpus(vocabulary, library, num_texts, text_words, hit_rate, rng):
+	"""Makes num_texts raw rows ('text id\\ttext') of about text_words
+	words each. hit_rate is the share of words that start a library
+	phrase, some of them negated"""
+	phrases = list(library)
+	cues = list(sentiment.NEGATION_CUES)
+	rows = []
+	for text_id in xrange(num_texts):
+		words = []
+		while len(words) < text_words:
+			if rng.random() < hit_rate:
+				if rng.random() < 0.3:
+					words.append(rng.choice(cues))
+				words.extend(rng.choice(phrases).split())
+			else:
+				words.append(rng.choice(vocabulary))
+		text = ' '.join(words).capitalize() + '.'
+		rows.append('%d\t%s\n' % (text_id, text))
+	return rows
+
+def write_library(library, library_filepath):
+	"""Writes library to a file get_library_from_file() can read"""
+	with open(library_filepath, 'w') as lib_file:
+		for phrase, (score, _) in sorted(
+			library.iteritems(), key=lambda item: item[1][1]):
+			lib_file.write('%s\t%d\n' % (phrase, score))
+
+def get_peak_rss_kb():
+	"""Gets peak resident set size of this process, in kilobytes"""
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		peak_rss /= 1024 # bytes on OS X
+	return peak_rss
+
+def make_stage_result(seconds, num_texts, num_hits):
+	"""Makes result entry for one stage"""
+	return {'seconds': seconds,
+		'texts_per_sec': num_texts / seconds if seconds else None,
+		'hits_per_sec': num_hits / seconds if seconds else None}
+
+def benchmark_stages(rows, library, end_weight=1.5, end_threshold=0.75):
+	"""Times clean_row, tokenize, LibraryRun preprocessing, do_run (the
+	encoded matching and scoring run_suite uses) with and without
+	summary_only, the string-keyed
+	find_phrase_matches and score_text, and get_results over all rows
+
+	output = (dict of stage name to seconds, total hit count)
+	"""
+	timings = {}
+	matcher = sentiment.PhraseMatcher(library)
+	max_words = matcher.max_words + 2
+
+	start = time.time()
+	texts = [sentiment.clean_row(row) for row in rows]
+	timings['clean_row'] = time.time() - start
+
+	start = time.time()
+	for _, text in texts:
+		for _ in sentiment.tokenize(text.split(), max_words=max_words):
+			pass
+	timings['tokenize'] = time.time() - start
+
+	start = time.time()
+	runs = [sentiment.LibraryRun(text, library, end_weight, end_threshold,
+		matcher=matcher) for text in texts]
+	timings['preprocessing'] = time.time() - start
+
+	start = time.time()
+	for run_instance in runs:
+		run_instance.do_run()
+	timings['do_run'] = time.time() - start
+
+	summary_runs = [sentiment.LibraryRun(text, library, end_weight,
+		end_threshold, matcher=matcher, summary_only=True) for text in texts]
+	start = time.time()
+	for run_instance in summary_runs:
+		run_instance.do_run()
+	timings['do_run_summary'] = time.time() - start
+
+	start = time.time()
+	all_matches = [run_instance.find_phrase_matches() for run_instance in runs]
+	timings['find_phrase_matches'] = time.time() - start
+
+	start = time.time()
+	all_scores = [run_instance.score_text(matches, end_weight, end_threshold)
+		for run_instance, (matches, _, _) in zip(runs, all_matches)]
+	timings['score_text'] = time.time() - start
+
+	num_hits = sum(hitcount_pos + hitcount_neg
+		for _, hitcount_pos, hitcount_neg in all_matches)
+
+	start = time.time()
+	for run_instance in runs:
+		run_instance.get_results()
+	timings['get_results'] = time.time() - start
+
+	return timings, num_hits
+
+def benchmark_run_suite(rows, library, workers=1):
+	"""Times a full SentimentFactory.run_suite over rows, outputs seconds"""
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		with open(text_filepath, 'w') as text_file:
+			text_file.writelines(rows)
+		write_library(library, library_filepath)
+
+		factory = sentiment.SentimentFactory(text_filepath, library_filepath,
+			tmp_dir + '/', workers=workers)
+		start = time.time()
+		factory.run_suite()
+		return time.time() - start
+	finally:
+		shutil.rmtree(tmp_dir)
+
+def run_benchmark(num_phrases=2000, max_phrase_words=3, num_texts=500,
+	              text_words=200, vocabulary_size=5000, hit_rate=0.05,
+	              workers=1, seed=0):
+	"""Runs all benchmarks, outputs results dict ready for saving"""
+	rng = random.Random(seed)
+	vocabulary = make_vocabulary(vocabulary_size, rng)
+	library = make_library(vocabulary, num_phrases, max_phrase_words, rng)
+	rows = make_corpus(vocabulary, library, num_texts, text_words, hit_rate, rng)
+
+	timings, num_hits = benchmark_stages(rows, library)
+	timings['run_suite'] = benchmark_run_suite(rows, library, workers)
+
+	return {'config': {'phrases': num_phrases,
+			'max_phrase_words': max_phrase_words, 'texts': num_texts,
+			'text_words': text_words, 'vocabulary': vocabulary_size,
+			'hit_rate': hit_rate, 'workers': workers, 'seed': seed},
+		'python': sys.version.split()[0],
+		'hits': num_hits,
+		'peak_rss_kb': get_peak_rss_kb(),
+		'stages': dict((stage, make_stage_result(seconds, num_texts, num_hits))
+			for stage, seconds in timings.iteritems())}
+
+def compare_results(results, baseline, tolerance):
+	"""Compares stage throughput with a baseline results dict
+
+	output = list of (stage, speed ratio, regressed) for stages in both,
+	where speed ratio > 1 means faster than the baseline and regressed
+	means slower by more than tolerance (a fraction)
+	"""
+	comparison = []
+	for stage, result in sorted(results['stages'].iteritems()):
+		base = baseline['stages'].get(stage)
+		if base is None or not result['seconds']:
+			continue
+		ratio = base['seconds'] / result['seconds']
+		comparison.append((stage, ratio, ratio < 1 - tolerance))
+	return comparison
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--phrases', type=int, default=2000)
+	parser.add_argument('--max-phrase-words', type=int, default=3)
+	parser.add_argument('--texts', type=int, default=500)
+	parser.add_argument('--text-words', type=int, default=200)
+	parser.add_argument('--vocabulary', type=int, default=5000)
+	parser.add_argument('--hit-rate', type=float, default=0.05)
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--output', help='file to save results to as JSON')
+	parser.add_argument('--baseline', help='earlier results file to compare to')
+	parser.add_argument('--tolerance', type=float, default=0.1,
+		help='slowdown vs baseline counted as a regression (default 0.1)')
+	args = parser.parse_args(argv)
+
+	results = run_benchmark(args.phrases, args.max_phrase_words, args.texts,
+		args.text_words, args.vocabulary, args.hit_rate, args.workers,
+		args.seed)
+
+	print '%-20s %10s %12s %12s' % ('stage', 'seconds', 'texts/sec', 'hits/sec')
+	for stage, result in sorted(results['stages'].iteritems()):
+		print '%-20s %10.3f %12.1f %12.1f' % (stage, result['seconds'],
+			result['texts_per_sec'] or 0, result['hits_per_sec'] or 0)
+	print 'hits: %d, peak RSS: %d kB' % (results['hits'], results['peak_rss_kb'])
+
+	if args.output:
+		with open(args.output, 'w') as output_file:
+			json.dump(results, output_file, indent=2, sort_keys=True)
+
+	if args.baseline:
+		with open(args.baseline) as baseline_file:
+			baseline = json.load(baseline_file)
+		regressed = False
+		for stage, ratio, stage_regressed in compare_results(
+			results, baseline, args.tolerance):
+			print '%-20s %6.2fx%s' % (
+				stage, ratio, '  REGRESSION' if stage_regressed else '')
+			regressed = regressed or stage_regressed
+		return 1 if regressed else 0
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
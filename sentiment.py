@@ -2,20 +2,344 @@
 
 import re
 import os
+import abc
 import collections
 import string
+import itertools
+import multiprocessing
+import hashlib
+import marshal
+import mmap
+import struct
+import time
+import math
+import heapq
+import json
+import array
+import sys
+import threading
+import Queue
+import zlib
+import bz2
+import tempfile
+import shutil
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# words that flip the meaning of a phrase following them, and the number
+# of words allowed between the negation word and the phrase
+NEGATION_CUES = ('not', 'dont', 'cant', 'wont', 'couldnt', 'shouldnt', 'never')
+NEGATION_GAP = 2
+
+# compiled library files start with the magic string and format version;
+# bump the version whenever PhraseMatcher.get_tables() changes
+LIBRARY_FILE_MAGIC = 'SENTLIB'
+LIBRARY_FILE_VERSION = 1
+
+# output columns for simple and verbose results, as (name, type) where
+# type is a struct code: 's' string, 'd' float, 'q' int
+SIMPLE_COLUMNS = [('.text id', 's'), ('.text score', 'd'), ('neg hits', 'q'),
+	('pos hits', 'q'), ('total hits', 'q'), ('total wordcount', 'q')]
+VERBOSE_COLUMNS = [('text id', 's'), ('phrase', 's'), ('word pos', 'q'),
+	('weighted score', 'd'), ('rule num', 'q')]
+
+# binary output files start with the magic string and format version
+OUTPUT_FILE_MAGIC = 'SENTOUT'
+OUTPUT_FILE_VERSION = 1
+
+# corpus index files start with the magic string and format version
+INDEX_FILE_MAGIC = 'SENTIDX'
+INDEX_FILE_VERSION = 1
+
+# bump whenever the hit store layout changes
+HIT_STORE_VERSION = 1
+
+# compressed files are recognized by extension, and input files also by
+# their first bytes
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz',
+	'.zst': 'zstd'}
+COMPRESSION_MAGIC = [('\x1f\x8b', 'gzip'), ('BZh', 'bz2'),
+	('\xfd7zXZ\x00', 'xz'), ('\x28\xb5\x2f\xfd', 'zstd')]
+
+_LITERAL_PHRASE = re.compile(r'\w+( \w+)*\Z')
+_GAP_WORD = re.compile(r'\w+\Z')
+_LITERAL_PREFIX = re.compile(r'[^.^$*+?{}\[\]\\|()]*')
 
 class SentimentException(Exception):
 	pass
 
+class HitTable(object):
+	"""Phrase hits of one text as parallel arrays, one entry per hit in
+	the order the matcher finds them
+
+	Each hit's token is a span of word positions [token_pos, token_end)
+	of words, so its string is only built when it's written out; hits
+	added with token strings of their own (from_hits()) keep those in
+	tokens instead. Scores are kept raw, negated for negated phrases,
+	and weighted once weight() has been run.
+
+	words = list of the text's words, or None for hits with token
+	strings
+	"""
+	def __init__(self, words=None):
+		self.words = words
+		self.tokens = None if words is not None else []
+		self.token_pos = array.array('i')
+		self.token_end = array.array('i')
+		self.score = []
+		self.weighted_score = None
+		self.rule_num = array.array('i')
+		self.negated = array.array('b')
+
+	@classmethod
+	def from_hits(cls, hits):
+		"""Makes table of hits (token, token_pos, score, rule_num, negated)"""
+		table = cls()
+		for token, token_pos, score, rule_num, negated in hits:
+			table.append(token_pos, token_pos + token.count(' ') + 1, score,
+				rule_num, negated, token)
+		return table
+
+	def __len__(self):
+		return len(self.score)
+
+	def append(self, token_pos, token_end, score, rule_num, negated,
+		       token=None):
+		"""Adds a single hit"""
+		self.token_pos.append(token_pos)
+		self.token_end.append(token_end)
+		self.score.append(score)
+		self.rule_num.append(rule_num)
+		self.negated.append(negated)
+		if self.tokens is not None:
+			self.tokens.append(token)
+
+	def get_token(self, index):
+		"""Gets token string of the index-th hit"""
+		if self.tokens is not None:
+			return self.tokens[index]
+		return ' '.join(
+			self.words[self.token_pos[index]:self.token_end[index]])
+
+	def count_negated(self):
+		return sum(self.negated)
+
+	def weight(self, wordcount, end_weight=1.5, end_threshold=0.75):
+		"""Weights hits at the end of the text, the way
+		LibraryRun.score_text() does, in one pass over the scores
+
+		output = score for entire text, see average_score()
+		"""
+		self.weighted_score = weighted_score = []
+		plain_sum = end_sum = end_hits = 0
+		wordcount = float(wordcount)
+		for token_pos, score in itertools.izip(self.token_pos, self.score):
+			if token_pos / wordcount >= end_threshold:
+				end_sum += score
+				end_hits += 1
+				weighted_score.append(score * end_weight)
+			else:
+				plain_sum += score
+				weighted_score.append(score)
+		return average_score(
+			plain_sum, end_sum, end_hits, len(self), end_weight)
+
+
+	def get_hits(self):
+		"""Gets hits as (token, token_pos, score, rule_num, negated)"""
+		return [(self.get_token(index), self.token_pos[index],
+			self.score[index], self.rule_num[index], bool(self.negated[index]))
+			for index in xrange(len(self))]
+
+	def get_matches(self, weighted=False):
+		"""Gets hits as the matches dict find_phrase_matches() outputs,
+		{token: [[token_pos, score, rule_num]]}, with weighted scores if
+		weighted=True. The lists are new, so changing them doesn't
+		change the table"""
+		scores = self.weighted_score if weighted else self.score
+		matches = collections.defaultdict(list)
+		for index in xrange(len(self)):
+			matches[self.get_token(index)].append(
+				[self.token_pos[index], scores[index], self.rule_num[index]])
+		return matches
+
+	def get_verbose_rows(self, text_id):
+		"""Gets sorted verbose result rows, [text_id, token, token_pos,
+		weighted score, rule_num] for each hit"""
+		return sorted([text_id, self.get_token(index), self.token_pos[index],
+			self.weighted_score[index], self.rule_num[index]]
+			for index in xrange(len(self)))
+
+
+def get_end_pos(wordcount, end_threshold=0.75):
+	"""Gets the first word position at the end of a text of wordcount
+	words, found with the same float test HitTable.weight() makes of
+	each hit"""
+	end_pos = max(0, int(math.ceil(wordcount * end_threshold)) - 1)
+	while end_pos < wordcount and end_pos / float(wordcount) < end_threshold:
+		end_pos += 1
+	return end_pos
+
+
+def average_score(plain_sum, end_sum, end_hits, num_hits, end_weight=1.5):
+	"""Averages the scores of a text's hits, with those at the end of
+	the text weighted by end_weight. Scores are summed before they're
+	weighted, so the average doesn't depend on the order of the hits
+
+	plain_sum = sum of scores of hits before the end of the text
+	end_sum = sum of scores of hits at the end of the text
+	end_hits = number of hits at the end of the text
+
+	output = average score; with int scores, an int (floor) average
+	unless a hit was weighted by a float end_weight, and 0 for a text
+	without hits
+	"""
+	if not num_hits:
+		return 0
+	if end_hits:
+		return (plain_sum + end_sum * end_weight) / num_hits
+	return plain_sum / num_hits
+
 def clean_row(row):
-	"""Cleans row from text file, outputs tuple (ID, cleaned_text)"""
-	text_id, text = row.split('\t')
-	text = text.lower()
-	text = re.sub(r'[^\w\s]', '', text)
-	text = text.translate(string.maketrans('\n\t\r', '   '))
-	#text = re.sub('\d', '', text)
-	return (text_id, text)
+	"""Cleans row from text file, outputs tuple (ID, cleaned_text)
+
+	Text is lowercased, stripped of punctuation and has newlines, tabs
+	and carriage returns turned into spaces (see TextNormalizer)"""
+	return _default_normalizer.clean_row(row)
+
+
+class _UnicodeTable(dict):
+	"""Translation table for unicode.translate() that works out and
+	caches the mapping of each character the first time it's seen"""
+	def __init__(self, map_char):
+		dict.__init__(self)
+		self.map_char = map_char
+
+	def __missing__(self, code):
+		mapped = self[code] = self.map_char(unichr(code))
+		return mapped
+
+
+class TextNormalizer(object):
+	"""Normalizes texts in a single translate() pass, with the mapping
+	precompiled into translation tables
+
+	By default the output is the same as lowercasing, removing
+	everything but word characters and whitespace (re.sub(r'[^\w\s]'))
+	and turning newlines, tabs and carriage returns into spaces.
+
+	keep_digits = if False, digits are removed too
+	unicode_aware = if True, letters, digits and whitespace of any
+	script are kept in unicode texts; by default only their ASCII
+	ones are, as with the regex
+	control_chars = what to do with newlines, tabs and carriage
+	returns: 'space' turns them into spaces, 'delete' removes them and
+	'keep' leaves them as they are
+	"""
+	control_char_policies = ('space', 'delete', 'keep')
+
+	def __init__(self, keep_digits=True, unicode_aware=False,
+		         control_chars='space'):
+		if control_chars not in self.control_char_policies:
+			raise SentimentException(
+				"unknown control_chars policy: %s" % control_chars)
+		self.keep_digits = keep_digits
+		self.unicode_aware = unicode_aware
+		self.control_chars = control_chars
+
+		self.byte_table, self.byte_deletions = self.make_byte_table()
+		# batches keep a NUL between texts to split them apart again
+		self.batch_table = self.byte_table
+		self.batch_deletions = self.byte_deletions.replace('\x00', '')
+		self.unicode_table = _UnicodeTable(self.map_unicode_char)
+
+	def map_byte(self, char):
+		"""Gets what a single byte turns into, '' if it's removed"""
+		if char in '\n\t\r':
+			return {'space': ' ', 'delete': '', 'keep': char}[self.control_chars]
+		if char in string.digits:
+			return char if self.keep_digits else ''
+		if char in string.ascii_letters or char in '_ \f\v':
+			return char.lower()
+		return ''
+
+	def make_byte_table(self):
+		"""Makes translation table and deleted bytes for str.translate()"""
+		table = []
+		deletions = []
+		for code in xrange(256):
+			mapped = self.map_byte(chr(code))
+			table.append(mapped or chr(code))
+			if not mapped:
+				deletions.append(chr(code))
+		return ''.join(table), ''.join(deletions)
+
+	def map_unicode_char(self, char):
+		"""Gets what a single unicode character turns into, None if it's
+		removed"""
+		mapped = []
+		for lower_char in char.lower():
+			if ord(lower_char) < 128:
+				mapped.append(self.map_byte(str(lower_char)))
+			elif self.unicode_aware and (
+				lower_char.isalpha() or lower_char.isspace() or
+				(lower_char.isdigit() and self.keep_digits)):
+				mapped.append(lower_char)
+		return u''.join(mapped) or None
+
+	def normalize(self, text):
+		"""Normalizes a single str or unicode text"""
+		if isinstance(text, unicode):
+			return text.translate(self.unicode_table)
+		return text.translate(self.byte_table, self.byte_deletions)
+
+	def clean_row(self, row):
+		"""Cleans row from text file, outputs tuple (ID, cleaned_text)"""
+		text_id, text = row.split('\t')
+		return (text_id, self.normalize(text))
+
+	def clean_rows(self, rows):
+		"""Cleans many rows from text file at once, outputs list of
+		(ID, cleaned_text). str texts are joined and translated in one
+		go, unless a text has a NUL byte of its own"""
+		split_rows = [row.split('\t') for row in rows]
+		texts = [text for _, text in split_rows]
+		if not all(type(text) is str for text in texts):
+			return [(text_id, self.normalize(text))
+				for text_id, text in split_rows]
+
+		joined = '\x00'.join(texts)
+		if joined.count('\x00') != len(texts) - 1:
+			return [(text_id, self.normalize(text))
+				for text_id, text in split_rows]
+		cleaned = joined.translate(
+			self.batch_table, self.batch_deletions).split('\x00')
+		return [(text_id, text)
+			for (text_id, _), text in itertools.izip(split_rows, cleaned)]
+
+_default_normalizer = TextNormalizer()
 
 def get_word_freq(text):
 	"""Gets word freq for each word in a text string, outputs {word: count}"""
@@ -64,10 +388,10 @@ def get_library_from_file(library_filepath):
 			library[phrase] = (int(score), index)
 	return library
 
-def get_opposite_meaning(phrase, num_words_btwn=2):
+def get_opposite_meaning(phrase, num_words_btwn=NEGATION_GAP):
 	"""Adds/removes negation words to/from phrase to get opposite meaning"""
 	negation_words = (
-		'(not|dont|cant|wont|couldnt|shouldnt|never) (\w+ ){0,' + str(
+		'(' + '|'.join(NEGATION_CUES) + ') (\w+ ){0,' + str(
 			num_words_btwn) + '} ?')
 	if negation_words in phrase:
 		phrase = phrase.replace(negation_words, "")
@@ -75,6 +399,43 @@ def get_opposite_meaning(phrase, num_words_btwn=2):
 		phrase = negation_words + phrase
 	return phrase
 
+def find_required_prefix(phrase):
+	"""Finds a string that a word of every token matching a phrase with
+	regex syntax, negated or not, has to start with: the literal start
+	of one of the phrase's space-separated parts outside brackets
+
+	output = the longest such string, or None if there is none (e.g.
+	the phrase has escapes or a top-level '|')
+	"""
+	if '\\' in phrase:
+		return None
+	parts = ['']
+	depth = 0
+	in_class = False
+	for char in phrase:
+		if in_class:
+			in_class = char != ']'
+		elif char == '[':
+			in_class = True
+		elif char == '(':
+			depth += 1
+		elif char == ')':
+			depth -= 1
+		elif depth == 0 and char == '|':
+			return None
+		elif depth == 0 and char == ' ':
+			parts.append('')
+			continue
+		parts[-1] += char
+
+	prefixes = []
+	for part in parts:
+		prefix = _LITERAL_PREFIX.match(part).group()
+		if part[len(prefix):len(prefix) + 1] in ('?', '*', '{'):
+			prefix = prefix[:-1] # the last character is optional
+		prefixes.append(prefix)
+	return max(prefixes, key=len) or None
+
 def create_negation_lib(library):
 	"""Creates negation library from given library by adding 
 	negation words to each phrase and reversing the score"""
@@ -109,40 +470,2976 @@ def format_lines_list(lines_list):
 
 	return formatted
 
+def split_results_simple(results_simple):
+	"""Splits a text's simple results into header and results, each in
+	the list of lists format format_lines_list() takes, with columns in
+	sorted order"""
+	# each embedded list represents one line of output
+	sorted_results = sorted(results_simple.iteritems())
+	header = [[item[0] for item in sorted_results]]
+	results = [[item[1] for item in sorted_results]]
+	return header, results
+
+
+class PhraseMatcher(object):
+	"""Matcher compiled once per library and reused across texts
+
+	Literal phrases (words separated by single spaces) are stored in a
+	word trie, so each token costs a few dict lookups instead of one regex
+	search per library phrase. Negation is handled as a state: a token
+	starting with a negation word is looked up again after skipping the
+	negation word and up to NEGATION_GAP words. Phrases containing regex
+	syntax are matched with the same patterns find_phrase_matches() has
+	always used.
+
+	The words of the library are also numbered in vocabulary, and the
+	trie copied into id_trie with word ids as keys, so texts can be
+	encoded into int arrays once and matched without building strings
+	(see encode() and find_span_hits()).
+
+	Phrases with regex syntax are indexed by a prefix one of their words
+	has to start with (see find_required_prefix()), so only the ones
+	whose prefix starts a word of the text are checked, and a text
+	without any such word or any first word of a trie phrase isn't
+	tokenized or walked at all.
+
+	library = {library phrase: (phrase score, rule number)}
+	"""
+	def __init__(self, library):
+		self.phrases = [] # [(phrase, score, rule_num)], in library order
+		self.trie = {} # {word: {word: ..., None: phrase id}}
+		self.regex_phrases = [] # [(phrase id, pattern, negated pattern)]
+		self.negation_cues = frozenset(NEGATION_CUES)
+		self.max_words = find_max_wordlength(library)
+
+		for phrase_id, (phrase, (score, rule_num)) in enumerate(
+			library.iteritems()):
+			self.phrases.append((phrase, score, rule_num))
+			if _LITERAL_PHRASE.match(phrase):
+				node = self.trie
+				for word in phrase.split(' '):
+					node = node.setdefault(word, {})
+				node[None] = phrase_id
+			else:
+				self.regex_phrases.append((phrase_id,
+					re.compile('^(' + phrase + ')$'),
+					re.compile('^(' + get_opposite_meaning(phrase) + ')$')))
+		self.build_id_tables()
+		self.build_regex_index()
+
+	def build_id_tables(self):
+		"""Numbers the library's words and the negation words, from 1 so
+		0 is left for words not in the library, and copies the trie with
+		words replaced by their ids"""
+		self.vocabulary = {} # {word: word id}
+		for word in NEGATION_CUES:
+			self.vocabulary.setdefault(word, len(self.vocabulary) + 1)
+		self.negation_ids = frozenset(
+			self.vocabulary[word] for word in NEGATION_CUES)
+
+		self.id_trie = {}
+		nodes = [(self.trie, self.id_trie)]
+		while nodes:
+			node, id_node = nodes.pop()
+			for word, child in node.iteritems():
+				if word is None:
+					id_node[None] = child
+					continue
+				word_id = self.vocabulary.setdefault(
+					word, len(self.vocabulary) + 1)
+				id_node[word_id] = {}
+				nodes.append((child, id_node[word_id]))
+		# first words of trie phrases, for rejecting texts without any
+		self.first_words = frozenset(self.trie)
+		self.first_ids = frozenset(self.id_trie)
+
+	def build_regex_index(self):
+		"""Indexes the phrases with regex syntax by their required
+		prefix, for get_regex_candidates()"""
+		# {prefix length: {prefix: [regex phrase]}}
+		self.regex_prefixes = collections.defaultdict(dict)
+		self.unindexed_regex_phrases = []
+		for regex_phrase in self.regex_phrases:
+			prefix = find_required_prefix(self.phrases[regex_phrase[0]][0])
+			if prefix is None:
+				self.unindexed_regex_phrases.append(regex_phrase)
+			else:
+				self.regex_prefixes[len(prefix)].setdefault(
+					prefix, []).append(regex_phrase)
+
+	def get_regex_candidates(self, words):
+		"""Gets the phrases with regex syntax that can match a token
+		of words, in library order"""
+		candidates = list(self.unindexed_regex_phrases)
+		if self.regex_prefixes:
+			word_set = set(words)
+			for length, by_prefix in self.regex_prefixes.iteritems():
+				heads = set(word[:length] for word in word_set)
+				for prefix in heads.intersection(by_prefix):
+					candidates.extend(by_prefix[prefix])
+			candidates.sort()
+		return candidates
+
+	def get_tables(self):
+		"""Outputs the matcher's tables as plain dicts, lists and tuples,
+		for saving with marshal"""
+		return {'phrases': self.phrases, 'trie': self.trie,
+			'max_words': self.max_words,
+			'regex_phrases': [(phrase_id, pattern.pattern, neg_pattern.pattern)
+				for phrase_id, pattern, neg_pattern in self.regex_phrases]}
+
+	@classmethod
+	def from_tables(cls, tables):
+		"""Recreates a matcher from get_tables() output without
+		rebuilding the trie"""
+		matcher = cls.__new__(cls)
+		matcher.phrases = tables['phrases']
+		matcher.trie = tables['trie']
+		matcher.max_words = tables['max_words']
+		matcher.negation_cues = frozenset(NEGATION_CUES)
+		matcher.regex_phrases = [
+			(phrase_id, re.compile(pattern), re.compile(neg_pattern))
+			for phrase_id, pattern, neg_pattern in tables['regex_phrases']]
+		matcher.build_id_tables()
+		matcher.build_regex_index()
+		return matcher
+
+	def get_library(self):
+		"""Outputs the library the matcher was compiled from"""
+		return dict((phrase, (score, rule_num))
+			for phrase, score, rule_num in self.phrases)
+
+	def lookup(self, words, start=0):
+		"""Returns id of the phrase spelled by words[start:], or None"""
+		node = self.trie
+		for i in xrange(start, len(words)):
+			node = node.get(words[i])
+			if node is None:
+				return None
+		return node.get(None)
+
+	def find_matches(self, tokens_generator):
+		"""Finds library phrase hits among tokens in a single pass
+
+		tokens_generator = iterable of (token, token_pos) for text
+
+		output = same as LibraryRun.find_phrase_matches(): dict of
+		token to list of [token position, phrase score, rule number],
+		positive hit count and negative hit count
+		"""
+		neg_hits = collections.defaultdict(list) # {phrase id: [(token, pos)]}
+		pos_hits = collections.defaultdict(list)
+
+		for token, token_pos in tokens_generator:
+			words = token.split(' ')
+			phrase_id = self.lookup(words)
+			if phrase_id is not None:
+				pos_hits[phrase_id].append((token, token_pos))
+
+			if words[0] in self.negation_cues:
+				for gap in xrange(min(NEGATION_GAP + 1, len(words) - 1)):
+					if gap and not _GAP_WORD.match(words[gap]):
+						break
+					phrase_id = self.lookup(words, gap + 1)
+					if phrase_id is not None:
+						neg_hits[phrase_id].append((token, token_pos))
+
+			self.match_regex_phrases(token, token_pos, neg_hits, pos_hits)
+
+		return self.resolve_hits(neg_hits, pos_hits)
+
+	def scan_words(self, words, max_words):
+		"""Finds library phrase hits by walking the trie from each word
+		position, without building the text's n-grams
+
+		Only spans starting with a library phrase's first word, or with a
+		negation word, are followed, and a token string is only joined for
+		a hit. Phrases with regex syntax still need every token, which
+		tokenize() then generates one at a time.
+
+		words = list of single words in order of the text
+		max_words = max number of words in a token
+
+		output = same as find_matches()
+		"""
+		return self.resolve_hits(*self.collect_hits(words, max_words))
+
+	def collect_hits(self, words, max_words):
+		"""Does the scanning for scan_words(), outputs negated and plain
+		hits before resolving them: two dicts of phrase id to list of
+		(token, token_pos)"""
+		neg_hits = collections.defaultdict(list) # {phrase id: [(token, pos)]}
+		pos_hits = collections.defaultdict(list)
+
+		text_len = len(words)
+		if self.first_words.isdisjoint(words):
+			text_len = 0 # no phrase starts anywhere in the text
+		for start in xrange(text_len):
+			end = min(text_len, start + max_words)
+			self.walk_trie(words, start, start, end, pos_hits)
+
+			if words[start] in self.negation_cues:
+				for gap in xrange(NEGATION_GAP + 1):
+					phrase_start = start + 1 + gap
+					if phrase_start >= end:
+						break
+					if gap and not _GAP_WORD.match(words[phrase_start - 1]):
+						break
+					self.walk_trie(words, start, phrase_start, end, neg_hits)
+
+		regex_phrases = self.get_regex_candidates(words)
+		if regex_phrases:
+			for token, token_pos in tokenize(words, max_words=max_words):
+				self.match_regex_phrases(
+					token, token_pos, neg_hits, pos_hits, regex_phrases)
+
+		return neg_hits, pos_hits
+
+	def walk_trie(self, words, token_start, phrase_start, end, hits):
+		"""Adds (token, token_pos) to hits for every library phrase spelled
+		by words from phrase_start, with the token starting at token_start
+		and ending before end"""
+		node = self.trie
+		for i in xrange(phrase_start, end):
+			node = node.get(words[i])
+			if node is None:
+				return
+			phrase_id = node.get(None)
+			if phrase_id is not None:
+				hits[phrase_id].append(
+					(' '.join(words[token_start:i + 1]), token_start))
+
+	def encode(self, words):
+		"""Encodes words as an array of word ids, 0 for words not in
+		the library"""
+		get_id = self.vocabulary.get
+		return array.array('i', [get_id(word, 0) for word in words])
+
+	def find_span_hits(self, word_ids, words, max_words):
+		"""Scans an encoded text like find_hits(), without building token
+		strings. words are only looked at for words not in the library
+		sitting between a negation word and a phrase, and for phrases
+		with regex syntax
+
+		word_ids = words encoded with encode()
+
+		output = HitTable of the hits, in the same order as find_hits()
+		"""
+		neg_hits = collections.defaultdict(list) # {phrase id: [(pos, end)]}
+		pos_hits = collections.defaultdict(list)
+		self.collect_span_hits(word_ids, words, max_words, neg_hits, pos_hits)
+		return self.make_span_table(words, neg_hits, pos_hits)
+
+	def make_span_table(self, words, neg_hits, pos_hits):
+		"""Resolves per-phrase hit spans like iter_resolved_hits(),
+		outputs HitTable of the hits"""
+		table = HitTable(words)
+		for phrase_id in sorted(set(neg_hits) | set(pos_hits)):
+			_, score, rule_num = self.phrases[phrase_id]
+			if phrase_id in neg_hits:
+				for token_pos, token_end in neg_hits[phrase_id]:
+					table.append(token_pos, token_end, -score, rule_num, True)
+			else:
+				for token_pos, token_end in pos_hits[phrase_id]:
+					table.append(token_pos, token_end, score, rule_num, False)
+		return table
+
+	def sum_span_hits(self, word_ids, words, max_words, end_threshold=0.75,
+		              rule_tallies=None):
+		"""Scans an encoded text like find_span_hits(), only counting
+		the hits of each phrase and how many are at the end of the text
+
+		output = (positive hit count, negative hit count, sum of scores
+		of hits before the end, sum of scores of hits at the end, number
+		of hits at the end), for average_score()
+
+		rule_tallies = if given, a dict the hit count and score sum of
+		each rule number are added to, as [hits, score sum]
+		"""
+		text_len = len(word_ids)
+		end_pos = get_end_pos(text_len, end_threshold)
+		# ({phrase id: hits before the end}, {phrase id: hits at the end})
+		neg_counts = ({}, {})
+		pos_counts = ({}, {})
+		if not self.first_ids.isdisjoint(word_ids):
+			self.count_span_hits(word_ids, words, max_words, 0, end_pos,
+				neg_counts[0], pos_counts[0])
+			self.count_span_hits(word_ids, words, max_words, end_pos, text_len,
+				neg_counts[1], pos_counts[1])
+		regex_phrases = self.get_regex_candidates(words)
+		if regex_phrases:
+			self.count_regex_spans(words, max_words, end_pos, neg_counts,
+				pos_counts, regex_phrases)
+
+		hitcount_pos = hitcount_neg = plain_sum = end_sum = end_hits = 0
+		for phrase_id in (set(neg_counts[0]) | set(neg_counts[1]) |
+			              set(pos_counts[0]) | set(pos_counts[1])):
+			score = self.phrases[phrase_id][1]
+			negated = phrase_id in neg_counts[0] or phrase_id in neg_counts[1]
+			if negated:
+				counts = neg_counts
+				score = -score
+			else:
+				counts = pos_counts
+			phrase_end_hits = counts[1].get(phrase_id, 0)
+			phrase_hits = counts[0].get(phrase_id, 0) + phrase_end_hits
+			if negated:
+				hitcount_neg += phrase_hits
+			else:
+				hitcount_pos += phrase_hits
+			plain_sum += score * (phrase_hits - phrase_end_hits)
+			end_sum += score * phrase_end_hits
+			end_hits += phrase_end_hits
+			if rule_tallies is not None:
+				tally = rule_tallies.setdefault(self.phrases[phrase_id][2], [0, 0])
+				tally[0] += phrase_hits
+				tally[1] += score * phrase_hits
+		return hitcount_pos, hitcount_neg, plain_sum, end_sum, end_hits
+
+	def count_span_hits(self, word_ids, words, max_words, first, last,
+		                neg_counts, pos_counts):
+		"""Scans an encoded text like collect_span_hits(), for tokens
+		starting from first up to last, adding 1 to neg_counts[phrase id]
+		or pos_counts[phrase id] for each hit instead of keeping spans"""
+		trie = self.id_trie
+		negation_ids = self.negation_ids
+		text_len = len(word_ids)
+		for start in xrange(first, last):
+			word_id = word_ids[start]
+			end = min(text_len, start + max_words)
+			node = trie.get(word_id)
+			i = start + 1
+			while node is not None:
+				phrase_id = node.get(None)
+				if phrase_id is not None:
+					pos_counts[phrase_id] = pos_counts.get(phrase_id, 0) + 1
+				if i >= end:
+					break
+				node = node.get(word_ids[i])
+				i += 1
+
+			if word_id in negation_ids:
+				for gap in xrange(NEGATION_GAP + 1):
+					phrase_start = start + 1 + gap
+					if phrase_start >= end:
+						break
+					if gap and not word_ids[phrase_start - 1] and (
+						not _GAP_WORD.match(words[phrase_start - 1])):
+						break
+					self.count_id_trie(word_ids, phrase_start, end, neg_counts)
+
+	def count_id_trie(self, word_ids, phrase_start, end, counts):
+		"""Like walk_id_trie(), adding 1 to counts[phrase id] for each
+		hit"""
+		node = self.id_trie
+		for i in xrange(phrase_start, end):
+			node = node.get(word_ids[i])
+			if node is None:
+				return
+			phrase_id = node.get(None)
+			if phrase_id is not None:
+				counts[phrase_id] = counts.get(phrase_id, 0) + 1
+
+	def count_regex_spans(self, words, max_words, end_pos, neg_counts,
+		                  pos_counts, regex_phrases):
+		"""Matches the tokens of words against regex_phrases like
+		collect_regex_spans(), adding 1 to neg_counts[at end][phrase id]
+		or pos_counts[at end][phrase id] for each hit, where at end is
+		whether the token starts at or after end_pos"""
+		for token, token_pos in tokenize(words, max_words=max_words):
+			at_end = int(token_pos >= end_pos)
+			neg, pos = neg_counts[at_end], pos_counts[at_end]
+			for phrase_id, pattern, neg_pattern in regex_phrases:
+				if neg_pattern.search(token) is not None:
+					neg[phrase_id] = neg.get(phrase_id, 0) + 1
+				if pattern.search(token) is not None:
+					pos[phrase_id] = pos.get(phrase_id, 0) + 1
+
+	def collect_span_hits(self, word_ids, words, max_words, neg_hits,
+		                  pos_hits):
+		"""Does the scanning for find_span_hits(), appending the
+		(token_pos, token_end) span of each hit to neg_hits[phrase id]
+		or pos_hits[phrase id]"""
+		trie = self.id_trie
+		negation_ids = self.negation_ids
+		text_len = len(word_ids)
+		if self.first_ids.isdisjoint(word_ids):
+			text_len = 0 # no phrase starts anywhere in the text
+		for start in xrange(text_len):
+			end = min(text_len, start + max_words)
+			if word_ids[start] in trie:
+				self.walk_id_trie(word_ids, start, start, end, pos_hits)
+
+			if word_ids[start] in negation_ids:
+				for gap in xrange(NEGATION_GAP + 1):
+					phrase_start = start + 1 + gap
+					if phrase_start >= end:
+						break
+					if gap and not word_ids[phrase_start - 1] and (
+						not _GAP_WORD.match(words[phrase_start - 1])):
+						break
+					self.walk_id_trie(
+						word_ids, start, phrase_start, end, neg_hits)
+
+		regex_phrases = self.get_regex_candidates(words)
+		if regex_phrases:
+			self.collect_regex_spans(
+				words, max_words, neg_hits, pos_hits, regex_phrases)
+
+	def collect_regex_spans(self, words, max_words, neg_hits, pos_hits,
+		                    regex_phrases):
+		"""Matches the tokens of words against regex_phrases, appending
+		the (token_pos, token_end) span of each hit to neg_hits or
+		pos_hits like collect_span_hits()"""
+		regex_neg_hits = collections.defaultdict(list)
+		regex_pos_hits = collections.defaultdict(list)
+		for token, token_pos in tokenize(words, max_words=max_words):
+			self.match_regex_phrases(token, token_pos, regex_neg_hits,
+				regex_pos_hits, regex_phrases)
+		for regex_hits, hits in ((regex_neg_hits, neg_hits),
+			                     (regex_pos_hits, pos_hits)):
+			for phrase_id, phrase_hits in regex_hits.iteritems():
+				for token, token_pos in phrase_hits:
+					hits[phrase_id].append(
+						(token_pos, token_pos + token.count(' ') + 1))
+
+	def walk_id_trie(self, word_ids, token_start, phrase_start, end, hits):
+		"""Like walk_trie(), for an encoded text: adds the (token_pos,
+		token_end) span of each hit to hits"""
+		node = self.id_trie
+		for i in xrange(phrase_start, end):
+			node = node.get(word_ids[i])
+			if node is None:
+				return
+			phrase_id = node.get(None)
+			if phrase_id is not None:
+				hits[phrase_id].append((token_start, i + 1))
+
+	def count_candidates(self, words, max_words):
+		"""Counts the spans scan_words() follows into the trie, plus the
+		token checks against the regex phrases get_regex_candidates() leaves,
+		for profiling"""
+		candidates = 0
+		text_len = len(words)
+		for start in xrange(text_len):
+			end = min(text_len, start + max_words)
+			if words[start] in self.trie:
+				candidates += 1
+			if words[start] in self.negation_cues:
+				for phrase_start in xrange(
+					start + 1, min(end, start + NEGATION_GAP + 2)):
+					if words[phrase_start] in self.trie:
+						candidates += 1
+		num_regex_phrases = len(self.get_regex_candidates(words))
+		if num_regex_phrases:
+			candidates += num_regex_phrases * sum(max(0, text_len - length + 1)
+				for length in xrange(1, max_words + 1))
+		return candidates
+
+	def match_regex_phrases(self, token, token_pos, neg_hits, pos_hits,
+		                    regex_phrases=None):
+		"""Checks a single token against the phrases with regex syntax,
+		or only against regex_phrases if given"""
+		if regex_phrases is None:
+			regex_phrases = self.regex_phrases
+		for phrase_id, pattern, neg_pattern in regex_phrases:
+			if neg_pattern.search(token) is not None:
+				neg_hits[phrase_id].append((token, token_pos))
+			if pattern.search(token) is not None:
+				pos_hits[phrase_id].append((token, token_pos))
+
+	def iter_resolved_hits(self, neg_hits, pos_hits):
+		"""Resolves per-phrase hits into scored hits. As with the original
+		regex loop, a phrase found negated anywhere in the text doesn't
+		count its positive hits, and phrases are visited in library order.
+		This is a generator.
+
+		output = (token, token_pos, score, rule_num, negated) for each hit
+		"""
+		for phrase_id in sorted(set(neg_hits) | set(pos_hits)):
+			_, score, rule_num = self.phrases[phrase_id]
+			if phrase_id in neg_hits:
+				for token, token_pos in neg_hits[phrase_id]:
+					yield token, token_pos, -score, rule_num, True
+			else:
+				for token, token_pos in pos_hits[phrase_id]:
+					yield token, token_pos, score, rule_num, False
+
+	def find_hits(self, words, max_words):
+		"""Scans words like scan_words(), outputs list of resolved hits,
+		each (token, token_pos, score, rule_num, negated)"""
+		return list(self.iter_resolved_hits(
+			*self.collect_hits(words, max_words)))
+
+	def resolve_hits(self, neg_hits, pos_hits):
+		"""Turns per-phrase hits into matches, positive hit count and
+		negative hit count"""
+		return self.get_matches(self.iter_resolved_hits(neg_hits, pos_hits))
+
+	def get_matches(self, hits):
+		"""Turns resolved hits into matches, positive hit count and
+		negative hit count"""
+		hitcount_pos = 0
+		hitcount_neg = 0
+
+		matches = collections.defaultdict(list)
+		for token, token_pos, score, rule_num, negated in hits:
+			matches[token].append([token_pos, score, rule_num])
+			if negated:
+				hitcount_neg += 1
+			else:
+				hitcount_pos += 1
+
+		return matches, hitcount_pos, hitcount_neg
+
+
+class LibrarySet(object):
+	"""Several named libraries matched in a single pass over each text,
+	through one PhraseMatcher compiled from the phrases of all of them
+
+	Hits of the combined matcher are handed to each library that has
+	the phrase, with its score and rule number. Each library keeps the
+	token window its own matcher would have (its longest phrase plus
+	the negation allowance), and a phrase found negated only in a
+	longer token doesn't lose its positive hits in that library, so
+	each library's hits are the ones it would find on its own.
+
+	libraries = {library name: library}
+	"""
+	def __init__(self, libraries):
+		self.libraries = libraries
+		self.names = sorted(libraries)
+		phrases = sorted(set(
+			phrase for library in libraries.itervalues() for phrase in library))
+		self.matcher = PhraseMatcher(dict(
+			(phrase, (0, index)) for index, phrase in enumerate(phrases)))
+		# {library name: [(phrase id in the library's own PhraseMatcher,
+		# score, rule_num) or None for each phrase id]}
+		self.entries = {}
+		for name, library in libraries.iteritems():
+			own_ids = dict((phrase, own_id)
+				for own_id, phrase in enumerate(library))
+			self.entries[name] = [
+				(own_ids[phrase],) + library[phrase] if phrase in library
+				else None for phrase, _, _ in self.matcher.phrases]
+		self.max_words = dict((name, find_max_wordlength(library) + 2)
+			for name, library in libraries.iteritems())
+
+	def find_span_hits(self, word_ids, words):
+		"""Scans an encoded text once for all libraries
+
+		output = {library name: HitTable}, each as that library's
+		PhraseMatcher.find_span_hits() would find them
+		"""
+		neg_hits = collections.defaultdict(list) # {phrase id: [(pos, end)]}
+		pos_hits = collections.defaultdict(list)
+		self.matcher.collect_span_hits(word_ids, words,
+			max(self.max_words.itervalues()), neg_hits, pos_hits)
+
+		phrase_ids = sorted(set(neg_hits) | set(pos_hits))
+		tables = {}
+		for name in self.names:
+			entries = self.entries[name]
+			max_words = self.max_words[name]
+			table = tables[name] = HitTable(words)
+			for _, phrase_id in sorted((entries[phrase_id][0], phrase_id)
+				for phrase_id in phrase_ids if entries[phrase_id] is not None):
+				_, score, rule_num = entries[phrase_id]
+				spans = [(token_pos, token_end) for token_pos, token_end
+					in neg_hits.get(phrase_id, ())
+					if token_end - token_pos <= max_words]
+				if spans:
+					score, negated = -score, True
+				else:
+					negated = False
+					spans = [(token_pos, token_end) for token_pos, token_end
+						in pos_hits.get(phrase_id, ())
+						if token_end - token_pos <= max_words]
+				for token_pos, token_end in spans:
+					table.append(token_pos, token_end, score, rule_num, negated)
+		return tables
+
+
+def get_library_hash(library_filepath):
+	"""Hashes library file contents, together with the negation settings
+	the matcher is built with, to key compiled library files"""
+	library_hash = hashlib.sha1(repr((NEGATION_CUES, NEGATION_GAP)))
+	with open(library_filepath, "rb") as lib_file:
+		for block in iter(lambda: lib_file.read(1 << 20), ''):
+			library_hash.update(block)
+	return library_hash.digest()
+
+def get_library_fingerprint(library, *settings):
+	"""Hashes library phrases, scores and rule numbers, together with
+	the negation settings and any run settings that change results"""
+	fingerprint = hashlib.sha1(repr((NEGATION_CUES, NEGATION_GAP, settings)))
+	fingerprint.update(marshal.dumps(sorted(library.iteritems())))
+	return fingerprint.digest()
+
+def save_compiled_library(matcher, library_hash, compiled_filepath):
+	"""Saves matcher tables to a compiled library file
+
+	file layout = LIBRARY_FILE_MAGIC, format version (unsigned short),
+	library_hash (20 bytes), then the marshalled matcher tables. The file
+	is written next to its final path and renamed into place, so workers
+	never load a half-written file"""
+	tmp_filepath = compiled_filepath + '.tmp%d' % os.getpid()
+	with open(tmp_filepath, "wb") as compiled_file:
+		compiled_file.write(LIBRARY_FILE_MAGIC)
+		compiled_file.write(struct.pack('<H', LIBRARY_FILE_VERSION))
+		compiled_file.write(library_hash)
+		marshal.dump(matcher.get_tables(), compiled_file)
+	os.rename(tmp_filepath, compiled_filepath)
+
+def load_compiled_library(compiled_filepath, library_hash=None):
+	"""Loads matcher from a compiled library file, memory-mapping it
+	so the tables are unmarshalled straight from the page cache
+
+	output = PhraseMatcher, or None if the file is missing, was written
+	by another format version or doesn't match library_hash"""
+	header_size = len(LIBRARY_FILE_MAGIC) + 2 + 20
+	try:
+		compiled_file = open(compiled_filepath, "rb")
+	except IOError:
+		return None
+	with compiled_file:
+		if os.fstat(compiled_file.fileno()).st_size <= header_size:
+			return None
+		mapped = mmap.mmap(compiled_file.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			magic_end = len(LIBRARY_FILE_MAGIC)
+			if (mapped[:magic_end] != LIBRARY_FILE_MAGIC or
+				struct.unpack('<H', mapped[magic_end:magic_end + 2])[0] !=
+				LIBRARY_FILE_VERSION):
+				return None
+			if (library_hash is not None and
+				mapped[magic_end + 2:header_size] != library_hash):
+				return None
+			tables = marshal.loads(buffer(mapped, header_size))
+		finally:
+			mapped.close()
+	return PhraseMatcher.from_tables(tables)
+
+def load_library(library_filepath, compiled_filepath=None):
+	"""Loads library and its matcher, using the compiled library file
+	if it's up to date with the library file and (re)compiling it if not
+
+	compiled_filepath = where the compiled library is kept, defaults to
+	library_filepath + '.compiled'
+
+	output = (library, matcher)
+	"""
+	if compiled_filepath is None:
+		compiled_filepath = library_filepath + '.compiled'
+	library_hash = get_library_hash(library_filepath)
+	matcher = load_compiled_library(compiled_filepath, library_hash)
+	if matcher is not None:
+		return matcher.get_library(), matcher
+
+	library = get_library_from_file(library_filepath)
+	matcher = PhraseMatcher(library)
+	save_compiled_library(matcher, library_hash, compiled_filepath)
+	return library, matcher
+
+class ResultsSink(object):
+	"""Base class for output sinks that write result rows to a file,
+	buffering them and writing batch_size rows at a time
+
+	filepath = output file, overwritten if it exists
+	columns = SIMPLE_COLUMNS or VERBOSE_COLUMNS, the shape of the rows
+	batch_size = number of rows buffered before a batch is written
+
+	Subclasses implement open_file(), write_batch() and close_file()
+	"""
+	__metaclass__ = abc.ABCMeta
+
+	def __init__(self, filepath, columns, batch_size=10000):
+		self.filepath = filepath
+		self.columns = columns
+		self.batch_size = batch_size
+		self.rows = []
+		self.open_file()
+
+	def write_rows(self, rows):
+		"""Buffers rows (lists of values in column order), writing a
+		batch once batch_size rows are buffered"""
+		self.rows.extend(rows)
+		if len(self.rows) >= self.batch_size:
+			self.flush()
+
+	def flush(self):
+		"""Writes buffered rows"""
+		if self.rows:
+			self.write_batch(self.rows)
+			self.rows = []
+
+	def close(self):
+		"""Writes buffered rows and closes the file"""
+		self.flush()
+		self.close_file()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+		return False
+
+	@abc.abstractmethod
+	def open_file(self):
+		"""Opens filepath for writing, called once when the sink is made"""
+
+	@abc.abstractmethod
+	def write_batch(self, rows):
+		"""Writes a non-empty list of rows to the open file"""
+
+	@abc.abstractmethod
+	def close_file(self):
+		"""Closes the file, after the last batch is written"""
+
+
+class TSVSink(ResultsSink):
+	"""Writes results as tab-separated text with a single header line"""
+	def open_file(self):
+		self.out = open_compressed(self.filepath, "w")
+		self.out.writelines(
+			format_lines_list([[name for name, _ in self.columns]]))
+
+	def write_batch(self, rows):
+		self.out.writelines(format_lines_list(rows))
+
+	def close_file(self):
+		self.out.close()
+
+
+class BinarySink(ResultsSink):
+	"""Writes results in a compact fixed-schema binary format
+
+	file layout = OUTPUT_FILE_MAGIC, then format version and number of
+	columns (unsigned shorts), then each column's type code and
+	name (unsigned short length + bytes). Batches follow, each the row
+	count (unsigned int) then one block per column: little-endian int64s
+	or float64s, or for strings their lengths (unsigned ints) then
+	their utf-8 bytes. read_binary_results() reads it back.
+	"""
+	def open_file(self):
+		self.out = open_compressed(self.filepath, "wb")
+		self.out.write(OUTPUT_FILE_MAGIC)
+		self.out.write(struct.pack(
+			'<HH', OUTPUT_FILE_VERSION, len(self.columns)))
+		for name, kind in self.columns:
+			self.out.write(kind + struct.pack('<H', len(name)) + name)
+
+	def write_batch(self, rows):
+		num_rows = len(rows)
+		blocks = [struct.pack('<I', num_rows)]
+		for (_, kind), values in zip(self.columns, zip(*rows)):
+			if kind == 's':
+				values = [value.encode('utf-8') if isinstance(value, unicode)
+					else str(value) for value in values]
+				blocks.append(struct.pack(
+					'<%dI' % num_rows, *[len(value) for value in values]))
+				blocks.append(''.join(values))
+			else:
+				blocks.append(struct.pack('<%d%s' % (num_rows, kind), *values))
+		self.out.write(''.join(blocks))
+
+	def close_file(self):
+		self.out.close()
+
+
+class ArrowSink(ResultsSink):
+	"""Writes results as an Arrow IPC file, one record batch per batch"""
+	arrow_types = {'s': 'string', 'd': 'float64', 'q': 'int64'}
+
+	def open_file(self):
+		if pyarrow is None:
+			raise SentimentException("arrow output needs pyarrow")
+		self.schema = pyarrow.schema([
+			(name, getattr(pyarrow, self.arrow_types[kind])())
+			for name, kind in self.columns])
+		self.open_writer()
+
+	def open_writer(self):
+		self.writer = pyarrow.RecordBatchFileWriter(self.filepath, self.schema)
+
+	def make_record_batch(self, rows):
+		"""Turns rows into a pyarrow.RecordBatch"""
+		arrays = [pyarrow.array(list(values), type=field.type)
+			for field, values in zip(self.schema, zip(*rows))]
+		return pyarrow.RecordBatch.from_arrays(arrays, self.schema.names)
+
+	def write_batch(self, rows):
+		self.writer.write_batch(self.make_record_batch(rows))
+
+	def close_file(self):
+		self.writer.close()
+
+
+class ParquetSink(ArrowSink):
+	"""Writes results as a Parquet file, one row group per batch"""
+	def open_writer(self):
+		self.writer = pyarrow.parquet.ParquetWriter(self.filepath, self.schema)
+
+	def write_batch(self, rows):
+		self.writer.write_table(
+			pyarrow.Table.from_batches([self.make_record_batch(rows)]))
+
+
+RESULTS_SINKS = {'tsv': TSVSink, 'binary': BinarySink, 'arrow': ArrowSink,
+	'parquet': ParquetSink}
+
+def open_results_sink(filepath, output_format, columns, batch_size=10000):
+	"""Opens output sink for output_format: 'tsv', 'binary', 'arrow',
+	'parquet', or 'columnar' for arrow when pyarrow is installed and
+	binary otherwise"""
+	if output_format == 'columnar':
+		output_format = 'arrow' if pyarrow is not None else 'binary'
+	if output_format not in RESULTS_SINKS:
+		raise SentimentException(
+			"unknown output format: %s" % output_format)
+	return RESULTS_SINKS[output_format](filepath, columns, batch_size)
+
+def read_binary_results(filepath):
+	"""Reads a file written by BinarySink. This is a generator.
+
+	output = one dict of column name to list of values per batch
+	"""
+	with open_compressed(filepath, "rb") as results_file:
+		if results_file.read(len(OUTPUT_FILE_MAGIC)) != OUTPUT_FILE_MAGIC:
+			raise SentimentException("not a binary results file")
+		version, num_columns = struct.unpack('<HH', results_file.read(4))
+		if version != OUTPUT_FILE_VERSION:
+			raise SentimentException(
+				"unsupported binary results version: %d" % version)
+		columns = []
+		for _ in xrange(num_columns):
+			kind = results_file.read(1)
+			name_len, = struct.unpack('<H', results_file.read(2))
+			columns.append((results_file.read(name_len), kind))
+
+		while True:
+			count = results_file.read(4)
+			if not count:
+				return
+			num_rows, = struct.unpack('<I', count)
+			batch = {}
+			for name, kind in columns:
+				if kind == 's':
+					lengths = struct.unpack('<%dI' % num_rows,
+						results_file.read(4 * num_rows))
+					data = results_file.read(sum(lengths))
+					values = []
+					offset = 0
+					for length in lengths:
+						values.append(data[offset:offset + length])
+						offset += length
+				else:
+					values = list(struct.unpack('<%d%s' % (num_rows, kind),
+						results_file.read(8 * num_rows)))
+				batch[name] = values
+			yield batch
+
+class ExternalSorter(object):
+	"""Sorts more rows than fit in memory: rows are buffered until their
+	estimated size in memory reaches max_bytes, then sorted and written
+	to a run file, and the runs are merged merge_width at a time at the
+	end. The sort is stable, so rows with equal keys stay in the order
+	added
+
+	key = function of a row giving its sort key
+	max_bytes = estimated memory taken by the rows kept in memory, from
+	sys.getsizeof() of each row, its fields and its list slot; the sort
+	keys made when a run is written come on top of this
+	directory = directory to make the run files' temporary directory in
+	merge_width = max number of run files read at once
+	block_rows = number of rows written to a run file at a time
+	"""
+	def __init__(self, key, max_bytes=1 << 26, directory=None,
+		         merge_width=64, block_rows=1000):
+		self.key = key
+		self.max_bytes = max_bytes
+		self.merge_width = merge_width
+		self.block_rows = block_rows
+		self.directory = tempfile.mkdtemp(prefix='sort', dir=directory)
+		self.rows = []
+		self.size = 0
+		self.runs = [] # run filepaths, in the order their rows were added
+		self.run_count = 0
+
+	def close(self):
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+		return False
+
+	def add_rows(self, rows):
+		"""Adds rows, writing a run file if they don't fit"""
+		self.rows.extend(rows)
+		getsizeof = sys.getsizeof
+		slot_size = getsizeof([None]) - getsizeof([])
+		for row in rows:
+			self.size += slot_size + getsizeof(row) + sum(
+				getsizeof(field) for field in row)
+		if self.size >= self.max_bytes:
+			self.rows.sort(key=self.key)
+			self.write_run(self.rows)
+			self.rows = []
+			self.size = 0
+
+	def write_run(self, rows):
+		"""Writes sorted rows to a new run file, block_rows at a time"""
+		run_filepath = os.path.join(self.directory, '%d' % self.run_count)
+		self.run_count += 1
+		with open(run_filepath, "wb") as run_file:
+			for block in iter_chunks(rows, self.block_rows):
+				marshal.dump(block, run_file)
+		self.runs.append(run_filepath)
+
+	def read_run(self, run_filepath):
+		"""Reads the rows of a run file. This is a generator."""
+		with open(run_filepath, "rb") as run_file:
+			while True:
+				try:
+					block = marshal.load(run_file)
+				except EOFError:
+					return
+				for row in block:
+					yield row
+
+	def merge_runs(self, run_filepaths):
+		"""Merges sorted run files into one sorted stream of rows, ties
+		taken from the earlier run first. This is a generator."""
+		key = self.key
+		decorated = [((key(row), run_index, row) for row in self.read_run(
+			run_filepath)) for run_index, run_filepath in enumerate(run_filepaths)]
+		for _, _, row in heapq.merge(*decorated):
+			yield row
+
+	def iter_sorted(self):
+		"""Sorts all rows added, yielding them in key order. This is a
+		generator."""
+		self.rows.sort(key=self.key)
+		if not self.runs:
+			for row in self.rows:
+				yield row
+			return
+		if self.rows:
+			self.write_run(self.rows)
+			self.rows = []
+		runs = self.runs
+		while len(runs) > self.merge_width:
+			groups = [runs[i:i + self.merge_width]
+				for i in xrange(0, len(runs), self.merge_width)]
+			self.runs = []
+			for group in groups:
+				self.write_run(self.merge_runs(group))
+				for run_filepath in group:
+					os.remove(run_filepath)
+			runs = self.runs
+		for row in self.merge_runs(runs):
+			yield row
+
+
+class RunStats(object):
+	"""Collects per-stage timings and counts from library runs, for
+	finding out where the time of a slow run goes
+
+	Stage times are summed and bucketed into histograms with power-of-two
+	microsecond bounds. Texts are counted with their words, candidate
+	spans and hits, and the slowest texts are kept as outliers.
+
+	slowest = number of slowest texts to keep
+	callback = if given, called with each text's profile record (see
+	LibraryRun.get_profile()) as it's added
+	"""
+	def __init__(self, slowest=10, callback=None):
+		self.slowest = slowest
+		self.callback = callback
+		self.stage_seconds = collections.defaultdict(float)
+		self.stage_histograms = {} # {stage: {bucket upper bound in us: count}}
+		self.counts = collections.defaultdict(int)
+		self.slowest_texts = [] # heap of (total seconds, text id, record)
+		self.pipeline = None # StagedPipeline.get_summary() of a pipelined run
+
+	def add_time(self, stage, seconds):
+		"""Adds a single timing of a stage"""
+		self.stage_seconds[stage] += seconds
+		bucket = 1 << max(0, int(math.ceil(math.log(max(seconds * 1e6, 1), 2))))
+		histogram = self.stage_histograms.setdefault(stage, {})
+		histogram[bucket] = histogram.get(bucket, 0) + 1
+
+	def add_text(self, record):
+		"""Adds a text's profile record"""
+		total_seconds = 0
+		for stage, seconds in record['seconds'].iteritems():
+			self.add_time(stage, seconds)
+			total_seconds += seconds
+		self.counts['texts'] += 1
+		for count in ('words', 'candidates', 'hits'):
+			self.counts[count] += record[count]
+
+		if len(self.slowest_texts) < self.slowest:
+			heapq.heappush(self.slowest_texts,
+				(total_seconds, record['text id'], record))
+		elif self.slowest and total_seconds > self.slowest_texts[0][0]:
+			heapq.heapreplace(self.slowest_texts,
+				(total_seconds, record['text id'], record))
+
+		if self.callback is not None:
+			self.callback(record)
+
+	def get_summary(self):
+		"""Gets collected stats as a dict of plain values: stage total
+		seconds and histograms, counts, the slowest texts' records,
+		slowest first, and the pipeline summary of a pipelined run"""
+		summary = {'stage seconds': dict(self.stage_seconds),
+			'stage histograms': dict((stage, sorted(histogram.iteritems()))
+				for stage, histogram in self.stage_histograms.iteritems()),
+			'counts': dict(self.counts),
+			'slowest texts': [record for _, _, record in
+				sorted(self.slowest_texts, reverse=True)]}
+		if self.pipeline is not None:
+			summary['pipeline'] = self.pipeline
+		return summary
+
+	def dump(self, output_file):
+		"""Writes get_summary() to an open file as JSON"""
+		json.dump(self.get_summary(), output_file, indent=2, sort_keys=True)
+
+
+class CorpusAggregates(object):
+	"""Corpus totals kept as texts are written, from each text's tally
+	(see LibraryRun.get_tally()), so they needn't be worked out from the
+	output file afterwards
+
+	Texts, words and positive and negative hits are counted, hits are
+	counted and their unweighted scores summed by rule number, and text
+	scores are summed and counted in a histogram of bin_width wide bins,
+	which gives quantiles to within bin_width. Aggregates of separate
+	processes or runs (e.g. over byte ranges of one file) merge into the
+	totals of all their texts, including through get_summary() output
+	saved as JSON (see from_summary()).
+
+	bin_width = width of the text score histogram bins
+	"""
+	quantiles = (0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99)
+
+	def __init__(self, bin_width=0.01):
+		self.bin_width = bin_width
+		self.counts = collections.defaultdict(int)
+		self.rule_hits = collections.defaultdict(int)
+		self.rule_scores = collections.defaultdict(float)
+		self.score_bins = collections.defaultdict(int) # {bin: text count}
+		self.score_sum = 0.0
+		self.score_min = None
+		self.score_max = None
+
+	def add_tally(self, tally):
+		"""Adds a single text's tally"""
+		text_score, wordcount, hitcount_pos, hitcount_neg, rule_tallies = tally
+		self.counts['texts'] += 1
+		self.counts['words'] += wordcount
+		self.counts['pos hits'] += hitcount_pos
+		self.counts['neg hits'] += hitcount_neg
+		for rule_num, (hits, score_sum) in rule_tallies.iteritems():
+			self.rule_hits[rule_num] += hits
+			self.rule_scores[rule_num] += score_sum
+		self.add_scores({int(math.floor(text_score / self.bin_width)): 1},
+			text_score, text_score, text_score)
+
+	def add_scores(self, score_bins, score_sum, score_min, score_max):
+		"""Adds text scores counted in score_bins"""
+		for score_bin, count in score_bins.iteritems():
+			self.score_bins[score_bin] += count
+		self.score_sum += score_sum
+		if score_min is not None and (
+			self.score_min is None or score_min < self.score_min):
+			self.score_min = score_min
+		if score_max is not None and (
+			self.score_max is None or score_max > self.score_max):
+			self.score_max = score_max
+
+	def merge(self, other):
+		"""Adds the totals of another CorpusAggregates"""
+		if other.bin_width != self.bin_width:
+			raise SentimentException(
+				"aggregates with different bin widths can't be merged")
+		for count, value in other.counts.iteritems():
+			self.counts[count] += value
+		for rule_num, hits in other.rule_hits.iteritems():
+			self.rule_hits[rule_num] += hits
+		for rule_num, score_sum in other.rule_scores.iteritems():
+			self.rule_scores[rule_num] += score_sum
+		self.add_scores(other.score_bins, other.score_sum, other.score_min,
+			other.score_max)
+
+	def get_quantile(self, fraction):
+		"""Gets the text score at fraction of the way through the sorted
+		scores, as the middle of its histogram bin"""
+		if not self.counts['texts']:
+			return None
+		rank = fraction * (self.counts['texts'] - 1)
+		seen = 0
+		for score_bin, count in sorted(self.score_bins.iteritems()):
+			seen += count
+			if seen > rank:
+				break
+		score = (score_bin + 0.5) * self.bin_width
+		return min(max(score, self.score_min), self.score_max)
+
+	def get_summary(self):
+		"""Gets the aggregates as a dict of plain values: counts, text
+		score mean, range, quantiles and histogram (as [bin start, text
+		count] pairs), and hits and score sum by rule number"""
+		texts = self.counts['texts']
+		return {'counts': dict(self.counts, **{'total hits':
+				self.counts['pos hits'] + self.counts['neg hits']}),
+			'bin width': self.bin_width,
+			'score mean': self.score_sum / texts if texts else None,
+			'score sum': self.score_sum,
+			'score min': self.score_min, 'score max': self.score_max,
+			'score quantiles': dict(('%g' % fraction,
+				self.get_quantile(fraction)) for fraction in self.quantiles),
+			'score histogram': [[score_bin * self.bin_width, count]
+				for score_bin, count in sorted(self.score_bins.iteritems())],
+			'rules': dict((str(rule_num), {'hits': hits,
+				'score sum': self.rule_scores[rule_num]})
+				for rule_num, hits in self.rule_hits.iteritems())}
+
+	@classmethod
+	def from_summary(cls, summary):
+		"""Recreates aggregates from get_summary() output, e.g. loaded
+		back from JSON, for merging"""
+		aggregates = cls(summary['bin width'])
+		counts = dict(summary['counts'])
+		counts.pop('total hits', None)
+		aggregates.counts.update(counts)
+		for rule_num, rule in summary['rules'].iteritems():
+			aggregates.rule_hits[int(rule_num)] = rule['hits']
+			aggregates.rule_scores[int(rule_num)] = rule['score sum']
+		aggregates.add_scores(dict(
+			(int(round(start / aggregates.bin_width)), count)
+			for start, count in summary['score histogram']),
+			summary['score sum'], summary['score min'], summary['score max'])
+		return aggregates
+
+	def dump(self, output_file):
+		"""Writes get_summary() to an open file as JSON"""
+		json.dump(self.get_summary(), output_file, indent=2, sort_keys=True)
+
+
+class ResultCache(object):
+	"""Cache of run results keyed by cleaned text, for reusing the
+	results of duplicate texts
+
+	Entries are keyed by a hash of a library fingerprint (see
+	get_library_fingerprint()) and the cleaned text, and hold the
+	marshalled result rows and hits of a run. They're kept in memory
+	up to max_bytes, evicting the least recently used first, and also
+	in directory if given, which persists between runs.
+
+	max_bytes = total size of marshalled entries kept in memory
+	directory = directory for the on-disk tier, created if missing
+	"""
+	def __init__(self, max_bytes=1 << 26, directory=None):
+		self.max_bytes = max_bytes
+		self.directory = directory
+		self.entries = collections.OrderedDict() # {key: marshalled entry}
+		self.size = 0
+		self.counts = collections.defaultdict(int)
+		if directory is not None and not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def get_key(self, fingerprint, text):
+		"""Gets cache key of a cleaned text for a library fingerprint"""
+		if isinstance(text, unicode):
+			text = text.encode('utf-8')
+		return hashlib.sha1(fingerprint + text).hexdigest()
+
+	def get_entry_filepath(self, key):
+		return os.path.join(self.directory, key[:2], key[2:])
+
+	def get(self, key):
+		"""Gets entry stored under key, None if there isn't one"""
+		data = self.entries.pop(key, None)
+		if data is None and self.directory is not None:
+			try:
+				with open(self.get_entry_filepath(key), "rb") as entry_file:
+					data = entry_file.read()
+			except IOError:
+				pass
+			else:
+				self.counts['disk hits'] += 1
+				self.size += len(data)
+				self.evict()
+		if data is None:
+			self.counts['misses'] += 1
+			return None
+		self.counts['hits'] += 1
+		self.entries[key] = data
+		return marshal.loads(data)
+
+	def put(self, key, entry):
+		"""Stores entry (anything marshal can dump) under key"""
+		data = marshal.dumps(entry)
+		old_data = self.entries.pop(key, None)
+		if old_data is not None:
+			self.size -= len(old_data)
+		self.entries[key] = data
+		self.size += len(data)
+		self.evict()
+		if self.directory is not None:
+			entry_filepath = self.get_entry_filepath(key)
+			if not os.path.isdir(os.path.dirname(entry_filepath)):
+				try:
+					os.mkdir(os.path.dirname(entry_filepath))
+				except OSError: # made by another process meanwhile
+					pass
+			tmp_filepath = entry_filepath + '.tmp%d' % os.getpid()
+			with open(tmp_filepath, "wb") as entry_file:
+				entry_file.write(data)
+			os.rename(tmp_filepath, entry_filepath)
+
+	def evict(self):
+		"""Drops least recently used entries until under max_bytes"""
+		while self.size > self.max_bytes and self.entries:
+			_, data = self.entries.popitem(last=False)
+			self.size -= len(data)
+			self.counts['evictions'] += 1
+
+	def get_summary(self):
+		"""Gets lookup counts and the hit and miss rates"""
+		summary = dict(self.counts)
+		lookups = self.counts['hits'] + self.counts['misses']
+		summary['hit rate'] = self.counts['hits'] / float(lookups or 1)
+		summary['miss rate'] = self.counts['misses'] / float(lookups or 1)
+		summary['bytes'] = self.size
+		return summary
+
+
+def write_hit_store_header(hit_store, library, max_words):
+	"""Starts a hit store in an open file. A hit store keeps the hits
+	found in each text of a run, with the library they were found
+	with, so the run can be rescored after library edits (see
+	SentimentFactory.rescore()). Hit records follow the header, one
+	marshalled (text_id, wordcount, hits) per text"""
+	marshal.dump({'version': HIT_STORE_VERSION, 'library': library,
+		'max_words': max_words}, hit_store)
+
+def read_hit_store(hit_store):
+	"""Reads hit store from an open file
+
+	output = (header dict with the library and max_words the hits were
+	found with, generator of (text_id, wordcount, hits) for each text)
+	"""
+	header = marshal.load(hit_store)
+	if header.get('version') != HIT_STORE_VERSION:
+		raise SentimentException("unsupported hit store version")
+
+	def read_records():
+		while True:
+			try:
+				yield marshal.load(hit_store)
+			except EOFError:
+				return
+	return header, read_records()
+
+def diff_libraries(old_library, new_library):
+	"""Compares two libraries by phrase, ignoring rule numbers
+
+	output = (set of added phrases, set of phrases whose score changed,
+	set of removed phrases)
+	"""
+	added = set(new_library) - set(old_library)
+	removed = set(old_library) - set(new_library)
+	changed = set(phrase for phrase in set(new_library) & set(old_library)
+		if new_library[phrase][0] != old_library[phrase][0])
+	return added, changed, removed
+
+RunOutput = collections.namedtuple('RunOutput', 'rows profile hits tally')
+
+def run_library(text, library, matcher, simple=True, profile=False,
+	            keep_hits=False, summary_only=False, keep_tally=False):
+	"""Runs library on a single cleaned text
+
+	output = RunOutput of result rows from LibraryRun.get_result_rows(),
+	profile record from LibraryRun.get_profile() if profile=True,
+	hit record (text_id, wordcount, hits) if keep_hits=True and
+	LibraryRun.get_tally() if keep_tally=True
+	"""
+	if isinstance(matcher, LibrarySet):
+		if keep_hits or summary_only or keep_tally:
+			raise SentimentException(
+				"hits, tallies and summary_only runs need a single library")
+		return run_library_set(text, matcher, simple, profile)
+	run_instance = LibraryRun(text, library, matcher=matcher, profile=profile,
+		summary_only=summary_only)
+	run_instance.do_run()
+	return get_run_output(run_instance, simple, profile, keep_hits, keep_tally)
+
+def run_library_set(text, library_set, simple=True, profile=False):
+	"""Runs every library of a LibrarySet on a single cleaned text,
+	splitting, encoding and matching the text once
+
+	output = RunOutput of each library's result rows in turn, with the
+	library name after the text id (see get_library_set_columns()),
+	and a profile record for the whole text if profile=True
+	"""
+	timings = {}
+	start = time.time()
+	text_id = text[0]
+	words = text[1].split()
+	word_ids = library_set.matcher.encode(words)
+	timings['preprocess'] = time.time() - start
+
+	start = time.time()
+	tables = library_set.find_span_hits(word_ids, words)
+	timings['match'] = time.time() - start
+
+	start = time.time()
+	runs = [(name, LibraryRun.from_hit_table(text_id, len(words),
+		tables[name], library_set.libraries[name], library_set.matcher))
+		for name in library_set.names]
+	timings['score'] = time.time() - start
+
+	start = time.time()
+	rows = []
+	for name, run_instance in runs:
+		rows.extend([row[0], name] + row[1:]
+			for row in run_instance.get_result_rows(simple))
+	timings['format'] = time.time() - start
+
+	record = None
+	if profile:
+		record = {'text id': text_id, 'seconds': timings,
+			'words': len(words),
+			'hits': sum(len(table) for table in tables.itervalues()),
+			'candidates': library_set.matcher.count_candidates(
+				words, max(library_set.max_words.itervalues()))}
+	return RunOutput(rows, record, None, None)
+
+def get_library_set_columns(columns):
+	"""Gets output columns of a LibrarySet run: columns with a library
+	name column after the text id"""
+	return columns[:1] + [('library', 's')] + columns[1:]
+
+def get_run_output(run_instance, simple=True, profile=False, keep_hits=False,
+	               keep_tally=False):
+	"""Gets RunOutput for a finished LibraryRun"""
+	return RunOutput(run_instance.get_result_rows(simple),
+		run_instance.get_profile() if profile else None,
+		(run_instance.text_id, run_instance.wordcount,
+			run_instance.get_hits()) if keep_hits else None,
+		run_instance.get_tally() if keep_tally else None)
+
+def score_hits_batch(text_index, hit_pos, hit_score, negated, wordcount,
+	                 end_weight=1.5, end_threshold=0.75):
+	"""Scores the hits of many texts at once with NumPy, weighting and
+	averaging them the way LibraryRun.score_text() does for one text
+
+	text_index = index into wordcount of each hit's text
+	hit_pos = token position of each hit
+	hit_score = phrase score of each hit, already negated for
+	negated phrases
+	negated = whether each hit is a negated phrase
+	wordcount = total word count of each text
+
+	output = dict with, for each text, 'text score', 'pos hits',
+	'neg hits' and 'total hits', and for each hit, 'weighted score'.
+	Text scores are a list of Python numbers: like score_text(), texts
+	whose weighted scores are all ints get an int (floor) average, and
+	texts without hits score 0
+	"""
+	if numpy is None:
+		raise SentimentException("score_hits_batch() needs numpy")
+
+	text_index = numpy.asarray(text_index, dtype=numpy.intp)
+	hit_pos = numpy.asarray(hit_pos)
+	hit_score = numpy.asarray(hit_score)
+	negated = numpy.asarray(negated, dtype=bool)
+	wordcount = numpy.asarray(wordcount)
+	num_texts = len(wordcount)
+	if not len(hit_score):
+		hit_score = hit_score.astype(int)
+
+	# weight phrases at end of text
+	is_end = (hit_pos / wordcount[text_index].astype(float)) >= end_threshold
+	weighted_score = numpy.where(is_end, hit_score * end_weight, hit_score)
+
+	total_hits = numpy.bincount(text_index, minlength=num_texts)
+	neg_hits = numpy.bincount(
+		text_index[negated], minlength=num_texts)
+
+	# texts whose weighted scores are all ints are floor-averaged
+	if issubclass(hit_score.dtype.type, numpy.integer):
+		int_sums = numpy.zeros(num_texts, dtype=numpy.int64)
+		numpy.add.at(int_sums, text_index, hit_score)
+		int_texts = numpy.bincount(
+			text_index[is_end], minlength=num_texts) == 0
+		if isinstance(end_weight, (int, long)):
+			numpy.add.at(int_sums, text_index[is_end],
+				hit_score[is_end] * (end_weight - 1))
+			int_texts[:] = True
+	else:
+		int_sums = numpy.zeros(num_texts, dtype=numpy.int64)
+		int_texts = total_hits == 0
+
+	float_sums = numpy.bincount(
+		text_index, weights=weighted_score, minlength=num_texts)
+	divisor = numpy.maximum(total_hits, 1)
+	text_score = numpy.where(int_texts,
+		(int_sums // divisor).astype(object),
+		(float_sums / divisor).astype(object))
+
+	return {'text score': text_score.tolist(),
+		'pos hits': total_hits - neg_hits, 'neg hits': neg_hits,
+		'total hits': total_hits, 'weighted score': weighted_score}
+
+def run_library_batch(texts, matcher, end_weight=1.5, end_threshold=0.75):
+	"""Runs matcher's library on a chunk of cleaned texts, matching
+	each text and then scoring all of them together with
+	score_hits_batch()
+
+	output = list of simple results for each text, the same dicts
+	LibraryRun.make_results_simple() creates
+	"""
+	max_words = matcher.max_words + 2 # for word allowances from negation
+	text_ids = []
+	wordcount = []
+	text_index = []
+	hit_pos = []
+	hit_score = []
+	negated = []
+	for index, (text_id, text) in enumerate(texts):
+		words = text.split()
+		text_ids.append(text_id)
+		wordcount.append(len(words))
+		hit_table = matcher.find_span_hits(
+			matcher.encode(words), words, max_words)
+		text_index.extend([index] * len(hit_table))
+		hit_pos.extend(hit_table.token_pos)
+		hit_score.extend(hit_table.score)
+		negated.extend(hit_table.negated)
+
+	scored = score_hits_batch(text_index, hit_pos, hit_score, negated,
+		wordcount, end_weight, end_threshold)
+
+	return [{'.text id': text_id, '.text score': text_score,
+		'total wordcount': text_wordcount, 'total hits': total,
+		'pos hits': pos, 'neg hits': neg}
+		for text_id, text_score, text_wordcount, total, pos, neg
+		in itertools.izip(text_ids, scored['text score'], wordcount,
+			scored['total hits'].tolist(), scored['pos hits'].tolist(),
+			scored['neg hits'].tolist())]
+
+def split_segments(wordcount, segment_words, overlap):
+	"""Splits a text's word positions into windows of segment_words
+	positions each, overlapping the next window by overlap words
+
+	output = list of (start, own_end, end): the window is words
+	[start:end], and the hits whose token starts in [start, own_end)
+	are the window's
+	"""
+	return [(start, min(wordcount, start + segment_words),
+		min(wordcount, start + segment_words + overlap))
+		for start in xrange(0, wordcount, segment_words)]
+
+def find_segment_hits(matcher, words, offset, num_owned, max_words):
+	"""Finds the hits of one window of a text, words being the window's
+	words and offset its start in the text
+
+	output = (neg_hits, pos_hits) of PhraseMatcher.collect_span_hits(),
+	as plain dicts of the hits whose token starts in the first num_owned
+	words, at whole-text positions. Phrases without such hits are left
+	out, so they don't suppress anything when merged
+	"""
+	neg_hits = collections.defaultdict(list)
+	pos_hits = collections.defaultdict(list)
+	matcher.collect_span_hits(
+		matcher.encode(words), words, max_words, neg_hits, pos_hits)
+	owned = []
+	for hits in (neg_hits, pos_hits):
+		owned.append({})
+		for phrase_id, spans in hits.iteritems():
+			spans = [(token_pos + offset, token_end + offset)
+				for token_pos, token_end in spans if token_pos < num_owned]
+			if spans:
+				owned[-1][phrase_id] = spans
+	return tuple(owned)
+
+def merge_segment_hits(matcher, segment_hits):
+	"""Merges find_segment_hits() output of each window of a text, in
+	window order, into the (neg_hits, pos_hits) collect_span_hits()
+	finds in the whole text, for PhraseMatcher.make_span_table()"""
+	merged = (collections.defaultdict(list), collections.defaultdict(list))
+	for window_hits in segment_hits:
+		for hits, window_phrase_hits in zip(merged, window_hits):
+			for phrase_id, spans in window_phrase_hits.iteritems():
+				hits[phrase_id].extend(spans)
+	# tokenize() makes tokens shortest first, so regex hits are found
+	# in token length order
+	for regex_phrase in matcher.regex_phrases:
+		for hits in merged:
+			if regex_phrase[0] in hits:
+				hits[regex_phrase[0]].sort(key=lambda span: (
+					span[1] - span[0], span[0]))
+	return merged
+
+def iter_chunks(iterable, chunk_size):
+	"""Groups items of iterable into lists of up to chunk_size items.
+	This is a generator."""
+	iterator = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(iterator, chunk_size))
+		if not chunk:
+			return
+		yield chunk
+
+class StagedPipeline(object):
+	"""Runs items from a source through stages of worker threads joined
+	by bounded queues, so reading, CPU work and writing overlap
+
+	Each stage applies its function to one item at a time, in as many
+	threads as it's given. Items carry their sequence number, and run()
+	yields results in source order. A full queue holds up the stages
+	before it, so a slow stage shows up as a deep queue in front of it.
+
+	queue_size = max number of items waiting in front of each stage
+	"""
+	_END = 'end'
+	_ERROR = 'error'
+
+	def __init__(self, queue_size=8):
+		self.queue_size = queue_size
+		self.stages = [] # [(name, function, threads)]
+		self.lock = threading.Lock()
+		self.stage_seconds = collections.defaultdict(float)
+		self.stage_items = collections.defaultdict(int)
+		# {stage: [max depth, sum of depths, number of puts]} of the
+		# queue in front of each stage, 'output' for the last one
+		self.queue_depths = {}
+		self.stopped = threading.Event()
+
+	def add_stage(self, name, function, threads=1):
+		"""Adds a stage running function on each item in threads threads"""
+		self.stages.append((name, function, threads))
+
+	def put(self, queue_name, out_queue, item):
+		"""Puts item on a queue, recording its depth. Outputs False if
+		the pipeline was stopped while waiting for room"""
+		while not self.stopped.is_set():
+			try:
+				out_queue.put(item, timeout=0.1)
+			except Queue.Full:
+				continue
+			depth = out_queue.qsize()
+			with self.lock:
+				depths = self.queue_depths.setdefault(queue_name, [0, 0, 0])
+				depths[0] = max(depths[0], depth)
+				depths[1] += depth
+				depths[2] += 1
+			return True
+		return False
+
+	def get(self, in_queue):
+		"""Gets next item from a queue, None if the pipeline was stopped"""
+		while not self.stopped.is_set():
+			try:
+				return in_queue.get(timeout=0.1)
+			except Queue.Empty:
+				continue
+		return None
+
+	def read_source(self, source, queue_name, out_queue):
+		"""Puts (sequence number, item) of each source item on out_queue"""
+		try:
+			for seq, item in enumerate(source):
+				if not self.put(queue_name, out_queue, (seq, item)):
+					return
+		except Exception:
+			self.put(queue_name, out_queue, (self._ERROR, sys.exc_info()))
+		self.put(queue_name, out_queue, (self._END, None))
+
+	def run_stage(self, name, function, in_queue, queue_name, out_queue,
+		          running):
+		"""Runs function on items from in_queue, putting the results on
+		out_queue, until the end of the source. running = one-item list
+		of the stage's threads still running; the last one to finish
+		passes the end on"""
+		while True:
+			task = self.get(in_queue)
+			if task is None:
+				return
+			seq, item = task
+			if seq == self._END:
+				in_queue.put(task) # for the stage's other threads
+				with self.lock:
+					running[0] -= 1
+					last = not running[0]
+				if last:
+					self.put(queue_name, out_queue, task)
+				return
+			if seq == self._ERROR:
+				self.put(queue_name, out_queue, task)
+				continue
+
+			start = time.time()
+			try:
+				task = (seq, function(item))
+			except Exception:
+				task = (self._ERROR, sys.exc_info())
+			with self.lock:
+				self.stage_seconds[name] += time.time() - start
+				self.stage_items[name] += 1
+			self.put(queue_name, out_queue, task)
+
+	def run(self, source):
+		"""Runs source items through the stages, yielding the results in
+		source order. This is a generator. An exception raised in a
+		stage is raised here"""
+		queues = [Queue.Queue(self.queue_size)
+			for _ in xrange(len(self.stages) + 1)]
+		queue_names = [name for name, _, _ in self.stages] + ['output']
+		threads = [threading.Thread(target=self.read_source,
+			args=(source, queue_names[0], queues[0]))]
+		for index, (name, function, num_threads) in enumerate(self.stages):
+			running = [num_threads]
+			for _ in xrange(num_threads):
+				threads.append(threading.Thread(target=self.run_stage,
+					args=(name, function, queues[index],
+						queue_names[index + 1], queues[index + 1], running)))
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+
+		done = {} # {sequence number: result} of results out of order
+		next_seq = 0
+		try:
+			while True:
+				seq, result = self.get(queues[-1])
+				if seq == self._END:
+					return
+				if seq == self._ERROR:
+					raise result[0], result[1], result[2]
+				done[seq] = result
+				while next_seq in done:
+					yield done.pop(next_seq)
+					next_seq += 1
+		finally:
+			self.stopped.set()
+			for thread in threads:
+				thread.join()
+
+	def get_summary(self):
+		"""Gets busy seconds and item count of each stage, and the max
+		and mean depth of the queue in front of each stage"""
+		with self.lock:
+			return {'stage seconds': dict(self.stage_seconds),
+				'stage items': dict(self.stage_items),
+				'queue depths': dict((name, {'max': depths[0],
+					'mean': depths[1] / float(depths[2] or 1)})
+					for name, depths in self.queue_depths.iteritems())}
+
+def get_compression(filepath, detect=True):
+	"""Gets compression of a file from its extension or, if detect=True
+	and the file exists, its first bytes. Outputs 'gzip', 'bz2', 'xz',
+	'zstd' or None for an uncompressed file"""
+	compression = COMPRESSION_EXTENSIONS.get(
+		os.path.splitext(filepath)[1].lower())
+	if compression is not None or not detect:
+		return compression
+	try:
+		with open(filepath, "rb") as raw_file:
+			start = raw_file.read(6)
+	except IOError:
+		return None
+	for magic, compression in COMPRESSION_MAGIC:
+		if start.startswith(magic):
+			return compression
+	return None
+
+def get_codec(compression):
+	"""Gets (compressor factory, decompressor factory) for compression;
+	each factory makes a new object with compress()/flush() or
+	decompress() and unused_data, for a single stream"""
+	if compression == 'gzip':
+		return (lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+			lambda: zlib.decompressobj(32 + zlib.MAX_WBITS))
+	if compression == 'bz2':
+		return bz2.BZ2Compressor, bz2.BZ2Decompressor
+	if compression == 'xz':
+		if lzma is None:
+			raise SentimentException("xz compression needs lzma")
+		return lzma.LZMACompressor, lzma.LZMADecompressor
+	if compression == 'zstd':
+		if zstandard is None:
+			raise SentimentException("zstd compression needs zstandard")
+		return (lambda: zstandard.ZstdCompressor().compressobj(),
+			lambda: zstandard.ZstdDecompressor().decompressobj())
+	raise SentimentException("unknown compression: %s" % compression)
+
+def open_compressed(filepath, mode="r", compression=None):
+	"""Opens a file for reading or writing, through CompressedReader or
+	CompressedWriter if it's compressed (see get_compression(); only
+	the extension counts when writing) and with open() if not"""
+	if compression is None:
+		compression = get_compression(filepath, detect='r' in mode)
+	if compression is None:
+		return open(filepath, mode)
+	if 'r' in mode:
+		return CompressedReader(filepath, compression)
+	return CompressedWriter(filepath, mode, compression)
+
+
+class CompressedReader(object):
+	"""Reads a compressed file, decompressing it in a background thread
+	a block at a time so decompression overlaps with the reader's work.
+	Concatenated streams, as left by appending, are read one after the
+	other.
+
+	block_size = number of compressed bytes read at a time
+	queue_size = max number of decompressed blocks read ahead
+	"""
+	def __init__(self, filepath, compression=None, block_size=1 << 20,
+		         queue_size=4):
+		if compression is None:
+			compression = get_compression(filepath)
+		self.make_decompressor = get_codec(compression)[1]
+		self.block_size = block_size
+		self.file = open(filepath, "rb")
+		self.blocks = Queue.Queue(queue_size)
+		self.stopped = threading.Event()
+		self.buffer = ''
+		self.eof = False
+		self.thread = threading.Thread(target=self.decompress_blocks)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def put(self, item):
+		"""Puts item on the block queue, False if the reader was closed
+		while waiting for room"""
+		while not self.stopped.is_set():
+			try:
+				self.blocks.put(item, timeout=0.1)
+				return True
+			except Queue.Full:
+				continue
+		return False
+
+	def decompress_blocks(self):
+		"""Decompresses the file into the block queue, ending it with
+		None, or the exception's exc_info if decompressing fails"""
+		try:
+			decompressor = self.make_decompressor()
+			for data in iter(lambda: self.file.read(self.block_size), ''):
+				while data:
+					try:
+						block = decompressor.decompress(data)
+					except EOFError: # a stream ended right at the block end
+						decompressor = self.make_decompressor()
+						continue
+					data = decompressor.unused_data
+					if data: # the next stream starts here
+						decompressor = self.make_decompressor()
+					if block and not self.put(block):
+						return
+			self.put(None)
+		except Exception:
+			self.put(sys.exc_info())
+
+	def read(self, size=-1):
+		"""Reads up to size decompressed bytes, all the rest if size < 0"""
+		parts = [self.buffer]
+		length = len(self.buffer)
+		while (size < 0 or length < size) and not self.eof:
+			block = self.blocks.get()
+			if block is None:
+				self.eof = True
+			elif isinstance(block, tuple):
+				raise block[0], block[1], block[2]
+			else:
+				parts.append(block)
+				length += len(block)
+		data = ''.join(parts)
+		if size < 0:
+			self.buffer = ''
+			return data
+		self.buffer = data[size:]
+		return data[:size]
+
+	def close(self):
+		self.stopped.set()
+		self.thread.join()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+		return False
+
+
+class CompressedWriter(object):
+	"""Writes a compressed file, buffering writes into blocks that are
+	compressed and written in a background thread. Appending adds a new
+	compressed stream after the ones in the file.
+
+	block_size = number of bytes buffered before a block is compressed
+	queue_size = max number of blocks waiting to be compressed
+	"""
+	def __init__(self, filepath, mode="w", compression=None,
+		         block_size=1 << 20, queue_size=4):
+		if compression is None:
+			compression = get_compression(filepath, detect=False)
+		self.compressor = get_codec(compression)[0]()
+		self.block_size = block_size
+		self.file = open(filepath, "ab" if 'a' in mode else "wb")
+		self.blocks = Queue.Queue(queue_size)
+		self.parts = []
+		self.size = 0
+		self.error = None
+		self.thread = threading.Thread(target=self.compress_blocks)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def write(self, data):
+		self.parts.append(data)
+		self.size += len(data)
+		if self.size >= self.block_size:
+			self.hand_off()
+
+	def writelines(self, lines):
+		for line in lines:
+			self.write(line)
+
+	def hand_off(self):
+		"""Hands buffered writes to the compressing thread"""
+		if self.parts:
+			self.blocks.put(''.join(self.parts))
+			self.parts = []
+			self.size = 0
+
+	def compress_blocks(self):
+		"""Compresses blocks from the queue into the file until None"""
+		while True:
+			block = self.blocks.get()
+			try:
+				if self.error is None:
+					if block is None:
+						self.file.write(self.compressor.flush())
+					else:
+						self.file.write(self.compressor.compress(block))
+			except Exception:
+				self.error = sys.exc_info()
+			finally:
+				self.blocks.task_done()
+			if block is None:
+				return
+
+	def raise_error(self):
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise error[0], error[1], error[2]
+
+	def flush(self):
+		"""Waits until everything written so far is compressed and
+		handed to the file"""
+		self.hand_off()
+		self.blocks.join()
+		self.raise_error()
+		self.file.flush()
+
+	def close(self):
+		self.hand_off()
+		self.blocks.put(None)
+		self.thread.join()
+		self.file.close()
+		self.raise_error()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+		return False
+
+
+def open_text_file(filepath, block_size=1 << 22):
+	"""Opens text file as a MappedTextFile, or a CompressedTextFile if
+	it's compressed"""
+	compression = get_compression(filepath)
+	if compression is not None:
+		return CompressedTextFile(filepath, block_size, compression)
+	return MappedTextFile(filepath, block_size)
+
+class MappedTextFile(object):
+	"""Text file read through mmap, in large blocks of rows
+
+	Rows are the file's lines, newline included. Byte offsets always
+	fall on row boundaries, so the file can be split into ranges that
+	separate workers (or machines) read on their own, and a run can be
+	resumed from the offset after the last row it finished.
+
+	block_size = number of bytes split into rows at a time
+	"""
+	def __init__(self, filepath, block_size=1 << 22):
+		self.block_size = block_size
+		self.file = open(filepath, "rb")
+		self.size = os.fstat(self.file.fileno()).st_size
+		self.map = None
+		if self.size:
+			self.map = mmap.mmap(
+				self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def close(self):
+		if self.map is not None:
+			self.map.close()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+		return False
+
+	def find_row_start(self, offset):
+		"""Finds the first row boundary at or after offset"""
+		if offset <= 0:
+			return 0
+		if offset >= self.size:
+			return self.size
+		newline = self.map.find('\n', offset - 1)
+		return self.size if newline == -1 else newline + 1
+
+	def get_byte_ranges(self, num_ranges):
+		"""Splits the file into up to num_ranges (start, end) byte ranges
+		of about the same size, on row boundaries"""
+		boundaries = sorted(set(
+			[self.find_row_start(self.size * i // num_ranges)
+				for i in xrange(num_ranges)] + [self.size]))
+		return zip(boundaries[:-1], boundaries[1:])
+
+	def iter_rows(self, start=0, end=None, row_ends=None):
+		"""Reads the rows starting in [start, end) block by block. This
+		is a generator.
+
+		row_ends = if given, a deque that gets the offset just after
+		each row appended before the row is yielded, for checkpointing
+		"""
+		if end is None or end > self.size:
+			end = self.size
+		pos = self.find_row_start(start)
+		while pos < end:
+			block_end = min(max(end, pos + 1), pos + self.block_size)
+			newline = self.map.rfind('\n', pos, block_end)
+			while newline == -1 and block_end < self.size:
+				# a row longer than the block
+				block_end = min(self.size, block_end + self.block_size)
+				newline = self.map.rfind('\n', pos, block_end)
+			if newline == -1:
+				lines = [self.map[pos:self.size]]
+			else:
+				lines = [line + '\n' for line in
+					self.map[pos:newline].split('\n')]
+			for line in lines:
+				pos += len(line)
+				if row_ends is not None:
+					row_ends.append(pos)
+				yield line
+				if pos >= end:
+					return
+
+class CompressedTextFile(object):
+	"""Compressed text file read as a stream of rows, with the same
+	iter_rows() as MappedTextFile; offsets are in decompressed bytes.
+
+	A stream can't be looked ahead in, so find_row_start() gives offset
+	back as it is (iter_rows() still starts at the next row boundary)
+	and the file can't be split into byte ranges.
+	"""
+	def __init__(self, filepath, block_size=1 << 22, compression=None):
+		self.block_size = block_size
+		self.reader = CompressedReader(filepath, compression)
+
+	def close(self):
+		self.reader.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+		return False
+
+	def find_row_start(self, offset):
+		return max(0, offset)
+
+	def get_byte_ranges(self, num_ranges):
+		raise SentimentException("compressed files can't be split")
+
+	def iter_rows(self, start=0, end=None, row_ends=None):
+		"""Reads the rows starting in [start, end), like
+		MappedTextFile.iter_rows(). This is a generator."""
+		pos = 0
+		rest = ''
+		while True:
+			block = self.reader.read(self.block_size)
+			if not block:
+				lines = [rest] if rest else []
+			else:
+				lines = (rest + block).split('\n')
+				rest = lines.pop()
+				lines = [line + '\n' for line in lines]
+			for line in lines:
+				row_start = pos
+				pos += len(line)
+				if row_start < start:
+					continue
+				if end is not None and row_start >= end:
+					return
+				if row_ends is not None:
+					row_ends.append(pos)
+				yield line
+			if not block:
+				return
+
+def build_corpus_index(texts, index_filepath):
+	"""Builds a positional inverted index of cleaned (text id, text)
+	pairs and saves it to index_filepath, for CorpusIndex. Outputs the
+	number of texts indexed
+
+	file layout = INDEX_FILE_MAGIC, format version (unsigned short),
+	offset of the header (unsigned long long), the word ids of each text
+	in turn, the posting list of each word in turn, then the marshalled
+	header. Word ids and postings are int32 in the byte order of the
+	machine that built the index, a posting being a (text index, word
+	position) pair. The file is written next to its final path and
+	renamed into place like a compiled library file
+	"""
+	vocabulary = {} # {word: word id}
+	postings = [] # [array of (text index, position) pairs] by word id
+	text_ids = []
+	wordcounts = []
+	tmp_filepath = index_filepath + '.tmp%d' % os.getpid()
+	with open(tmp_filepath, "wb") as index_file:
+		index_file.write(INDEX_FILE_MAGIC)
+		index_file.write(struct.pack('<HQ', INDEX_FILE_VERSION, 0))
+		forward_offset = index_file.tell()
+		for text_index, (text_id, text) in enumerate(texts):
+			word_ids = array.array('i')
+			for position, word in enumerate(text.split()):
+				word_id = vocabulary.get(word)
+				if word_id is None:
+					word_id = vocabulary[word] = len(postings)
+					postings.append(array.array('i'))
+				word_ids.append(word_id)
+				postings[word_id].extend((text_index, position))
+			index_file.write(word_ids.tostring())
+			text_ids.append(text_id)
+			wordcounts.append(len(word_ids))
+
+		postings_offset = index_file.tell()
+		posting_starts = [0] # index of each word's first posting
+		for word_postings in postings:
+			index_file.write(word_postings.tostring())
+			posting_starts.append(posting_starts[-1] + len(word_postings) // 2)
+
+		header_offset = index_file.tell()
+		marshal.dump({'words': sorted(vocabulary, key=vocabulary.get),
+			'text_ids': text_ids, 'wordcounts': wordcounts,
+			'posting_starts': posting_starts, 'forward_offset': forward_offset,
+			'postings_offset': postings_offset}, index_file)
+		index_file.seek(len(INDEX_FILE_MAGIC))
+		index_file.write(struct.pack('<HQ', INDEX_FILE_VERSION, header_offset))
+	os.rename(tmp_filepath, index_filepath)
+	return len(text_ids)
+
+class CorpusIndex(object):
+	"""Positional inverted index saved by build_corpus_index(), read
+	through mmap, for running libraries over the same corpus again and
+	again without reading and splitting the texts
+
+	Each literal phrase's occurrences come from the posting list of its
+	rarest word, checked against the words at the phrase's other
+	positions, and negation cues and gap words are checked at the
+	positions before each occurrence. Phrases with regex syntax are
+	matched in the texts having a word that starts with their required
+	prefix (see find_required_prefix()). The hits and results are those
+	LibraryRun finds in the same texts.
+	"""
+	_word_id = struct.Struct('i')
+
+	def __init__(self, index_filepath):
+		self.file = open(index_filepath, "rb")
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic_end = len(INDEX_FILE_MAGIC)
+		version, header_offset = struct.unpack(
+			'<HQ', self.map[magic_end:magic_end + 10])
+		if (self.map[:magic_end] != INDEX_FILE_MAGIC or
+			version != INDEX_FILE_VERSION):
+			self.close()
+			raise SentimentException(
+				"%s isn't a corpus index of this version" % index_filepath)
+		header = marshal.loads(buffer(self.map, header_offset))
+		self.words = header['words']
+		self.vocabulary = dict(
+			(word, word_id) for word_id, word in enumerate(self.words))
+		self.text_ids = header['text_ids']
+		self.wordcounts = header['wordcounts']
+		self.posting_starts = header['posting_starts']
+		self.forward_offset = header['forward_offset']
+		self.postings_offset = header['postings_offset']
+		self.text_starts = [0] # index of each text's first word id
+		for wordcount in self.wordcounts:
+			self.text_starts.append(self.text_starts[-1] + wordcount)
+
+	def close(self):
+		self.map.close()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+		return False
+
+	def get_postings(self, word_id):
+		"""Gets the posting list of a word, as an array of text index
+		and position pairs one after the other"""
+		postings = array.array('i')
+		postings.fromstring(self.map[
+			self.postings_offset + 8 * self.posting_starts[word_id]:
+			self.postings_offset + 8 * self.posting_starts[word_id + 1]])
+		return postings
+
+	def get_words(self, text_index):
+		"""Gets the words of a text, as the text's split() would"""
+		word_ids = array.array('i')
+		start = self.forward_offset + 4 * self.text_starts[text_index]
+		word_ids.fromstring(
+			self.map[start:start + 4 * self.wordcounts[text_index]])
+		words = self.words
+		return [words[word_id] for word_id in word_ids]
+
+	def find_hits(self, matcher, max_words):
+		"""Finds the hits of matcher's phrases in every text, the way
+		PhraseMatcher.collect_span_hits() does with tokens of up to
+		max_words words
+
+		output = {text index: (neg_hits, pos_hits)} for the texts with
+		hits, each {phrase id: [(token_pos, token_end)]}
+		"""
+		hits = collections.defaultdict(lambda: (
+			collections.defaultdict(list), collections.defaultdict(list)))
+		mapped = self.map
+		unpack_from = self._word_id.unpack_from
+		cue_ids = frozenset(self.vocabulary[cue]
+			for cue in NEGATION_CUES if cue in self.vocabulary)
+		# words ending a negation gap, as in collect_span_hits()
+		bad_gap_ids = frozenset(word_id
+			for word_id, word in enumerate(self.words)
+			if word not in matcher.vocabulary and not _GAP_WORD.match(word))
+		regex_ids = frozenset(
+			regex_phrase[0] for regex_phrase in matcher.regex_phrases)
+
+		for phrase_id, (phrase, _, _) in enumerate(matcher.phrases):
+			if phrase_id in regex_ids:
+				continue
+			phrase_ids = [self.vocabulary.get(word) for word in phrase.split(' ')]
+			length = len(phrase_ids)
+			if None in phrase_ids or length > max_words:
+				continue
+			rarest = min(xrange(length), key=lambda i: (
+				self.posting_starts[phrase_ids[i] + 1] -
+				self.posting_starts[phrase_ids[i]]))
+			others = [(i, phrase_ids[i]) for i in xrange(length) if i != rarest]
+			postings = self.get_postings(phrase_ids[rarest])
+			neg_spans = [] # [(text index, cue position, token end)]
+			for i in xrange(0, len(postings), 2):
+				text_index = postings[i]
+				start = postings[i + 1] - rarest
+				end = start + length
+				if start < 0 or end > self.wordcounts[text_index]:
+					continue
+				base = self.forward_offset + 4 * self.text_starts[text_index]
+				if any(unpack_from(mapped, base + 4 * (start + j))[0] != word_id
+					for j, word_id in others):
+					continue
+				hits[text_index][1][phrase_id].append((start, end))
+
+				for gap in xrange(NEGATION_GAP + 1):
+					cue_pos = start - 1 - gap
+					if cue_pos < 0 or end - cue_pos > max_words:
+						break
+					if gap and unpack_from(
+						mapped, base + 4 * (start - gap))[0] in bad_gap_ids:
+						break
+					if unpack_from(mapped, base + 4 * cue_pos)[0] in cue_ids:
+						neg_spans.append((text_index, cue_pos, end))
+			# collect_span_hits() finds negated hits in cue position order
+			for text_index, cue_pos, end in sorted(neg_spans):
+				hits[text_index][0][phrase_id].append((cue_pos, end))
+
+		if matcher.regex_phrases:
+			candidates = collections.defaultdict(set) # {text index: phrases}
+			for length, by_prefix in matcher.regex_prefixes.iteritems():
+				for word_id, word in enumerate(self.words):
+					regex_phrases = by_prefix.get(word[:length])
+					if regex_phrases:
+						for text_index in set(self.get_postings(word_id)[::2]):
+							candidates[text_index].update(regex_phrases)
+			if matcher.unindexed_regex_phrases:
+				for text_index in xrange(len(self.text_ids)):
+					candidates[text_index].update(
+						matcher.unindexed_regex_phrases)
+			for text_index, regex_phrases in candidates.iteritems():
+				neg_hits, pos_hits = hits[text_index]
+				matcher.collect_regex_spans(self.get_words(text_index),
+					max_words, neg_hits, pos_hits, sorted(regex_phrases))
+		return hits
+
+	def run_library(self, library, matcher, simple=True, end_weight=1.5,
+		            end_threshold=0.75, keep_tally=False):
+		"""Runs library on every text of the index, yielding each text's
+		RunOutput in index order, with the rows (and tally if
+		keep_tally=True) run_library() gives. This is a generator."""
+		hits = self.find_hits(matcher, matcher.max_words + 2)
+		for text_index, text_id in enumerate(self.text_ids):
+			if text_index in hits:
+				hit_table = matcher.make_span_table(
+					self.get_words(text_index), *hits.pop(text_index))
+			else:
+				hit_table = HitTable([])
+			run_instance = LibraryRun.from_hit_table(text_id,
+				self.wordcounts[text_index], hit_table, library, matcher,
+				end_weight, end_threshold)
+			yield get_run_output(run_instance, simple, keep_tally=keep_tally)
+
+def save_checkpoint(checkpoint_filepath, offset, aggregates=None,
+	                output_size=None, hit_store_size=None):
+	"""Saves byte offset to resume a run from, the sizes of the output
+	file and hit store up to the texts before it and the CorpusAggregates
+	of those texts if given, replacing the checkpoint file in one step so
+	a crash never leaves it half-written
+
+	file layout = a line of the offset and the sizes (-1 for a size not
+	given), then the aggregates' summary as JSON if there are any
+	"""
+	sizes = [-1 if size is None else size
+		for size in (output_size, hit_store_size)]
+	tmp_filepath = checkpoint_filepath + '.tmp%d' % os.getpid()
+	with open(tmp_filepath, "w") as checkpoint_file:
+		checkpoint_file.write('%d %d %d\n' % tuple([offset] + sizes))
+		if aggregates is not None:
+			json.dump(aggregates.get_summary(), checkpoint_file)
+	os.rename(tmp_filepath, checkpoint_filepath)
+
+def read_checkpoint(checkpoint_filepath):
+	"""Reads byte offset saved by save_checkpoint()"""
+	with open(checkpoint_filepath, "r") as checkpoint_file:
+		return int(checkpoint_file.readline().split()[0])
+
+def read_checkpoint_sizes(checkpoint_filepath):
+	"""Reads the output file and hit store sizes saved by
+	save_checkpoint(), outputs (output size, hit store size), each None
+	if it wasn't saved"""
+	with open(checkpoint_filepath, "r") as checkpoint_file:
+		fields = [int(field) for field in checkpoint_file.readline().split()]
+	return tuple(None if size < 0 else size
+		for size in (fields[1:] + [-1, -1])[:2])
+
+def read_checkpoint_aggregates(checkpoint_filepath):
+	"""Reads the CorpusAggregates saved by save_checkpoint(), None if
+	there aren't any"""
+	with open(checkpoint_filepath, "r") as checkpoint_file:
+		checkpoint_file.readline()
+		summary = checkpoint_file.read()
+	return CorpusAggregates.from_summary(json.loads(summary)) if summary else None
+
+# library and matcher for pool workers, set once per process by
+# _init_worker so they aren't pickled again for every chunk of texts
+_worker_library = {}
+
+def _init_worker(library, matcher):
+	"""Stores library and matcher in a freshly started worker process"""
+	_worker_library['library'] = library
+	_worker_library['matcher'] = matcher
+
+def _run_library_chunk(texts, options):
+	"""Runs the worker's library on a chunk of cleaned texts, outputs
+	list of run_library() output for each text
+
+	options = dict of run_library() keyword arguments
+	"""
+	library = _worker_library['library']
+	matcher = _worker_library['matcher']
+	return [run_library(text, library, matcher, **options) for text in texts]
+
+
+def _find_segment_hits(words, offset, num_owned):
+	"""Runs find_segment_hits() with the worker's matcher"""
+	matcher = _worker_library['matcher']
+	return find_segment_hits(
+		matcher, words, offset, num_owned, matcher.max_words + 2)
+
+
+class _SegmentedText(object):
+	"""A long text matched in windows by the worker processes, standing
+	in for the AsyncResult of a chunk of texts in run_parallel()"""
+	def __init__(self, text_id, words, windows, library, matcher, options):
+		self.text_id = text_id
+		self.words = words
+		self.windows = windows # AsyncResult of each window, in order
+		self.library = library
+		self.matcher = matcher
+		self.options = options
+
+	def get(self):
+		"""Merges the windows' hits and scores them over the whole text.
+		Outputs a list of the text's RunOutput, without a profile"""
+		hit_table = self.matcher.make_span_table(self.words,
+			*merge_segment_hits(self.matcher,
+				[window.get() for window in self.windows]))
+		run_instance = LibraryRun.from_hit_table(self.text_id,
+			len(self.words), hit_table, self.library, self.matcher)
+		return [get_run_output(run_instance, self.options['simple'],
+			keep_hits=self.options['keep_hits'],
+			keep_tally=self.options['keep_tally'])]
+
 
 class SentimentFactory(object):
-	"""Factory class for creating instances of library runs"""
+	"""Factory class for creating instances of library runs
+
+	compiled_library_filepath = if given, the library is loaded from
+	this compiled library file, which is rebuilt whenever the library
+	file changes (see load_library())
+	workers = number of processes to run the library with; 1 runs
+	everything in this process
+	chunk_size = number of texts sent to a worker at a time
+	max_pending = max number of chunks in flight at once, defaults to
+	twice the number of workers
+	simple = write simple results (one line per text) if True, verbose
+	results (one line per phrase hit) if False
+	output_format = None to append a header and results for each text
+	to the output file, or an open_results_sink() format ('tsv',
+	'binary', 'arrow', 'parquet', 'columnar') to write one header or
+	schema per file and batch_size rows at a time
+	stats = RunStats to collect per-stage timings and counts in; runs
+	aren't profiled if not given
+	hit_store_filepath = if given, the hits found in each text are
+	kept in this file, for rescore() to update the results after the
+	library is edited
+	normalizer = TextNormalizer to clean rows with, chunk_size rows at
+	a time; rows go through clean_row() one by one if not given
+	byte_range = (start, end) byte offsets of the part of the text file
+	to run, e.g. one of MappedTextFile.get_byte_ranges(); the whole
+	file if not given
+	checkpoint_filepath = if given, the byte offset after the last text
+	written is saved to this file every checkpoint_every texts, and a
+	run finding the file resumes from that offset, appending to the
+	output file and hit store once they're cut back to their sizes at
+	the checkpoint, so rows written after it by a failed run aren't
+	written twice
+	result_cache = ResultCache to reuse the results of texts that are
+	the same after cleaning; hits and misses are counted in stats too
+	summary_only = run LibraryRun in summary-only mode, keeping running
+	sums instead of each hit; needs simple results and no hit store
+	pipeline_queue_size = if given, run_suite() runs as a StagedPipeline
+	with queues this long: reading, cleaning in clean_threads threads
+	and matching in match_threads threads (defaulting to workers, each
+	handing chunks to the worker processes if there are several) run
+	alongside formatting and writing, which stay in this thread. The
+	pipeline is kept in self.pipeline, and its summary in stats
+	aggregates_filepath = if given, CorpusAggregates of the texts
+	written are kept in self.aggregates and saved to this file as JSON
+	at the end of the run. They're saved with each checkpoint too, so
+	a resumed run's aggregates still cover the whole output
+	sort_key = if given, the output is written in the order of this
+	column name (or list of column names) over the whole run, with one
+	header, instead of text by text; rows are sorted with an
+	ExternalSorter, keeping rows taking about sort_memory bytes of
+	memory (as estimated with sys.getsizeof()) and the rest in run
+	files in sort_directory (the system's temporary directory if not
+	given). Sorted output can't be checkpointed
+	segment_words = if given, texts of more than this many words are
+	split into windows of segment_words words, overlapping by the
+	longest phrase plus the negation allowance, which the worker
+	processes match alongside other texts. The windows' hits are merged
+	at whole-text positions and scored over the whole text, giving the
+	same results. Only used when workers > 1 and not pipelined; long
+	texts get no profile record in stats
+
+	The text file and the output file can be compressed with gzip, bz2,
+	xz or zstd (see get_compression()), and are then decompressed and
+	compressed in background threads as the run goes.
+
+	library_filepath can also be a dict {library name: library file},
+	to score each text against all of the libraries in one pass with a
+	LibrarySet. Each text then gets a group of rows for each library,
+	in name order, with the library name after the text id (see
+	get_library_set_columns()). Such runs can't keep a hit store or
+	aggregates, use a compiled library file, be summary_only or use
+	segment_words.
+
+	For running libraries over the same texts again and again,
+	build_index() saves a CorpusIndex of them once, and run_index()
+	then writes run_suite()'s output from the index.
+	"""
 	def __init__(self, text_filepath, library_filepath, output_directory="", 
-		        output_filename="sentiment_summary.txt"):
+		        output_filename="sentiment_summary.txt", workers=1,
+		        chunk_size=500, max_pending=None,
+		        compiled_library_filepath=None, simple=True,
+		        output_format=None, batch_size=10000, stats=None,
+		        hit_store_filepath=None, normalizer=None, byte_range=None,
+		        checkpoint_filepath=None, checkpoint_every=10000,
+		        result_cache=None, summary_only=False,
+		        pipeline_queue_size=None, clean_threads=1,
+		        match_threads=None, segment_words=None,
+		        aggregates_filepath=None, sort_key=None,
+		        sort_memory=1 << 26, sort_directory=None):
+		if summary_only and (not simple or hit_store_filepath is not None):
+			raise SentimentException(
+				"summary_only runs only make simple results, without hits")
+		if pipeline_queue_size is not None and result_cache is not None:
+			raise SentimentException(
+				"result_cache can't be used in a pipelined run")
+		if sort_key is not None and checkpoint_filepath is not None:
+			raise SentimentException("sorted output can't be checkpointed")
+		if isinstance(library_filepath, dict) and (summary_only or
+			hit_store_filepath is not None or
+			compiled_library_filepath is not None or
+			segment_words is not None or aggregates_filepath is not None):
+			raise SentimentException("runs with several libraries can't "
+				"be summary_only, segmented, keep aggregates or use a hit "
+				"store or compiled library")
 		self.text_filepath = text_filepath
 		self.library_filepath = library_filepath
+		self.compiled_library_filepath = compiled_library_filepath
 		self.output_directory = output_directory
 		self.output_filename = output_filename
+		self.workers = workers
+		self.chunk_size = chunk_size
+		if max_pending is None:
+			max_pending = 2 * workers
+		self.max_pending = max_pending
+		self.simple = simple
+		self.output_format = output_format
+		self.batch_size = batch_size
+		self.stats = stats
+		self.hit_store_filepath = hit_store_filepath
+		self.normalizer = normalizer
+		self.byte_range = byte_range
+		self.checkpoint_filepath = checkpoint_filepath
+		self.checkpoint_every = checkpoint_every
+		self.result_cache = result_cache
+		self.summary_only = summary_only
+		self.pipeline_queue_size = pipeline_queue_size
+		self.clean_threads = clean_threads
+		if match_threads is None:
+			match_threads = workers
+		self.match_threads = match_threads
+		self.segment_words = segment_words
+		self.aggregates_filepath = aggregates_filepath
+		self.aggregates = None # CorpusAggregates of the last run
+		if isinstance(sort_key, basestring):
+			sort_key = [sort_key]
+		self.sort_key = sort_key
+		self.sort_memory = sort_memory
+		self.sort_directory = sort_directory
+		self.pipeline = None
+		self.offset = None # byte offset after the last text written
 
 	def run_suite(self):
 		"""Starts library runs for each essay
 
 		Loads library files and texts, then iteratively appends to output file
 		a line containing results of running library on each text. Texts are 
-		streamed into Python and written to the output file one at a time
+		streamed into Python and written to the output file one at a time,
+		in input order even when they're run by several workers
 
 		"""
-		library = get_library_from_file(self.library_filepath)
-		negation_library = create_negation_lib(library)
-		with open(self.output_directory+self.output_filename, "a") as out:
-			with open(text_filepath, "r") as full_text:
-				texts = self.stream_lines(full_text)
-				for text in texts:
-					run_instance = LibraryRun(text, library, negation_library)
-					run_instance.do_run()
-					results = run_instance.get_results()
-					for line in results:
+		library, matcher = self.load_library()
+		start, end = self.byte_range or (0, None)
+		aggregates = None
+		hit_store_size = None
+		if (self.checkpoint_filepath is not None and
+			os.path.exists(self.checkpoint_filepath)):
+			output_filepath = self.output_directory + self.output_filename
+			if self.output_format is not None or get_compression(
+				output_filepath, detect=False):
+				raise SentimentException(
+					"only appended uncompressed output can be resumed")
+			start = read_checkpoint(self.checkpoint_filepath)
+			output_size, hit_store_size = read_checkpoint_sizes(
+				self.checkpoint_filepath)
+			if (self.hit_store_filepath is not None) != (
+				hit_store_size is not None):
+				raise SentimentException(
+					"checkpoint was saved with a different hit store setting")
+			# drop what was written after the checkpoint before it failed
+			if output_size is not None and os.path.exists(output_filepath):
+				with open(output_filepath, "r+b") as output_file:
+					output_file.truncate(output_size)
+			if self.aggregates_filepath is not None:
+				aggregates = read_checkpoint_aggregates(
+					self.checkpoint_filepath)
+				if aggregates is None:
+					raise SentimentException(
+						"checkpoint has no aggregates to resume with")
+
+		row_ends = collections.deque()
+		with open_text_file(self.text_filepath) as text_file:
+			full_text = text_file.iter_rows(start, end, row_ends)
+			if self.pipeline_queue_size is not None:
+				all_results = self.run_pipelined(full_text, library, matcher)
+			else:
+				if self.stats is not None:
+					texts = self.stream_lines_profiled(full_text)
+				else:
+					texts = self.stream_lines(full_text)
+				if self.result_cache is not None:
+					all_results = self.run_cached(texts, library, matcher)
+				else:
+					all_results = self.run_texts(texts, library, matcher)
+			self.offset = text_file.find_row_start(start)
+			try:
+				self.write_results(all_results, library, matcher, row_ends,
+					aggregates, hit_store_size)
+			finally:
+				all_results.close() # stop reading before the file closes
+
+	def rescore(self, old_hit_store_filepath):
+		"""Updates the results of an earlier run that kept a hit store,
+		after edits to the library
+
+		Hits of unchanged phrases are reused and phrases whose score
+		changed are rescored from the hit store. Only added phrases are
+		matched against the texts, which are only read if there are any.
+		If the longest phrase changed length, every phrase can match
+		differently and all of them are matched again. Results and the
+		new hit store are written as run_suite() would write them.
+
+		old_hit_store_filepath = hit store from the earlier run; must
+		not be the same file as hit_store_filepath
+		"""
+		if isinstance(self.library_filepath, dict):
+			raise SentimentException("rescore needs a single library")
+		library, matcher = self.load_library()
+		max_words = matcher.max_words + 2 # for word allowances from negation
+
+		with open(old_hit_store_filepath, "rb") as old_hit_store:
+			header, records = read_hit_store(old_hit_store)
+			added, _, removed = diff_libraries(header['library'], library)
+			if header['max_words'] != max_words:
+				added = set(library)
+
+			if not added:
+				self.write_results(self.rescore_hits(records,
+					header['library'], library, matcher, removed),
+					library, matcher)
+				return
+			start, end = self.byte_range or (0, None)
+			with open_text_file(self.text_filepath) as text_file:
+				self.write_results(self.rescore_hits(records,
+					header['library'], library, matcher, removed | added,
+					added, self.stream_lines(text_file.iter_rows(start, end))),
+					library, matcher)
+
+	def rescore_hits(self, records, old_library, library, matcher, dropped,
+		             added=(), texts=None):
+		"""Rescores hit store records with library, yielding RunOutput
+		for each text. This is a generator.
+
+		dropped = phrases of old_library whose hits are thrown away
+		added = phrases of library to match against texts, which must
+		be the cleaned texts the hit store was made from, in order
+		"""
+		options = self.get_run_options()
+		options['profile'] = False # there are no texts to profile
+		del options['summary_only'] # hits are already found
+		max_words = matcher.max_words + 2
+		added_matcher = None
+		if added:
+			added_matcher = PhraseMatcher(
+				dict((phrase, library[phrase]) for phrase in added))
+
+		old_phrases = dict((rule_num, phrase)
+			for phrase, (_, rule_num) in old_library.iteritems())
+		# hits are put back in the order a full run finds them in: by
+		# phrase in library order, then position and token length
+		rule_order = dict((rule_num, phrase_id)
+			for phrase_id, (_, _, rule_num) in enumerate(matcher.phrases))
+
+		for text_id, wordcount, old_hits in records:
+			hits = []
+			for token, token_pos, score, rule_num, negated in old_hits:
+				phrase = old_phrases[rule_num]
+				if phrase in dropped:
+					continue
+				score, rule_num = library[phrase]
+				if negated:
+					score = -score
+				hits.append((token, token_pos, score, rule_num, negated))
+
+			if added_matcher is not None:
+				text = next(texts)
+				if text[0] != text_id:
+					raise SentimentException(
+						"texts don't match hit store at text %s" % text_id)
+				hits.extend(added_matcher.find_hits(text[1].split(), max_words))
+
+			hits.sort(key=lambda hit: (rule_order[hit[3]], hit[1], len(hit[0])))
+			run_instance = LibraryRun.from_hits(
+				text_id, wordcount, hits, library, matcher)
+			yield get_run_output(run_instance, **options)
+
+	def run_texts(self, texts, library, matcher):
+		"""Runs library on cleaned texts, in worker processes if there
+		are several, yielding each text's RunOutput in input order"""
+		if self.workers > 1:
+			return self.run_parallel(texts, library, matcher)
+		options = self.get_run_options()
+		return (run_library(text, library, matcher, **options)
+			for text in texts)
+
+	def run_pipelined(self, rows, library, matcher):
+		"""Runs library on raw rows through a StagedPipeline of chunk_size
+		rows at a time, yielding each text's RunOutput in input order.
+		This is a generator."""
+		options = self.get_run_options()
+		pool = None
+		if self.workers > 1:
+			pool = multiprocessing.Pool(
+				self.workers, _init_worker, (library, matcher))
+			match_chunk = lambda texts: pool.apply(
+				_run_library_chunk, (texts, options))
+		else:
+			match_chunk = lambda texts: [
+				run_library(text, library, matcher, **options)
+				for text in texts]
+
+		self.pipeline = StagedPipeline(self.pipeline_queue_size)
+		self.pipeline.add_stage('clean', lambda chunk: list(
+			self.stream_lines(chunk)), self.clean_threads)
+		self.pipeline.add_stage('match', match_chunk, self.match_threads)
+		results = self.pipeline.run(iter_chunks(rows, self.chunk_size))
+		try:
+			for chunk_results in results:
+				for run_output in chunk_results:
+					yield run_output
+		finally:
+			results.close()
+			if pool is not None:
+				pool.terminate()
+				pool.join()
+			if self.stats is not None:
+				self.stats.pipeline = self.pipeline.get_summary()
+
+	def run_cached(self, texts, library, matcher):
+		"""Runs library on cleaned texts like run_texts(), reusing the
+		cached results of texts seen before. This is a generator.
+
+		Only cache misses are run; cached results are yielded in their
+		place in input order with the text id swapped in
+		"""
+		cache = self.result_cache
+		options = self.get_run_options()
+		fingerprint = get_library_fingerprint(library, options['simple'],
+			options['keep_hits'], options['keep_tally'])
+		# (text id, cache key, cached entry or None) of each text read
+		pending = collections.deque()
+
+		def get_misses():
+			for text in texts:
+				key = cache.get_key(fingerprint, text[1])
+				entry = cache.get(key)
+				pending.append((text[0], key, entry))
+				if self.stats is not None:
+					self.stats.counts['cache hits' if entry is not None
+						else 'cache misses'] += 1
+				if entry is None:
+					yield text
+
+		def cached_output(text_id, entry):
+			rows, hits, tally = entry
+			return RunOutput([[text_id] + row[1:] for row in rows], None,
+				(text_id, hits[0], hits[1]) if hits is not None else None,
+				tally)
+
+		for output in self.run_texts(get_misses(), library, matcher):
+			while pending[0][2] is not None:
+				text_id, _, entry = pending.popleft()
+				yield cached_output(text_id, entry)
+			_, key, _ = pending.popleft()
+			cache.put(key, (output.rows, output.hits[1:]
+				if output.hits is not None else None, output.tally))
+			yield output
+		while pending:
+			text_id, _, entry = pending.popleft()
+			yield cached_output(text_id, entry)
+
+	def get_run_options(self):
+		"""Gets run_library() keyword arguments for this factory"""
+		return {'simple': self.simple, 'profile': self.stats is not None,
+			'keep_hits': self.hit_store_filepath is not None,
+			'summary_only': self.summary_only,
+			'keep_tally': self.aggregates_filepath is not None}
+
+	def write_results(self, all_results, library, matcher, row_ends=None,
+		              aggregates=None, hit_store_size=None):
+		"""Writes each text's results from an iterable of RunOutput to
+		the output file, and their hits to the hit store if there is one
+
+		row_ends = deque of the byte offset after each text's row, for
+		tracking offset and saving checkpoints
+		aggregates = CorpusAggregates to add the texts' tallies to, if
+		there's an aggregates file; new ones if not given
+		hit_store_size = if given, the hit store is resumed: cut back to
+		this size and appended to
+		"""
+		if self.aggregates_filepath is not None and aggregates is None:
+			aggregates = CorpusAggregates()
+		self.aggregates = aggregates
+		columns = SIMPLE_COLUMNS if self.simple else VERBOSE_COLUMNS
+		if isinstance(matcher, LibrarySet):
+			columns = get_library_set_columns(columns)
+		output_filepath = self.output_directory+self.output_filename
+		profile = self.stats is not None
+
+		sorter = None
+		if self.sort_key is not None:
+			names = [name for name, _ in columns]
+			for name in self.sort_key:
+				if name not in names:
+					raise SentimentException("no output column %s" % name)
+			key_indexes = [names.index(name) for name in self.sort_key]
+			sorter = ExternalSorter(
+				lambda row: [row[index] for index in key_indexes],
+				self.sort_memory, self.sort_directory)
+
+		hit_store = None
+		if self.hit_store_filepath is not None and hit_store_size is not None:
+			hit_store = open(self.hit_store_filepath, "r+b")
+			hit_store.truncate(hit_store_size)
+			hit_store.seek(hit_store_size)
+		elif self.hit_store_filepath is not None:
+			hit_store = open(self.hit_store_filepath, "wb")
+			write_hit_store_header(
+				hit_store, library, matcher.max_words + 2)
+		if self.output_format is not None:
+			out = open_results_sink(output_filepath, self.output_format,
+				columns, self.batch_size)
+		else:
+			out = open_compressed(output_filepath, "a")
+			header = [[name for name, _ in columns]]
+
+		try:
+			for text_count, (results, record, hits, tally) in enumerate(
+				all_results, 1):
+				if profile:
+					start = time.time()
+				if sorter is not None:
+					sorter.add_rows(results)
+				elif self.output_format is not None:
+					out.write_rows(results)
+				else:
+					for line in format_lines_list(header + results):
 						self.append_to_output_file(line, out)
+				if hit_store is not None:
+					marshal.dump(hits, hit_store)
+				if aggregates is not None:
+					aggregates.add_tally(tally)
+				if profile:
+					self.stats.add_time('write', time.time() - start)
+					if record is not None:
+						self.stats.add_text(record)
+				if row_ends is not None:
+					self.offset = row_ends.popleft()
+					if (self.checkpoint_filepath is not None and
+						text_count % self.checkpoint_every == 0):
+						self.save_checkpoint(out, hit_store, aggregates)
+			if sorter is not None:
+				self.write_sorted(sorter, out, columns)
+			if row_ends is not None and self.checkpoint_filepath is not None:
+				self.save_checkpoint(out, hit_store, aggregates)
+			if aggregates is not None:
+				with open(self.aggregates_filepath, "w") as aggregates_file:
+					aggregates.dump(aggregates_file)
+		finally:
+			out.close()
+			if hit_store is not None:
+				hit_store.close()
+			if sorter is not None:
+				sorter.close()
+
+	def save_checkpoint(self, out, hit_store, aggregates):
+		"""Flushes the output file and hit store and saves a checkpoint
+		of offset, with their sizes so a resumed run can cut off what
+		was written after it"""
+		out.flush()
+		hit_store_size = None
+		if hit_store is not None:
+			hit_store.flush()
+			hit_store_size = hit_store.tell()
+		save_checkpoint(self.checkpoint_filepath, self.offset, aggregates,
+			os.path.getsize(self.output_directory + self.output_filename),
+			hit_store_size)
+
+	def write_sorted(self, sorter, out, columns):
+		"""Writes the rows of an ExternalSorter to the output file in
+		order, after a single header if there's no output_format"""
+		if self.stats is not None:
+			start = time.time()
+		if self.output_format is None:
+			self.append_to_output_file(
+				format_lines_list([[name for name, _ in columns]])[0], out)
+		for rows in iter_chunks(sorter.iter_sorted(), self.batch_size):
+			if self.output_format is not None:
+				out.write_rows(rows)
+			else:
+				for line in format_lines_list(rows):
+					self.append_to_output_file(line, out)
+		if self.stats is not None:
+			self.stats.add_time('sort', time.time() - start)
+
+	def build_index(self, index_filepath):
+		"""Builds a corpus index of the texts (in byte_range if given),
+		cleaned as run_suite() cleans them, for run_index(). Outputs the
+		number of texts indexed"""
+		start, end = self.byte_range or (0, None)
+		with open_text_file(self.text_filepath) as text_file:
+			return build_corpus_index(
+				self.stream_lines(text_file.iter_rows(start, end)),
+				index_filepath)
+
+	def run_index(self, index_filepath):
+		"""Runs the library on the texts of a corpus index made by
+		build_index() instead of the text file, writing the output
+		run_suite() would write for them. Index runs cover the whole
+		index, so they take no byte_range (give it to build_index()
+		instead) and aren't checkpointed"""
+		if (isinstance(self.library_filepath, dict) or
+			self.hit_store_filepath is not None or
+			self.checkpoint_filepath is not None or
+			self.byte_range is not None):
+			raise SentimentException("index runs need a single library and "
+				"no hit store, checkpoint or byte range")
+		library, matcher = self.load_library()
+		with CorpusIndex(index_filepath) as index:
+			all_results = index.run_library(library, matcher, self.simple,
+				keep_tally=self.aggregates_filepath is not None)
+			try:
+				self.write_results(all_results, library, matcher)
+			finally:
+				all_results.close()
+
+	def load_library(self):
+		"""Loads library and compiles its matcher, going through the
+		compiled library file if there is one. Outputs (library, matcher),
+		or ({library name: library}, LibrarySet) for several libraries"""
+		if isinstance(self.library_filepath, dict):
+			libraries = dict((name, get_library_from_file(library_filepath))
+				for name, library_filepath in self.library_filepath.iteritems())
+			return libraries, LibrarySet(libraries)
+		if self.compiled_library_filepath is not None:
+			return load_library(
+				self.library_filepath, self.compiled_library_filepath)
+		library = get_library_from_file(self.library_filepath)
+		return library, PhraseMatcher(library)
+
+	def run_parallel(self, texts, library, matcher):
+		"""Runs library on texts in a pool of worker processes, yielding
+		each text's run_library() output in input order. This is a
+		generator.
+
+		Texts are sent in chunks of chunk_size, and no more than max_pending
+		chunks are in flight, so reading the input waits on the workers
+		instead of piling texts up in memory
+		"""
+		pool = multiprocessing.Pool(
+			self.workers, _init_worker, (library, matcher))
+		pending = collections.deque()
+		try:
+			for job in self.submit_texts(pool, texts, library, matcher):
+				if len(pending) >= self.max_pending:
+					for results in pending.popleft().get():
+						yield results
+				pending.append(job)
+			while pending:
+				for results in pending.popleft().get():
+					yield results
+		finally:
+			pool.terminate()
+			pool.join()
+
+	def submit_texts(self, pool, texts, library, matcher):
+		"""Hands texts to the worker pool chunk_size at a time, yielding
+		the AsyncResult of each chunk, and a _SegmentedText for each text
+		longer than segment_words, whose windows are handed out on their
+		own. This is a generator."""
+		options = self.get_run_options()
+		if self.segment_words is None:
+			for chunk in iter_chunks(texts, self.chunk_size):
+				yield pool.apply_async(_run_library_chunk, (chunk, options))
+			return
+
+		chunk = []
+		for text in texts:
+			if text[1].count(' ') >= self.segment_words:
+				words = text[1].split()
+				if len(words) > self.segment_words:
+					if chunk:
+						yield pool.apply_async(
+							_run_library_chunk, (chunk, options))
+						chunk = []
+					windows = [pool.apply_async(_find_segment_hits,
+						(words[start:end], start, own_end - start))
+						for start, own_end, end in split_segments(len(words),
+							self.segment_words, matcher.max_words + 2)]
+					yield _SegmentedText(
+						text[0], words, windows, library, matcher, options)
+					continue
+			chunk.append(text)
+			if len(chunk) == self.chunk_size:
+				yield pool.apply_async(_run_library_chunk, (chunk, options))
+				chunk = []
+		if chunk:
+			yield pool.apply_async(_run_library_chunk, (chunk, options))
+
+	def clean_lines(self, lines):
+		"""Cleans a list of lines with the normalizer, or clean_row()
+		if there is none"""
+		if self.normalizer is None:
+			return [clean_row(line) for line in lines]
+		return self.normalizer.clean_rows(lines)
 
 	def stream_lines(self, full_text):
 		"""Stream lines from text file. This is a generator."""
-		for line in full_text:
-			yield clean_row(line)
+		if self.normalizer is None:
+			for line in full_text:
+				yield clean_row(line)
+			return
+		for lines in iter_chunks(full_text, self.chunk_size):
+			for text in self.normalizer.clean_rows(lines):
+				yield text
+
+	def stream_lines_profiled(self, full_text):
+		"""Stream lines from text file like stream_lines(), timing
+		clean_lines() of each chunk into stats. This is a generator."""
+		for lines in iter_chunks(full_text, self.chunk_size):
+			start = time.time()
+			texts = self.clean_lines(lines)
+			self.stats.add_time('clean', time.time() - start)
+			for text in texts:
+				yield text
 
 	def append_to_output_file(self, line, output_file):
 		"""Appends single line to an output file"""
@@ -154,69 +3451,78 @@ class LibraryRun(object):
 
 	text = (text_id, [single words in order of text])
 	library = {library phrase: (phrase score, rule number)
+	matcher = PhraseMatcher compiled from library; built here if not
+	given, pass one in to share it between runs of the same library
+
+	profile = if True, wall time of each stage (preprocess, match,
+	score, format) is recorded in timings
+	summary_only = if True, do_run() only keeps hit counts and score
+	sums for the simple results, no per-hit data; verbose results and
+	hits can't be had from the run
 
 	initializes with do_preprocessing()}
 	"""
-	def __init__(self, text, library, end_weight=1.5, end_threshold=0.75):
+	def __init__(self, text, library, end_weight=1.5, end_threshold=0.75,
+		        matcher=None, profile=False, summary_only=False):
 		self.text = text
+		self.summary_only = summary_only
 		self.library = library
-		self.word_freq, self.tokens_generator = self.do_preprocessing()
+		if matcher is None:
+			matcher = PhraseMatcher(library)
+		self.matcher = matcher
+		self.timings = {} if profile else None # {stage: seconds}
+		self.hits = None # [(token, token_pos, score, rule_num, negated)]
+		self.hit_table = None # HitTable, set by do_run()
+		self.rule_tallies = None # set by do_summary_run()
+
+		if self.timings is not None:
+			start = time.time()
+		self.word_pos = self.do_preprocessing()
+		if self.timings is not None:
+			self.timings['preprocess'] = time.time() - start
 		self.end_weight = end_weight
 		self.end_threshold = end_threshold
 
+	_word_freq = None
+
 	def do_preprocessing(self):
 		"""Preprocesses text to create needed data: text id, word count,
-		and tokens generator for returning results"""
+		word positions and the words encoded as library word ids for
+		matching. Tokens aren't built up front; do_run() walks the word
+		ids and only spans up to max_words long are considered"""
 		self.text_id = self.text[0]
 
 		# get word position of each word in text
 		word_pos = self.text[1].split() # [word1, word2,...]
 		self.wordcount = len(word_pos) # total word count
+		self.word_ids = self.matcher.encode(word_pos)
 
-		word_freq = get_word_freq(self.text[1]) # {word: count}
+		self.max_words = (
+		self.matcher.max_words + 2) # for word allowances from negation
 
-		library_phrases = [line[0] for line in self.library]
-		max_words = (
-		find_max_wordlength(library_phrases) + 2) # for word allowances from negation
+		return word_pos
 
-		tokens_generator = list(
-		tokenize(word_pos, max_words=max_words)) # [(token, token_pos)]
-		
-		return word_freq, tokens_generator
+	@property
+	def word_freq(self):
+		"""Word frequencies of the text, {word: count}, only counted
+		when they're asked for"""
+		if self._word_freq is None:
+			self._word_freq = get_word_freq(self.text[1])
+		return self._word_freq
 
-	def find_phrase_matches(self, tokens_generator):
+	def find_phrase_matches(self, tokens_generator=None):
 		"""Finds phrase matches between negation library and text, and 
 		normal library and text, and returns matches
 
-		tokens_generator = generator listing (token, token_pos) for text
+		tokens_generator = generator listing (token, token_pos) for text;
+		if not given, the text's word positions are scanned directly
 
 		output = dict of phrase to list of tuples for each phrase hit 
 		(token position, phrase score, rule number) """
-		# lib = {phrase: (score, rule_num)}
-
-		hitcount_pos = 0
-		hitcount_neg = 0
-
-		matches = collections.defaultdict(list)
-		for phrase, (score, rule_num) in self.library.iteritems():
-			found_neg_phrase = False
-			for token, token_pos in tokens_generator:
-				neg_phrase_search = re.search(
-					'^(' + get_opposite_meaning(phrase) + ')$', token)
-				if neg_phrase_search is not None:
-					found_neg_phrase = True
-					matches[token].append(
-						[token_pos, -score, rule_num])
-					hitcount_neg += 1
-			if found_neg_phrase == False:
-				for token, token_pos in tokens_generator:
-					phrase_search = re.search('^(' + phrase + ')$', token)
-					if phrase_search is not None:
-						matches[token].append(
-							[token_pos, score, rule_num])
-						hitcount_pos += 1
-
-		return matches, hitcount_pos, hitcount_neg
+		if tokens_generator is None:
+			self.hits = self.matcher.find_hits(self.word_pos, self.max_words)
+			return self.matcher.get_matches(self.hits)
+		return self.matcher.find_matches(tokens_generator)
 
 	def score_text(self, matches, end_weight=1.5, end_threshold=0.75):
 		"""Scores text by averaging phrase-match scores. Optionally, 
@@ -228,58 +3534,170 @@ class LibraryRun(object):
 
 	    output = score for entire text
 		"""
-		# create matches dict where we will
-		# add weighted scores instead of unweighted scores
-		matches_weighted = matches.copy()
-
-		# weight phrases at end of text, put all scores into all_scores
-		# to easily sum over for score of whole text, and
-		# add weighted score to matches_weighted
-		all_scores = []
-		for token in matches_weighted:
-			for hit in matches_weighted[token]:
-				if float(hit[0]) / float(self.wordcount) >= end_threshold:
-					all_scores.append(hit[1] * end_weight)
-					hit[1] = hit[1] * end_weight
-				else:
-					all_scores.append(hit[1])
-
-		# calc score for whole text, using weighted scores
-		text_score = sum(all_scores) / len(all_scores)
+		# weight phrases at end of text into new hit lists, leaving
+		# matches unweighted, and sum over weighted scores for score of
+		# whole text
+		matches_weighted = {}
+		all_scores = 0
+		num_hits = 0
+		for token, hits in matches.iteritems():
+			weighted_hits = matches_weighted[token] = []
+			for token_pos, score, rule_num in hits:
+				if float(token_pos) / float(self.wordcount) >= end_threshold:
+					score = score * end_weight
+				weighted_hits.append([token_pos, score, rule_num])
+				all_scores += score
+				num_hits += 1
+
+		# calc score for whole text, using weighted scores; a text
+		# without hits scores 0
+		if num_hits:
+			text_score = all_scores / num_hits
+		else:
+			text_score = 0
 
 		return text_score, matches_weighted
 
 	def do_run(self):
-		"""Runs find_phrase_matches() and text_score() to create data
+		"""Finds the text's phrase hits and scores them to create data
 		that will be used by get_results() in creating results output
 
-		Creates: matches_unweighted, which is data for each phrase hit
-		using unweighted scores; matches_weighted, which is data for 
-		each phrase hit using weighted scores; test_score, which is the
-		text's overall score
+		Creates: hit_table, a HitTable with the unweighted and weighted
+		score of each phrase hit; hitcount; text_score, which is the
+		text's overall score. Token strings are only built from the
+		hit spans when verbose results or hits are asked for
 		"""
-		self.matches_unweighted, hitcount_pos, hitcount_neg = (
-		self.find_phrase_matches(self.tokens_generator))
+		if self.summary_only:
+			self.do_summary_run()
+			return
+
+		if self.timings is not None:
+			start = time.time()
+		self.hit_table = self.matcher.find_span_hits(
+			self.word_ids, self.word_pos, self.max_words)
+		if self.timings is not None:
+			matched = time.time()
+			self.timings['match'] = matched - start
+
+		self.set_hitcount()
+		self.text_score = self.hit_table.weight(
+			self.wordcount, self.end_weight, self.end_threshold)
+		if self.timings is not None:
+			self.timings['score'] = time.time() - matched
+
+	def do_summary_run(self):
+		"""do_run() for summary_only runs: hits are counted per phrase
+		as they're found, and only hitcount and text_score are created"""
+		if self.timings is not None:
+			start = time.time()
+		self.rule_tallies = {}
+		hitcount_pos, hitcount_neg, plain_sum, end_sum, end_hits = (
+			self.matcher.sum_span_hits(self.word_ids, self.word_pos,
+				self.max_words, self.end_threshold, self.rule_tallies))
+		if self.timings is not None:
+			matched = time.time()
+			self.timings['match'] = matched - start
 
 		self.hitcount = {'pos': hitcount_pos, 'neg': hitcount_neg, 
 		'total': hitcount_pos + hitcount_neg}
+		self.text_score = average_score(plain_sum, end_sum, end_hits,
+			self.hitcount['total'], self.end_weight)
+		if self.timings is not None:
+			self.timings['score'] = time.time() - matched
+
+	def get_tally(self):
+		"""Gets the run's tally for CorpusAggregates.add_tally(): (text
+		score, wordcount, positive hits, negative hits, {rule number:
+		[hit count, sum of unweighted scores]})"""
+		rule_tallies = self.rule_tallies
+		if rule_tallies is None:
+			rule_tallies = {}
+			for rule_num, score in itertools.izip(
+				self.hit_table.rule_num, self.hit_table.score):
+				tally = rule_tallies.setdefault(rule_num, [0, 0])
+				tally[0] += 1
+				tally[1] += score
+		return (self.text_score, self.wordcount, self.hitcount['pos'],
+			self.hitcount['neg'], rule_tallies)
+
+	def set_hitcount(self):
+		"""Counts positive and negative hits in hit_table"""
+		hitcount_neg = self.hit_table.count_negated()
+		hitcount_pos = len(self.hit_table) - hitcount_neg
+		self.hitcount = {'pos': hitcount_pos, 'neg': hitcount_neg, 
+		'total': hitcount_pos + hitcount_neg}
 
-		self.text_score, self.matches_weighted = self.score_text(self.matches_unweighted, 
-			self.end_weight, self.end_threshold)		 
+	@property
+	def matches_unweighted(self):
+		"""{token: [[token pos, phrase score, rule num]]} of the hits,
+		built from hit_table"""
+		if self.hit_table is not None:
+			return self.hit_table.get_matches()
+
+	@property
+	def matches_weighted(self):
+		"""Same as matches_unweighted, with weighted scores"""
+		if self.hit_table is not None:
+			return self.hit_table.get_matches(weighted=True)
+
+	def get_hits(self):
+		"""Gets the run's hits as (token, token_pos, score, rule_num,
+		negated), building them from hit_table after do_run()"""
+		if self.summary_only:
+			raise SentimentException("summary_only runs don't keep hits")
+		if self.hits is None and self.hit_table is not None:
+			self.hits = self.hit_table.get_hits()
+		return self.hits
+
+	@classmethod
+	def from_hits(cls, text_id, wordcount, hits, library, matcher,
+		          end_weight=1.5, end_threshold=0.75):
+		"""Creates a run that's done as if do_run() had found hits in a
+		text of wordcount words, for getting results without the text
+
+		hits = list of (token, token_pos, score, rule_num, negated) in
+		the order PhraseMatcher.find_hits() gives them
+		"""
+		run_instance = cls.from_hit_table(text_id, wordcount,
+			HitTable.from_hits(hits), library, matcher, end_weight,
+			end_threshold)
+		run_instance.hits = hits
+		return run_instance
+
+	@classmethod
+	def from_hit_table(cls, text_id, wordcount, hit_table, library, matcher,
+		               end_weight=1.5, end_threshold=0.75):
+		"""Creates a run that's done as if do_run() had found the hits
+		of hit_table in a text of wordcount words"""
+		run_instance = cls.__new__(cls)
+		run_instance.text = (text_id, None)
+		run_instance.text_id = text_id
+		run_instance.library = library
+		run_instance.matcher = matcher
+		run_instance.timings = None
+		run_instance.summary_only = False
+		run_instance.wordcount = wordcount
+		run_instance.end_weight = end_weight
+		run_instance.end_threshold = end_threshold
+		run_instance.hits = None
+
+		run_instance.hit_table = hit_table
+		run_instance.set_hitcount()
+		run_instance.text_score = run_instance.hit_table.weight(
+			wordcount, end_weight, end_threshold)
+		return run_instance
 
 	def make_results_verbose(self):
 		"""Creates results output from data gotten from running
 		library on the text
 
-		Each item in results list = data for one line
+		Each item in results list = data for one line, one line for
+		each phrase hit
 		"""
-		# add each phrase hit's data to a separate element of results list
-		results = []
-		for token in self.matches_weighted:
-			for hit in self.matches_weighted[token]:
-				results.append([self.text_id, token, hit[0], hit[1], hit[2]])
-
-		self.results_verbose = sorted(results)
+		if self.summary_only:
+			raise SentimentException(
+				"summary_only runs only make simple results")
+		self.results_verbose = self.hit_table.get_verbose_rows(self.text_id)
 
 	def make_results_simple(self):
 		"""Creates simple summary results for whole text"""
@@ -290,6 +3708,30 @@ class LibraryRun(object):
 
 		self.results_simple = results
 
+	def get_result_rows(self, simple=True):
+		"""Gets results from LibraryRun as a list of rows, one list of
+		values per output line, in SIMPLE_COLUMNS order if simple=True
+		and in VERBOSE_COLUMNS order otherwise"""
+		if self.timings is not None:
+			start = time.time()
+		if simple is True:
+			self.make_results_simple()
+			_, results = split_results_simple(self.results_simple)
+		else:
+			self.make_results_verbose()
+			results = self.results_verbose
+		if self.timings is not None:
+			self.timings['format'] = time.time() - start
+		return results
+
+	def get_profile(self):
+		"""Gets profile record for the run, for RunStats.add_text(): text
+		id, stage timings, word count, candidate spans and hit count"""
+		return {'text id': self.text_id, 'seconds': self.timings,
+			'words': self.wordcount, 'hits': self.hitcount['total'],
+			'candidates': self.matcher.count_candidates(
+				self.word_pos, self.max_words)}
+
 	def get_results(self, simple=True):
 		"""Gets results from LibraryRun for writing to file.
 		If simple=True, then just returns a single line 
@@ -307,18 +3749,7 @@ class LibraryRun(object):
 		if simple is True:
 			self.make_results_simple()
 
-			# get simple results into list of lists format, where
-			# each embedded list represents one line of output - this
-			# is so format_results() can format correctly
-			results = []
-			header = []
-
-			sorted_results = sorted(list(self.results_simple.iteritems()))
-			for item in sorted_results:
-				results.append(item[1])
-				header.append(item[0])
-			results = [results]
-			header = [header]
+			header, results = split_results_simple(self.results_simple)
 		else:
 			self.make_results_verbose()
 			results = self.results_verbose
@@ -5,6 +5,14 @@ import sentiment
 import mock
 import StringIO
 import __builtin__
+import os
+import shutil
+import tempfile
+import json
+import collections
+import socket
+import threading
+import service
 
 def fake_open_library(*args):
 	"""Fakes opening library file"""
@@ -32,7 +40,9 @@ class TestCleanRowFunction(unittest.TestCase):
 		self.assertEqual(obj_ut[1], "an apple is it yellowgreen or redorange")
 
 	def test_clean_row_control_chars(self):
-		pass
+		"""Tests clean_row turns newlines, tabs and returns into spaces"""
+		obj_ut = sentiment.clean_row('100\tan\rapple\x0bpie\n')
+		self.assertEqual(obj_ut[1], "an apple\x0bpie ")
 
 	# def test_clean_row_digits(self):
 	# 	"""Tests clean_row removes digits"""
@@ -40,6 +50,62 @@ class TestCleanRowFunction(unittest.TestCase):
 	# 		'100\t1 apple three apple 123 apples')
 	# 	self.assertEqual(obj_ut[1], ' apple three apple  apples')
 
+def regex_clean_text(text):
+	"""Reference implementation of text cleaning, as clean_row used to
+	do it"""
+	text = text.lower()
+	text = sentiment.re.sub(r'[^\w\s]', '', text)
+	if isinstance(text, unicode):
+		return text.translate(dict((ord(c), u' ') for c in u'\n\t\r'))
+	return text.translate(sentiment.string.maketrans('\n\t\r', '   '))
+
+class TestTextNormalizer(unittest.TestCase):
+	"""Tests for the TextNormalizer class"""
+	def setUp(self):
+		"""Define commonly used test things"""
+		self.texts = [''.join(chr(code) for code in range(256)),
+			'Caf\xc3\xa9 "Good"; not BAD!\r\n', u'Caf\xe9 \u212a \u0130 ok\t.',
+			'100 apples\x0b\x0cand_more']
+
+	def test_normalize_same_as_regex(self):
+		"""Tests the default normalizer cleans texts like the regexes did"""
+		normalizer = sentiment.TextNormalizer()
+		for text in self.texts:
+			self.assertEqual(normalizer.normalize(text), regex_clean_text(text))
+
+	def test_normalize_digits(self):
+		"""Tests digits can be removed"""
+		normalizer = sentiment.TextNormalizer(keep_digits=False)
+		self.assertEqual(normalizer.normalize('1 apple three apple 123 apples'),
+			' apple three apple  apples')
+
+	def test_normalize_control_chars(self):
+		"""Tests control char policies"""
+		text = 'a\tb\nc'
+		self.assertEqual(sentiment.TextNormalizer(
+			control_chars='delete').normalize(text), 'abc')
+		self.assertEqual(sentiment.TextNormalizer(
+			control_chars='keep').normalize(text), text)
+		self.assertRaises(sentiment.SentimentException,
+			sentiment.TextNormalizer, control_chars='tab')
+
+	def test_normalize_unicode_aware(self):
+		"""Tests letters of any script are kept when unicode aware"""
+		normalizer = sentiment.TextNormalizer(unicode_aware=True)
+		self.assertEqual(normalizer.normalize(u'Caf\xc9, \u0395\u03a5!'),
+			u'caf\xe9 \u03b5\u03c5')
+
+	def test_clean_rows(self):
+		"""Tests batch cleaning gives the same rows as clean_row"""
+		normalizer = sentiment.TextNormalizer()
+		rows = ['%d\t%s' % (i, text) for i, text in enumerate(self.texts)
+			if not isinstance(text, unicode) and '\t' not in text]
+		rows.append('9\tNUL \x00 in text')
+		for batch in (rows, rows[:-1]):
+			self.assertEqual(normalizer.clean_rows(batch),
+				[sentiment.clean_row(row) for row in batch])
+
+
 class TestLibraryHelperFunctions(unittest.TestCase):
 	"""Tests that library-making helper functions work correctly"""
 	@mock.patch('__builtin__.open', fake_open_library)
@@ -124,8 +190,618 @@ class TestTokenizeFunction(unittest.TestCase):
 			lambda y: list(func(*y)), args)
 
 
+def regex_phrase_matches(library, tokens):
+	"""Reference implementation of phrase matching: one regex search per
+	library phrase and token, as find_phrase_matches used to do"""
+	matches = {}
+	for phrase, (score, rule_num) in library.iteritems():
+		found_neg_phrase = False
+		for token, token_pos in tokens:
+			if sentiment.re.search(
+				'^(' + sentiment.get_opposite_meaning(phrase) + ')$', token):
+				found_neg_phrase = True
+				matches.setdefault(token, []).append([token_pos, -score, rule_num])
+		if not found_neg_phrase:
+			for token, token_pos in tokens:
+				if sentiment.re.search('^(' + phrase + ')$', token):
+					matches.setdefault(token, []).append([token_pos, score, rule_num])
+	return matches
+
+class TestPhraseMatcher(unittest.TestCase):
+	"""Tests for the PhraseMatcher class"""
+	def setUp(self):
+		"""Define commonly used test things"""
+		self.lib = {'good': (1, 0), 'bad': (-1, 1), 'very good': (2, 2),
+			'not bad': (1, 3), 'terrib(le|ly)': (-2, 4)}
+		self.text = ('dont think it was very good but not bad or good '
+			'or not really very bad and never terribly good').split()
+
+	def test_lookup(self):
+		"""Tests lookup finds whole phrases only"""
+		matcher = sentiment.PhraseMatcher(self.lib)
+		self.assertEqual(matcher.phrases[matcher.lookup(['very', 'good'])],
+			('very good', 2, 2))
+		self.assertIsNone(matcher.lookup(['very']))
+		self.assertIsNone(matcher.lookup(['very', 'good', 'good']))
+
+	def test_regex_phrases_kept_aside(self):
+		"""Tests phrases with regex syntax are not put in the trie"""
+		matcher = sentiment.PhraseMatcher(self.lib)
+		self.assertEqual([matcher.phrases[p[0]][0] for p in matcher.regex_phrases],
+			['terrib(le|ly)'])
+
+	def test_find_matches_same_as_regex(self):
+		"""Tests find_matches gives the same hits as one regex per phrase"""
+		matcher = sentiment.PhraseMatcher(self.lib)
+		tokens = list(sentiment.tokenize(self.text, max_words=5))
+		matches, hitcount_pos, hitcount_neg = matcher.find_matches(tokens)
+		target = regex_phrase_matches(self.lib, tokens)
+		self.assertEqual(dict(matches), target)
+		self.assertEqual(hitcount_pos + hitcount_neg,
+			sum(len(hits) for hits in target.values()))
+
+	def test_scan_words_same_as_find_matches(self):
+		"""Tests scanning words gives the same hits as matching every token"""
+		matcher = sentiment.PhraseMatcher(self.lib)
+		for max_words in range(1, 6):
+			tokens = sentiment.tokenize(self.text, max_words=max_words)
+			target = matcher.find_matches(tokens)
+			obj_ut = matcher.scan_words(self.text, max_words)
+			self.assertEqual((dict(obj_ut[0]),) + obj_ut[1:],
+				(dict(target[0]),) + target[1:])
+
+	def test_find_span_hits_same_as_find_hits(self):
+		"""Tests matching encoded words finds the same hits, with spans
+		covering the same tokens"""
+		matcher = sentiment.PhraseMatcher(self.lib)
+		texts = [self.text, 'not , bad never ? ever good'.split(), []]
+		for words in texts:
+			for max_words in range(1, 6):
+				hit_table = matcher.find_span_hits(
+					matcher.encode(words), words, max_words)
+				self.assertEqual(hit_table.get_hits(),
+					matcher.find_hits(words, max_words))
+
+	def test_encode(self):
+		"""Tests words are encoded as library word ids, 0 if unknown"""
+		matcher = sentiment.PhraseMatcher(self.lib)
+		word_ids = matcher.encode(['very', 'good', 'day', 'not'])
+		self.assertEqual(word_ids[2], 0)
+		self.assertIn(word_ids[0], matcher.id_trie)
+		self.assertIn(word_ids[1], matcher.id_trie[word_ids[0]])
+		self.assertIn(word_ids[3], matcher.negation_ids)
+		self.assertEqual(sentiment.PhraseMatcher.from_tables(
+			matcher.get_tables()).id_trie, matcher.id_trie)
+
+	def test_max_words(self):
+		"""Tests max_words is the word count of the longest phrase"""
+		matcher = sentiment.PhraseMatcher(self.lib)
+		self.assertEqual(matcher.max_words, 2)
+
+	def test_find_required_prefix(self):
+		"""Tests the required prefix of regex phrases leaves out optional
+		characters, groups and alternatives"""
+		self.assertEqual(sentiment.find_required_prefix('terrib(le|ly)'),
+			'terrib')
+		self.assertEqual(sentiment.find_required_prefix(
+			'(so|very) goo?d( day)?'), 'go')
+		self.assertEqual(sentiment.find_required_prefix('[a-z ]+ly bad'),
+			'bad')
+		self.assertIsNone(sentiment.find_required_prefix('good|bad'))
+		self.assertIsNone(sentiment.find_required_prefix('\\w+ly'))
+
+	def test_regex_prefilter_finds_same_hits(self):
+		"""Tests only prefiltered regex phrases are checked, without
+		losing any hits"""
+		lib = {'terrib(le|ly)': (-2, 0), '(so|very) goo?d': (2, 1),
+			'bad(ly)? done': (-1, 2), 'an? .* day': (1, 3), 'nice|fine': (1, 4),
+			'g(o)+d': (1, 5), 'good': (1, 6)}
+		matcher = sentiment.PhraseMatcher(lib)
+		texts = ['not so god a really nice day and never badly done'.split(),
+			'goood but not terribly fine'.split(), 'no phrases here'.split()]
+		for words in texts:
+			tokens = list(sentiment.tokenize(words, max_words=5))
+			self.assertEqual(dict(matcher.scan_words(words, 5)[0]),
+				dict(matcher.find_matches(tokens)[0]))
+			self.assertEqual(matcher.find_span_hits(
+				matcher.encode(words), words, 5).get_hits(),
+				matcher.find_hits(words, 5))
+		self.assertEqual([matcher.phrases[regex_phrase[0]][0] for regex_phrase
+			in matcher.get_regex_candidates(texts[2])], ['nice|fine'])
+
+	def test_library_set_same_as_each_library(self):
+		"""Tests a LibrarySet finds the hits each library's own matcher
+		finds, with libraries of different longest phrases"""
+		libraries = {'full': self.lib, 'short': {'good': (2, 0),
+			'bad': (-1, 1), 'or': (1, 2)}}
+		library_set = sentiment.LibrarySet(libraries)
+		texts = [self.text, 'not , bad never ? ever good'.split(),
+			'not so very good'.split(), []]
+		for words in texts:
+			tables = library_set.find_span_hits(
+				library_set.matcher.encode(words), words)
+			for name, library in libraries.items():
+				matcher = sentiment.PhraseMatcher(library)
+				self.assertEqual(tables[name].get_hits(),
+					matcher.find_hits(words, matcher.max_words + 2))
+
+	def test_segment_hits_same_as_whole_text(self):
+		"""Tests hits of overlapping windows merge into the hits of the
+		whole text, however small the windows"""
+		matcher = sentiment.PhraseMatcher(self.lib)
+		words = self.text + 'not , good never really very good'.split()
+		target = matcher.find_span_hits(matcher.encode(words), words, 4)
+		for segment_words in range(1, len(words) + 2):
+			segment_hits = [sentiment.find_segment_hits(matcher,
+				words[start:end], start, own_end - start, 4)
+				for start, own_end, end in sentiment.split_segments(
+					len(words), segment_words, 4)]
+			obj_ut = matcher.make_span_table(words,
+				*sentiment.merge_segment_hits(matcher, segment_hits))
+			self.assertEqual(obj_ut.get_hits(), target.get_hits())
+
+	def test_find_matches_hitcounts(self):
+		"""Tests positive hits of a phrase found negated are not counted"""
+		matcher = sentiment.PhraseMatcher({'good': (1, 0), 'bad': (-1, 1)})
+		tokens = list(sentiment.tokenize(
+			'good not good bad'.split(), max_words=2))
+		matches, hitcount_pos, hitcount_neg = matcher.find_matches(tokens)
+		self.assertEqual(dict(matches),
+			{'not good': [[1, -1, 0]], 'bad': [[3, -1, 1]]})
+		self.assertEqual((hitcount_pos, hitcount_neg), (1, 1))
+
+
+class TestCompiledLibrary(unittest.TestCase):
+	"""Tests for saving and loading compiled library files"""
+	def setUp(self):
+		"""Write a library file to a temporary directory"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		self.library_filepath = os.path.join(tmp_dir, 'library.txt')
+		self.compiled_filepath = os.path.join(tmp_dir, 'library.compiled')
+		with open(self.library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\nvery good\t2\nterrib(le|ly)\t-2\n')
+
+	def test_load_library_compiles(self):
+		"""Tests load_library writes a compiled library file the first time"""
+		library, matcher = sentiment.load_library(
+			self.library_filepath, self.compiled_filepath)
+		self.assertEqual(library, {'good': (1, 0), 'very good': (2, 1),
+			'terrib(le|ly)': (-2, 2)})
+		self.assertTrue(os.path.exists(self.compiled_filepath))
+
+	def test_load_compiled_library(self):
+		"""Tests a loaded matcher has the same tables as a compiled one"""
+		_, target = sentiment.load_library(
+			self.library_filepath, self.compiled_filepath)
+		obj_ut = sentiment.load_compiled_library(self.compiled_filepath,
+			sentiment.get_library_hash(self.library_filepath))
+		self.assertEqual(obj_ut.get_tables(), target.get_tables())
+
+	def test_load_compiled_library_stale(self):
+		"""Tests a compiled library isn't used once the library file changes"""
+		sentiment.load_library(self.library_filepath, self.compiled_filepath)
+		with open(self.library_filepath, 'a') as lib_file:
+			lib_file.write('bad\t-1\n')
+		obj_ut = sentiment.load_compiled_library(self.compiled_filepath,
+			sentiment.get_library_hash(self.library_filepath))
+		self.assertIsNone(obj_ut)
+		library, _ = sentiment.load_library(
+			self.library_filepath, self.compiled_filepath)
+		self.assertEqual(library['bad'], (-1, 3))
+
+	def test_load_compiled_library_version(self):
+		"""Tests compiled libraries from other format versions are ignored"""
+		sentiment.load_library(self.library_filepath, self.compiled_filepath)
+		with open(self.compiled_filepath, 'r+b') as compiled_file:
+			compiled_file.seek(len(sentiment.LIBRARY_FILE_MAGIC))
+			compiled_file.write('\xff\xff')
+		self.assertIsNone(
+			sentiment.load_compiled_library(self.compiled_filepath))
+
+
+class TestResultsSinks(unittest.TestCase):
+	"""Tests for the output sinks"""
+	def setUp(self):
+		"""Define commonly used test things"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		self.filepath = os.path.join(tmp_dir, 'results')
+		self.rows = [['100', 'not good', 2, -1, 0],
+			['100', 'not very good', 4, -1.5, 0], ['101', 'good', 0, 1, 3]]
+
+	def test_tsv_sink(self):
+		"""Tests TSVSink writes a single header line"""
+		with sentiment.open_results_sink(self.filepath, 'tsv',
+			sentiment.VERBOSE_COLUMNS, batch_size=2) as sink:
+			sink.write_rows(self.rows[:1])
+			sink.write_rows(self.rows[1:])
+		with open(self.filepath) as results_file:
+			self.assertEqual(results_file.read(),
+				'text id\tphrase\tword pos\tweighted score\trule num\n'
+				'100\tnot good\t2\t-1\t0\n100\tnot very good\t4\t-1.5\t0\n'
+				'101\tgood\t0\t1\t3\n')
+
+	def test_incomplete_sink(self):
+		"""Tests a sink missing one of its hooks can't be made"""
+		class NoCloseSink(sentiment.ResultsSink):
+			def open_file(self):
+				pass
+			def write_batch(self, rows):
+				pass
+		self.assertRaises(TypeError, NoCloseSink, self.filepath,
+			sentiment.VERBOSE_COLUMNS)
+		self.assertFalse(os.path.exists(self.filepath))
+
+	def test_binary_sink(self):
+		"""Tests BinarySink output is read back in batches"""
+		with sentiment.open_results_sink(self.filepath, 'binary',
+			sentiment.VERBOSE_COLUMNS, batch_size=2) as sink:
+			sink.write_rows(self.rows)
+			sink.write_rows(self.rows[:1])
+		obj_ut = list(sentiment.read_binary_results(self.filepath))
+		self.assertEqual(len(obj_ut), 2)
+		self.assertEqual(obj_ut[0]['phrase'], ['not good', 'not very good', 'good'])
+		self.assertEqual(obj_ut[0]['weighted score'], [-1.0, -1.5, 1.0])
+		self.assertEqual(obj_ut[1]['rule num'], [0])
+
+	@unittest.skipIf(sentiment.pyarrow is None, "needs pyarrow")
+	def test_arrow_sink(self):
+		"""Tests ArrowSink writes one record batch per batch"""
+		with sentiment.open_results_sink(self.filepath, 'arrow',
+			sentiment.VERBOSE_COLUMNS, batch_size=2) as sink:
+			sink.write_rows(self.rows)
+		reader = sentiment.pyarrow.ipc.open_file(
+			sentiment.pyarrow.memory_map(self.filepath))
+		self.assertEqual(reader.num_record_batches, 1)
+		self.assertEqual(reader.read_all().to_pydict()['word pos'], [2, 4, 0])
+
+	@unittest.skipIf(sentiment.pyarrow is None, "needs pyarrow")
+	def test_parquet_sink(self):
+		"""Tests ParquetSink writes a readable parquet file"""
+		with sentiment.open_results_sink(self.filepath, 'parquet',
+			sentiment.VERBOSE_COLUMNS) as sink:
+			sink.write_rows(self.rows)
+		obj_ut = sentiment.pyarrow.parquet.read_table(self.filepath)
+		self.assertEqual(obj_ut.to_pydict()['text id'], ['100', '100', '101'])
+
+	def test_unknown_format(self):
+		"""Tests open_results_sink refuses unknown formats"""
+		self.assertRaises(sentiment.SentimentException,
+			sentiment.open_results_sink, self.filepath, 'xml',
+			sentiment.SIMPLE_COLUMNS)
+
+
+class TestRunStats(unittest.TestCase):
+	"""Tests for the RunStats class"""
+	def test_add_time_histogram(self):
+		"""Tests stage times are summed and bucketed by microseconds"""
+		stats = sentiment.RunStats()
+		for seconds in (0.0000005, 0.000003, 0.000004, 0.001):
+			stats.add_time('match', seconds)
+		summary = stats.get_summary()
+		self.assertAlmostEqual(summary['stage seconds']['match'], 0.0010075)
+		self.assertEqual(summary['stage histograms']['match'],
+			[(1, 1), (4, 2), (1024, 1)])
+
+	def test_slowest_texts(self):
+		"""Tests only the slowest texts are kept, slowest first"""
+		stats = sentiment.RunStats(slowest=2)
+		for text_id, seconds in enumerate([0.3, 0.1, 0.5, 0.2]):
+			stats.add_text({'text id': text_id, 'seconds': {'match': seconds},
+				'words': 1, 'candidates': 1, 'hits': 0})
+		self.assertEqual([record['text id'] for record in
+			stats.get_summary()['slowest texts']], [2, 0])
+
+
+class TestCorpusAggregates(unittest.TestCase):
+	"""Tests for the CorpusAggregates class"""
+	def setUp(self):
+		"""Make tallies of a few texts"""
+		self.tallies = [(0.5 * i - 2, 10 + i, i % 3, i % 2,
+			{i % 4: [1 + i % 2, 0.5 * i]}) for i in range(9)]
+
+	def test_add_tally(self):
+		"""Tests counts, rule totals and score quantiles"""
+		aggregates = sentiment.CorpusAggregates(bin_width=0.25)
+		for tally in self.tallies:
+			aggregates.add_tally(tally)
+		summary = aggregates.get_summary()
+		self.assertEqual(summary['counts'], {'texts': 9, 'words': 126,
+			'pos hits': 9, 'neg hits': 4, 'total hits': 13})
+		self.assertEqual(summary['rules']['1'], {'hits': 4, 'score sum': 3.0})
+		self.assertEqual(summary['score mean'], 0)
+		self.assertEqual((summary['score min'], summary['score max']), (-2, 2))
+		self.assertAlmostEqual(summary['score quantiles']['0.5'], 0.125)
+		self.assertEqual(summary['score quantiles']['0.01'], -1.875)
+
+	def test_merge_and_from_summary(self):
+		"""Tests merged aggregates, also loaded from JSON, give the
+		summary of all the tallies"""
+		whole = sentiment.CorpusAggregates()
+		parts = [sentiment.CorpusAggregates(), sentiment.CorpusAggregates()]
+		for i, tally in enumerate(self.tallies):
+			whole.add_tally(tally)
+			parts[i % 2].add_tally(tally)
+		merged = sentiment.CorpusAggregates.from_summary(
+			json.loads(json.dumps(parts[0].get_summary())))
+		merged.merge(parts[1])
+		self.assertEqual(merged.get_summary(), whole.get_summary())
+		self.assertRaises(sentiment.SentimentException, merged.merge,
+			sentiment.CorpusAggregates(bin_width=1))
+
+
+class TestExternalSorter(unittest.TestCase):
+	"""Tests for the ExternalSorter class"""
+	def test_sort_through_run_files(self):
+		"""Tests rows sorted through many run files and merge passes
+		come out in stable key order, and the run files are removed"""
+		rows = [['%d' % (i % 5), i * 7 % 11, i] for i in range(300)]
+		key = lambda row: [row[0], row[1]]
+		for max_bytes in (1, 200, 1 << 20):
+			with sentiment.ExternalSorter(key, max_bytes, merge_width=3,
+				block_rows=7) as sorter:
+				for i in range(0, len(rows), 4):
+					sorter.add_rows(rows[i:i + 4])
+				self.assertEqual(list(sorter.iter_sorted()),
+					sorted(rows, key=key))
+				self.assertEqual(len(sorter.runs) > 1, max_bytes < 1 << 20)
+			self.assertFalse(os.path.exists(sorter.directory))
+
+
+class TestHitStore(unittest.TestCase):
+	"""Tests for hit store helpers"""
+	def test_diff_libraries(self):
+		"""Tests diff_libraries compares phrases, not rule numbers"""
+		obj_ut = sentiment.diff_libraries(
+			{'good': (1, 0), 'bad': (-1, 1), 'meh': (0, 2)},
+			{'great': (2, 0), 'good': (1, 1), 'bad': (-2, 2)})
+		self.assertEqual(obj_ut, (set(['great']), set(['bad']), set(['meh'])))
+
+	def test_read_hit_store(self):
+		"""Tests hit store records are read back after the header"""
+		hit_store = tempfile.TemporaryFile()
+		self.addCleanup(hit_store.close)
+		sentiment.write_hit_store_header(hit_store, {'good': (1, 0)}, 3)
+		sentiment.marshal.dump(('1', 2, [('good', 1, 1, 0, False)]), hit_store)
+		hit_store.seek(0)
+		header, records = sentiment.read_hit_store(hit_store)
+		self.assertEqual(header['library'], {'good': (1, 0)})
+		self.assertEqual(list(records), [('1', 2, [('good', 1, 1, 0, False)])])
+
+
+class TestResultCache(unittest.TestCase):
+	"""Tests for the ResultCache class"""
+	def test_lru_eviction(self):
+		"""Tests least recently used entries are evicted over max_bytes"""
+		entry_size = len(sentiment.marshal.dumps([['1', 0]]))
+		cache = sentiment.ResultCache(max_bytes=2 * entry_size)
+		cache.put('a', [['1', 0]])
+		cache.put('b', [['1', 0]])
+		cache.get('a')
+		cache.put('c', [['1', 0]])
+		self.assertEqual(cache.get('b'), None)
+		self.assertEqual(cache.get('a'), [['1', 0]])
+		summary = cache.get_summary()
+		self.assertEqual((summary['hits'], summary['misses'],
+			summary['evictions']), (2, 1, 1))
+
+	def test_disk_tier(self):
+		"""Tests entries persist on disk between caches"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		cache = sentiment.ResultCache(directory=tmp_dir)
+		key = cache.get_key('fingerprint', u'good text')
+		cache.put(key, ([['1', 1]], None))
+		cache = sentiment.ResultCache(directory=tmp_dir)
+		self.assertEqual(cache.get(key), ([['1', 1]], None))
+		self.assertEqual(cache.get_summary()['disk hits'], 1)
+		self.assertNotEqual(cache.get_key('other', u'good text'), key)
+
+
+class TestStagedPipeline(unittest.TestCase):
+	"""Tests for the StagedPipeline class"""
+	def test_results_in_source_order(self):
+		"""Tests results come out in source order however many threads
+		each stage runs"""
+		pipeline = sentiment.StagedPipeline(queue_size=2)
+		pipeline.add_stage('square', lambda x: x * x, threads=3)
+		pipeline.add_stage('sleep', lambda x: sentiment.time.sleep(
+			0.001 * (x % 3)) or x + 1, threads=4)
+		self.assertEqual(list(pipeline.run(xrange(50))),
+			[x * x + 1 for x in xrange(50)])
+		summary = pipeline.get_summary()
+		self.assertEqual(summary['stage items'], {'square': 50, 'sleep': 50})
+		self.assertEqual(sorted(summary['queue depths']),
+			['output', 'sleep', 'square'])
+		self.assertLessEqual(summary['queue depths']['sleep']['max'], 2)
+
+	def test_stage_error_raised(self):
+		"""Tests an exception in a stage is raised by run()"""
+		pipeline = sentiment.StagedPipeline()
+		pipeline.add_stage('invert', lambda x: 1 / x, threads=2)
+		self.assertRaises(ZeroDivisionError, list, pipeline.run([1, 0, 2]))
+
+
+class TestCompressedFiles(unittest.TestCase):
+	"""Tests for reading and writing compressed files"""
+	def setUp(self):
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		self.tmp_dir = tmp_dir
+		self.lines = ['%d\t%s\n' % (i, 'word ' * (i % 11)) for i in range(200)]
+
+	def test_get_compression(self):
+		"""Tests compression is found from the extension or first bytes"""
+		filepath = os.path.join(self.tmp_dir, 'texts')
+		self.assertEqual(sentiment.get_compression(filepath + '.GZ'), 'gzip')
+		with open(filepath, 'wb') as raw_file:
+			raw_file.write(sentiment.bz2.compress('text'))
+		self.assertEqual(sentiment.get_compression(filepath), 'bz2')
+		self.assertIsNone(sentiment.get_compression(filepath, detect=False))
+
+	def test_round_trip(self):
+		"""Tests written and appended streams are read back whole, in
+		blocks of any size"""
+		for extension in ('.gz', '.bz2'):
+			filepath = os.path.join(self.tmp_dir, 'texts' + extension)
+			for mode, lines in (('w', self.lines[:150]), ('a', self.lines[150:])):
+				writer = sentiment.CompressedWriter(filepath, mode, block_size=100)
+				writer.writelines(lines)
+				writer.flush()
+				writer.close()
+			for block_size in (7, 1 << 20):
+				reader = sentiment.CompressedReader(filepath,
+					block_size=block_size)
+				with reader:
+					self.assertEqual(reader.read(5), ''.join(self.lines)[:5])
+					self.assertEqual(reader.read(), ''.join(self.lines)[5:])
+
+	def test_compressed_text_file(self):
+		"""Tests rows of a compressed text file, from an offset"""
+		filepath = os.path.join(self.tmp_dir, 'texts.gz')
+		with sentiment.open_compressed(filepath, 'w') as out:
+			out.writelines(self.lines)
+		row_ends = sentiment.collections.deque()
+		with sentiment.open_text_file(filepath, block_size=64) as text_file:
+			self.assertEqual(list(text_file.iter_rows(row_ends=row_ends)),
+				self.lines)
+		with sentiment.open_text_file(filepath, block_size=64) as text_file:
+			self.assertEqual(list(text_file.iter_rows(row_ends[9] - 1,
+				row_ends[19])), self.lines[10:20])
+
+
+class TestCorpusIndex(unittest.TestCase):
+	"""Tests for build_corpus_index and the CorpusIndex class"""
+	def setUp(self):
+		"""Index texts with negation gaps, repeats and odd words"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		self.tmp_dir = tmp_dir
+		self.texts = [('a', 'not so very good but not bad or good'),
+			('b', 'never ? good and not , bad at all'),
+			('c', ''), ('d', 'terribly terrible very very good not not bad'),
+			('e', 'nothing to see here')]
+		self.lib = {'good': (1, 0), 'bad': (-1, 1), 'very good': (2, 2),
+			'not bad': (1, 3), 'terrib(le|ly)': (-2, 4), 'at all': (0, 5),
+			'(never|so) .*': (1, 6)}
+		self.index_filepath = os.path.join(tmp_dir, 'corpus.idx')
+		sentiment.build_corpus_index(self.texts, self.index_filepath)
+
+	def test_find_hits_same_as_matcher(self):
+		"""Tests hits found through the index are the matcher's hits"""
+		matcher = sentiment.PhraseMatcher(self.lib)
+		with sentiment.CorpusIndex(self.index_filepath) as index:
+			self.assertEqual(index.text_ids, ['a', 'b', 'c', 'd', 'e'])
+			for max_words in range(1, 7):
+				hits = index.find_hits(matcher, max_words)
+				for text_index, (_, text) in enumerate(self.texts):
+					words = text.split()
+					self.assertEqual(index.get_words(text_index), words)
+					target = matcher.find_span_hits(
+						matcher.encode(words), words, max_words).get_hits()
+					obj_ut = matcher.make_span_table(words,
+						*hits[text_index]).get_hits()
+					self.assertEqual(obj_ut, target)
+
+	def test_run_library_same_as_library_run(self):
+		"""Tests index runs give the rows of LibraryRun"""
+		matcher = sentiment.PhraseMatcher(self.lib)
+		for simple in (True, False):
+			target = [sentiment.run_library(text, self.lib, matcher,
+				simple).rows for text in self.texts]
+			with sentiment.CorpusIndex(self.index_filepath) as index:
+				obj_ut = [output.rows for output in
+					index.run_library(self.lib, matcher, simple)]
+			self.assertEqual(obj_ut, target)
+
+	def test_not_an_index(self):
+		"""Tests other files aren't opened as an index"""
+		filepath = os.path.join(self.tmp_dir, 'texts.txt')
+		with open(filepath, 'w') as text_file:
+			text_file.write('1\tgood enough text\n' * 10)
+		self.assertRaises(sentiment.SentimentException,
+			sentiment.CorpusIndex, filepath)
+
+
+class TestMappedTextFile(unittest.TestCase):
+	"""Tests for the MappedTextFile class"""
+	def setUp(self):
+		"""Write a text file to a temporary directory"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		self.filepath = os.path.join(tmp_dir, 'texts.txt')
+		self.lines = ['%d\t%s\n' % (i, 'word ' * (i * 7 % 13)) for i in range(40)]
+		self.lines.append('40\tno newline at the end')
+		with open(self.filepath, 'wb') as text_file:
+			text_file.write(''.join(self.lines))
+
+	def test_iter_rows(self):
+		"""Tests rows are read whole, however small the blocks are"""
+		for block_size in (1, 16, 1 << 20):
+			with sentiment.MappedTextFile(self.filepath, block_size) as text_file:
+				self.assertEqual(list(text_file.iter_rows()), self.lines)
+
+	def test_byte_ranges(self):
+		"""Tests byte ranges split the file on row boundaries"""
+		with sentiment.MappedTextFile(self.filepath, 32) as text_file:
+			ranges = text_file.get_byte_ranges(7)
+			self.assertEqual(len(ranges), 7)
+			rows = []
+			for start, end in ranges:
+				rows.extend(text_file.iter_rows(start, end))
+		self.assertEqual(rows, self.lines)
+
+	def test_row_ends(self):
+		"""Tests the offset after each row is recorded, and reading can
+		resume from one"""
+		row_ends = sentiment.collections.deque()
+		with sentiment.MappedTextFile(self.filepath) as text_file:
+			list(text_file.iter_rows(row_ends=row_ends))
+			self.assertEqual(row_ends[-1], os.path.getsize(self.filepath))
+			self.assertEqual(list(text_file.iter_rows(row_ends[9])),
+				self.lines[10:])
+
+	def test_empty_file(self):
+		"""Tests an empty file has no rows"""
+		open(self.filepath, 'w').close()
+		with sentiment.MappedTextFile(self.filepath) as text_file:
+			self.assertEqual(list(text_file.iter_rows()), [])
+
+
 class TestSentimentFactory(unittest.TestCase):
 	"""Tests for the SentimentFactory class"""
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.tmp_dir)
+		self.text_filepath = os.path.join(self.tmp_dir, 'texts.txt')
+		self.library_filepath = os.path.join(self.tmp_dir, 'library.txt')
+
+	def write_texts(self, lines):
+		"""Writes lines of tab separated text id and text to the text
+		file"""
+		with open(self.text_filepath, 'w') as text_file:
+			text_file.writelines(lines)
+
+	def write_library(self, lines):
+		"""Writes library lines of tab separated phrase and score to the
+		library file"""
+		with open(self.library_filepath, 'w') as lib_file:
+			lib_file.write(lines)
+
+	def make_factory(self, output_filename, **kwargs):
+		"""Makes a SentimentFactory of the text and library files writing
+		output_filename in tmp_dir"""
+		return sentiment.SentimentFactory(self.text_filepath,
+			self.library_filepath, self.tmp_dir + '/', output_filename,
+			**kwargs)
+
+	def run_factory(self, output_filename, **kwargs):
+		"""Runs run_suite() of make_factory(), outputs the output file"""
+		self.make_factory(output_filename, **kwargs).run_suite()
+		with open(os.path.join(self.tmp_dir, output_filename)) as out:
+			return out.read()
+
 	def test_instantiate_sentiment_factory(self):
 		"""Tests we can instantiate SentimentFactory"""
 		obj_ut = sentiment.SentimentFactory("", "")
@@ -139,6 +815,517 @@ class TestSentimentFactory(unittest.TestCase):
 		obj_ut = [line for line in test.stream_lines(test_fo)]
 		self.assertEqual(obj_ut, ['this is line 1\n', 'this is line 2\n'])
 
+	def test_stream_lines_profiled_normalizer(self):
+		"""Tests stats don't change how lines are cleaned"""
+		normalizer = sentiment.TextNormalizer(keep_digits=False)
+		lines = ['1\tgood 123 good\n', '2\tNot bad!\n']
+		plain = sentiment.SentimentFactory("", "", normalizer=normalizer)
+		profiled = sentiment.SentimentFactory("", "", normalizer=normalizer,
+			chunk_size=1, stats=sentiment.RunStats())
+		self.assertEqual(list(profiled.stream_lines_profiled(lines)),
+			list(plain.stream_lines(lines)))
+		self.assertEqual(
+			sum(profiled.stats.stage_histograms['clean'].values()), 2)
+
+	def test_iter_chunks(self):
+		"""Tests iter_chunks groups items into lists of chunk_size"""
+		obj_ut = list(sentiment.iter_chunks(xrange(5), 2))
+		self.assertEqual(obj_ut, [[0, 1], [2, 3], [4]])
+
+	def test_run_suite_workers(self):
+		"""Tests run_suite gives the same output, in input order, with
+		several worker processes as with one"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		with open(text_filepath, 'w') as text_file:
+			for i in range(25):
+				text_file.write('%d\tSo good%s, not bad %s\n' % (
+					i, ' good' * (i % 3), 'bad' * (i % 4)))
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\nbad\t-1\n')
+
+		outputs = []
+		for workers in (1, 3):
+			output_filename = 'out%d.txt' % workers
+			sentiment.SentimentFactory(text_filepath, library_filepath,
+				tmp_dir + '/', output_filename, workers=workers,
+				chunk_size=4, max_pending=2).run_suite()
+			with open(os.path.join(tmp_dir, output_filename)) as out:
+				outputs.append(out.read())
+		self.assertEqual(outputs[0], outputs[1])
+		self.assertEqual(outputs[0].count('\n'), 50)
+
+	def test_run_suite_output_format(self):
+		"""Tests run_suite writes a single header through an output sink"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		with open(text_filepath, 'w') as text_file:
+			text_file.write('1\tNot good at all\n2\tgood, good\n')
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\n')
+		sentiment.SentimentFactory(text_filepath, library_filepath,
+			tmp_dir + '/', 'out.txt', output_format='tsv').run_suite()
+		with open(os.path.join(tmp_dir, 'out.txt')) as out:
+			self.assertEqual(out.read(), '.text id\t.text score\tneg hits\t'
+				'pos hits\ttotal hits\ttotal wordcount\n'
+				'1\t-1\t1\t0\t1\t4\n2\t1\t0\t2\t2\t2\n')
+
+	def test_run_suite_stats(self):
+		"""Tests run_suite collects per-stage stats, with and without
+		worker processes"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		with open(text_filepath, 'w') as text_file:
+			for i in range(6):
+				text_file.write('%d\tnot good, good%s\n' % (i, ' good' * i))
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\n')
+
+		for workers in (1, 2):
+			records = []
+			stats = sentiment.RunStats(slowest=2, callback=records.append)
+			sentiment.SentimentFactory(text_filepath, library_filepath,
+				tmp_dir + '/', workers=workers, chunk_size=2,
+				stats=stats).run_suite()
+			summary = stats.get_summary()
+			self.assertEqual(summary['counts'],
+				{'texts': 6, 'words': 33, 'hits': 12, 'candidates': 39})
+			self.assertEqual(sorted(summary['stage seconds']), ['clean',
+				'format', 'match', 'preprocess', 'score', 'write'])
+			self.assertEqual(len(summary['slowest texts']), 2)
+			self.assertEqual([record['text id'] for record in records],
+				[str(i) for i in range(6)])
+
+	def rescore_and_rerun(self, library_v1, library_v2, simple=True,
+		                  remove_texts=False, byte_range=None):
+		"""Runs library_v1 keeping a hit store, then rescores with
+		library_v2; outputs (rescored output, output of a full run),
+		all of them over byte_range if given"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		with open(text_filepath, 'w') as text_file:
+			text_file.write('1\tNot good at all, just bad\n'
+				'2\tgood, good and very good\n3\tnever very bad, never good\n')
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write(library_v1)
+		sentiment.SentimentFactory(text_filepath, library_filepath,
+			tmp_dir + '/', 'v1.txt', simple=simple, byte_range=byte_range,
+			hit_store_filepath=os.path.join(tmp_dir, 'v1.hits')).run_suite()
+
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write(library_v2)
+		sentiment.SentimentFactory(text_filepath, library_filepath,
+			tmp_dir + '/', 'full.txt', simple=simple,
+			byte_range=byte_range).run_suite()
+		if remove_texts:
+			os.remove(text_filepath)
+		sentiment.SentimentFactory(text_filepath, library_filepath,
+			tmp_dir + '/', 'rescored.txt', simple=simple, byte_range=byte_range,
+			hit_store_filepath=os.path.join(tmp_dir, 'v2.hits')).rescore(
+			os.path.join(tmp_dir, 'v1.hits'))
+
+		outputs = []
+		for output_filename in ('rescored.txt', 'full.txt'):
+			with open(os.path.join(tmp_dir, output_filename)) as out:
+				outputs.append(out.read())
+		return outputs
+
+	def test_rescore_byte_range(self):
+		"""Tests rescoring the hit store of a byte range run reads only
+		the texts of that range"""
+		rescored, target = self.rescore_and_rerun('good\t1\n',
+			'good\t1\nvery bad\t-3\n', byte_range=(30, None))
+		self.assertEqual(rescored, target)
+		self.assertNotIn('\n1\t', '\n' + target)
+
+	def test_rescore(self):
+		"""Tests rescoring after adding, removing and changing phrases
+		gives the same results as a full run"""
+		for simple in (True, False):
+			rescored, target = self.rescore_and_rerun(
+				'good\t1\nbad\t-1\nat all\t0\n',
+				'very bad\t-3\ngood\t2\nat all\t0\nfoo\t5\n', simple)
+			self.assertEqual(rescored, target)
+
+	def test_rescore_without_texts(self):
+		"""Tests score changes and removals are rescored from the hit
+		store alone"""
+		rescored, target = self.rescore_and_rerun(
+			'good\t1\nbad\t-1\njust\t1\n', 'bad\t-2\ngood\t1\n',
+			remove_texts=True)
+		self.assertEqual(rescored, target)
+
+	def test_run_suite_byte_ranges_and_resume(self):
+		"""Tests running byte ranges separately, or resuming from a
+		checkpoint, gives the same output as one run"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		checkpoint_filepath = os.path.join(tmp_dir, 'checkpoint')
+		with open(text_filepath, 'w') as text_file:
+			for i in range(20):
+				text_file.write('%d\tgood%s\n' % (i, ' bad' * (i % 3)))
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\nbad\t-1\n')
+
+		def run(output_filename, **kwargs):
+			factory = sentiment.SentimentFactory(text_filepath,
+				library_filepath, tmp_dir + '/', output_filename, **kwargs)
+			factory.run_suite()
+			return factory
+
+		run('full.txt')
+		with sentiment.MappedTextFile(text_filepath) as text_file:
+			for byte_range in text_file.get_byte_ranges(3):
+				run('ranges.txt', byte_range=byte_range)
+
+		factory = run('resumed.txt', byte_range=(0, 100),
+			checkpoint_filepath=checkpoint_filepath, checkpoint_every=2)
+		self.assertEqual(sentiment.read_checkpoint(checkpoint_filepath),
+			factory.offset)
+		run('resumed.txt', checkpoint_filepath=checkpoint_filepath)
+		self.assertEqual(sentiment.read_checkpoint(checkpoint_filepath),
+			os.path.getsize(text_filepath))
+
+		outputs = []
+		for output_filename in ('full.txt', 'ranges.txt', 'resumed.txt'):
+			with open(os.path.join(tmp_dir, output_filename)) as out:
+				outputs.append(out.read())
+		self.assertEqual(outputs[1], outputs[0])
+		self.assertEqual(outputs[2], outputs[0])
+
+	def test_run_suite_resume_after_failure(self):
+		"""Tests a run failing partway through, then resumed from its
+		checkpoint, writes the output, hit store and aggregates of one
+		full run"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		with open(text_filepath, 'w') as text_file:
+			for i in range(20):
+				text_file.write('%d\tgood%s\n' % (i, ' not bad' * (i % 3)))
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\nbad\t-1\n')
+
+		def run(name, **kwargs):
+			sentiment.SentimentFactory(text_filepath, library_filepath,
+				tmp_dir + '/', name + '.txt',
+				hit_store_filepath=os.path.join(tmp_dir, name + '.hits'),
+				aggregates_filepath=os.path.join(tmp_dir, name + '.json'),
+				**kwargs).run_suite()
+			outputs = []
+			for extension in ('.txt', '.hits', '.json'):
+				with open(os.path.join(tmp_dir, name + extension), 'rb') as out:
+					outputs.append(out.read())
+			return outputs
+
+		format_lines_list = sentiment.format_lines_list
+		written = []
+		def fail_after_texts(lines_list):
+			if len(written) == 13:
+				raise IOError("disk full")
+			written.append(lines_list)
+			return format_lines_list(lines_list)
+
+		checkpoint_filepath = os.path.join(tmp_dir, 'checkpoint')
+		with mock.patch.object(sentiment, 'format_lines_list',
+			side_effect=fail_after_texts):
+			self.assertRaises(IOError, run, 'resumed',
+				checkpoint_filepath=checkpoint_filepath, checkpoint_every=5)
+		self.assertEqual(sentiment.read_checkpoint_sizes(checkpoint_filepath)[0],
+			len(''.join(format_lines_list(sum(written[:10], [])))))
+		self.assertEqual(run('resumed',
+			checkpoint_filepath=checkpoint_filepath), run('full'))
+
+	def test_run_suite_summary_only(self):
+		"""Tests summary_only runs write the same output, and need
+		simple results without a hit store"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		with open(text_filepath, 'w') as text_file:
+			for i in range(10):
+				text_file.write('%d\tgood%s not bad\n' % (i, ' bad' * i))
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\nbad\t-2\n')
+
+		outputs = []
+		for summary_only in (False, True):
+			sentiment.SentimentFactory(text_filepath, library_filepath,
+				tmp_dir + '/', '%s.txt' % summary_only, workers=2,
+				summary_only=summary_only).run_suite()
+			with open(os.path.join(tmp_dir, '%s.txt' % summary_only)) as out:
+				outputs.append(out.read())
+		self.assertEqual(outputs[0], outputs[1])
+		self.assertRaises(sentiment.SentimentException,
+			sentiment.SentimentFactory, text_filepath, library_filepath,
+			simple=False, summary_only=True)
+
+	def test_run_suite_library_set(self):
+		"""Tests runs with several libraries write each library's rows
+		after the text id, the same as runs of each library"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepaths = {'a': os.path.join(tmp_dir, 'a.txt'),
+			'b': os.path.join(tmp_dir, 'b.txt')}
+		with open(text_filepath, 'w') as text_file:
+			for i in range(5):
+				text_file.write('%d\tgood%s not so very bad\n' % (i, ' bad' * i))
+		with open(library_filepaths['a'], 'w') as lib_file:
+			lib_file.write('good\t1\nbad\t-2\n')
+		with open(library_filepaths['b'], 'w') as lib_file:
+			lib_file.write('very bad\t-3\ngood\t2\n')
+
+		for simple in (True, False):
+			sentiment.SentimentFactory(text_filepath, library_filepaths,
+				tmp_dir + '/', 'both.txt', simple=simple,
+				output_format='tsv').run_suite()
+			with open(os.path.join(tmp_dir, 'both.txt')) as out:
+				header = out.readline().split('\t')
+				rows = [line.split('\t') for line in out]
+			self.assertEqual(header[:2], [header[0], 'library'])
+
+			target = []
+			for name in ('a', 'b'):
+				sentiment.SentimentFactory(text_filepath,
+					library_filepaths[name], tmp_dir + '/', name + '_out.txt',
+					simple=simple, output_format='tsv').run_suite()
+				with open(os.path.join(tmp_dir, name + '_out.txt')) as out:
+					out.readline()
+					target.extend([line.split('\t')[0], name] +
+						line.split('\t')[1:] for line in out)
+			self.assertEqual(sorted(rows), sorted(target))
+		self.assertRaises(sentiment.SentimentException,
+			sentiment.SentimentFactory, text_filepath, library_filepaths,
+			summary_only=True)
+
+	def test_run_index(self):
+		"""Tests runs over a corpus index write run_suite's output"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		index_filepath = os.path.join(tmp_dir, 'texts.idx')
+		with open(text_filepath, 'w') as text_file:
+			for i in range(10):
+				text_file.write('%d\tGood%s, not so very bad!\n' % (i, ' bad' * i))
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\nbad\t-2\nvery bad\t-3\n')
+
+		self.assertEqual(sentiment.SentimentFactory(text_filepath,
+			library_filepath).build_index(index_filepath), 10)
+		for simple in (True, False):
+			outputs = []
+			for name in ('suite.txt', 'index.txt'):
+				factory = sentiment.SentimentFactory(text_filepath,
+					library_filepath, tmp_dir + '/', name, simple=simple)
+				if name == 'index.txt':
+					factory.run_index(index_filepath)
+				else:
+					factory.run_suite()
+				with open(os.path.join(tmp_dir, name)) as out:
+					outputs.append(out.read())
+				os.remove(os.path.join(tmp_dir, name))
+			self.assertEqual(outputs[0], outputs[1])
+		for options in ({'byte_range': (0, 100)}, {'checkpoint_filepath':
+			os.path.join(tmp_dir, 'checkpoint')}):
+			self.assertRaises(sentiment.SentimentException,
+				sentiment.SentimentFactory(text_filepath, library_filepath,
+					tmp_dir + '/', **options).run_index, index_filepath)
+
+	def test_run_suite_segmented(self):
+		"""Tests long texts matched in windows by the workers give the
+		same output and hits as whole texts"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		with open(text_filepath, 'w') as text_file:
+			for i in range(12):
+				text_file.write('%d\tgood%s not so very bad good\n' % (
+					i, ' never bad' * (i * 5 % 7)))
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\nbad\t-2\nvery bad\t-3\n')
+
+		for simple in (True, False):
+			outputs = []
+			for segment_words in (None, 4):
+				name = '%s.txt' % segment_words
+				hit_store_filepath = os.path.join(tmp_dir, name + '.hits')
+				sentiment.SentimentFactory(text_filepath, library_filepath,
+					tmp_dir + '/', name, workers=2, chunk_size=3,
+					simple=simple, hit_store_filepath=hit_store_filepath,
+					segment_words=segment_words).run_suite()
+				with open(os.path.join(tmp_dir, name)) as out:
+					outputs.append(out.read())
+				with open(hit_store_filepath, 'rb') as hit_store:
+					outputs.append(list(sentiment.read_hit_store(hit_store)[1]))
+				os.remove(os.path.join(tmp_dir, name))
+			self.assertEqual(outputs[:2], outputs[2:])
+
+	def test_run_suite_aggregates(self):
+		"""Tests aggregates kept during runs match the verbose output,
+		with or without workers, summary_only and checkpoints"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		aggregates_filepath = os.path.join(tmp_dir, 'aggregates.json')
+		with open(text_filepath, 'w') as text_file:
+			for i in range(10):
+				text_file.write('%d\tgood%s not bad\n' % (i, ' bad' * i))
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\nbad\t-2\n')
+
+		sentiment.SentimentFactory(text_filepath, library_filepath,
+			tmp_dir + '/', 'verbose.txt', simple=False).run_suite()
+		rule_hits = collections.Counter()
+		with open(os.path.join(tmp_dir, 'verbose.txt')) as out:
+			for line in out:
+				if not line.startswith('text id'):
+					rule_hits[line.split('\t')[4].strip()] += 1
+
+		checkpoint_filepath = os.path.join(tmp_dir, 'checkpoint')
+		for options in ({}, {'workers': 2, 'summary_only': True},
+			{'checkpoint_filepath': checkpoint_filepath,
+				'checkpoint_every': 3}):
+			factory = sentiment.SentimentFactory(text_filepath,
+				library_filepath, tmp_dir + '/',
+				aggregates_filepath=aggregates_filepath, **options)
+			factory.run_suite()
+			with open(aggregates_filepath) as aggregates_file:
+				summary = json.load(aggregates_file)
+			self.assertEqual(summary, json.loads(json.dumps(
+				factory.aggregates.get_summary())))
+			self.assertEqual(summary['counts']['texts'], 10)
+			self.assertEqual(summary['counts']['total hits'],
+				sum(rule_hits.values()))
+			self.assertEqual(dict((rule_num, rule['hits']) for rule_num, rule
+				in summary['rules'].items()), dict(rule_hits))
+		self.assertEqual(sentiment.read_checkpoint_aggregates(
+			checkpoint_filepath).get_summary(), factory.aggregates.get_summary())
+
+	def test_run_suite_sorted(self):
+		"""Tests sorted runs write every row once, in key order, under
+		a single header"""
+		self.write_texts('%d\tgood%s not bad\n' % (i, ' bad' * (i % 6))
+			for i in range(20))
+		self.write_library('good\t1\nbad\t-2\n')
+
+		lines = self.run_factory('plain.txt', simple=False).splitlines(True)
+		header = lines[0]
+		rows = [line for line in lines if line != header]
+
+		lines = self.run_factory('sorted.txt', simple=False,
+			sort_key=['rule num', 'word pos'], sort_memory=100,
+			sort_directory=self.tmp_dir).splitlines(True)
+		self.assertEqual(lines[0], header)
+		sorted_rows = lines[1:]
+		self.assertEqual(sorted(sorted_rows), sorted(rows))
+		keys = [(int(row.split('\t')[4]), int(row.split('\t')[2]))
+			for row in sorted_rows]
+		self.assertEqual(keys, sorted(keys))
+		self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+			['library.txt', 'plain.txt', 'sorted.txt', 'texts.txt'])
+		self.assertRaises(sentiment.SentimentException,
+			self.make_factory('out.txt', sort_key='score').run_suite)
+
+	def test_run_suite_pipelined(self):
+		"""Tests pipelined runs write the same output as plain runs"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		with open(text_filepath, 'w') as text_file:
+			for i in range(30):
+				text_file.write('%d\tGood%s, not bad\n' % (i, ' bad' * (i % 4)))
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\nbad\t-2\n')
+
+		outputs = []
+		for name, kwargs in (('plain', {}),
+			('threads', {'pipeline_queue_size': 2, 'clean_threads': 2}),
+			('workers', {'pipeline_queue_size': 2, 'workers': 2})):
+			stats = sentiment.RunStats()
+			sentiment.SentimentFactory(text_filepath, library_filepath,
+				tmp_dir + '/', name, chunk_size=4, simple=False, stats=stats,
+				**kwargs).run_suite()
+			with open(os.path.join(tmp_dir, name)) as out:
+				outputs.append(out.read())
+		self.assertEqual(outputs[1], outputs[0])
+		self.assertEqual(outputs[2], outputs[0])
+		self.assertEqual(stats.get_summary()['pipeline']['stage items'],
+			{'clean': 8, 'match': 8})
+
+	def test_run_suite_compressed(self):
+		"""Tests compressed input and output give the same results"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\nbad\t-2\n')
+		lines = ['%d\tGood%s, not bad\n' % (i, ' bad' * (i % 4))
+			for i in range(30)]
+		for text_filename in ('texts.txt', 'texts.gz'):
+			with sentiment.open_compressed(
+				os.path.join(tmp_dir, text_filename), 'w') as text_file:
+				text_file.writelines(lines)
+
+		outputs = []
+		for text_filename, output_filename, output_format in (
+			('texts.txt', 'out.txt', None), ('texts.gz', 'out.bz2', None),
+			('texts.txt', 'out.tsv', 'tsv'), ('texts.gz', 'out.tsv.gz', 'tsv')):
+			sentiment.SentimentFactory(os.path.join(tmp_dir, text_filename),
+				library_filepath, tmp_dir + '/', output_filename,
+				output_format=output_format).run_suite()
+			with sentiment.open_compressed(
+				os.path.join(tmp_dir, output_filename), 'r') as out:
+				outputs.append(out.read())
+		self.assertEqual(outputs[1], outputs[0])
+		self.assertEqual(outputs[3], outputs[2])
+
+	def test_run_suite_result_cache(self):
+		"""Tests duplicate texts reuse cached results, with their own
+		text ids, and the output is the same as without the cache"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		text_filepath = os.path.join(tmp_dir, 'texts.txt')
+		library_filepath = os.path.join(tmp_dir, 'library.txt')
+		with open(text_filepath, 'w') as text_file:
+			for i in range(12):
+				text_file.write('%d\t%s\n' % (i, ['Good!', 'not bad',
+					'good bad day'][i % 3]))
+		with open(library_filepath, 'w') as lib_file:
+			lib_file.write('good\t1\nbad\t-1\n')
+
+		outputs = []
+		for simple in (True, False):
+			for result_cache in (None, sentiment.ResultCache()):
+				stats = sentiment.RunStats()
+				factory = sentiment.SentimentFactory(text_filepath,
+					library_filepath, tmp_dir + '/', 'out.txt', simple=simple,
+					stats=stats, result_cache=result_cache)
+				factory.run_suite()
+				with open(os.path.join(tmp_dir, 'out.txt')) as out:
+					outputs.append(out.read())
+				os.remove(os.path.join(tmp_dir, 'out.txt'))
+			self.assertEqual(outputs[-1], outputs[-2])
+			self.assertEqual(result_cache.get_summary()['hit rate'], 0.75)
+			self.assertEqual((stats.counts['cache hits'],
+				stats.counts['cache misses']), (9, 3))
+
 	# def test_append_to_output_file(self):
 	# 	"""Tests that append_to_output_file appends line to output file.
 	# 	This maybe doesn't test appending as you would expect, but we couldn't
@@ -235,6 +1422,14 @@ class TestLibraryRun(unittest.TestCase):
 		self.assertEqual(obj_ut, {'not good': [[2, -1, 0]],
 			'not very good': [[4, -1, 0]]})
 
+	def test_score_text_keeps_matches_unweighted(self):
+		"""Tests score_text leaves the matches it weights unchanged"""
+		test = sentiment.LibraryRun(self.text3, self.lib)
+		matches = test.find_phrase_matches(self.tokens_generator3)[0]
+		test.score_text(matches, end_threshold=0.5)
+		self.assertEqual(dict(matches), {'not good': [[2, -1, 0]],
+			'not very good': [[4, -1, 0]]})
+
 	def test_score_text4(self):
 		"""Tests that score_text creates matches_weighted correctly
 		when weights are applied"""
@@ -253,6 +1448,53 @@ class TestLibraryRun(unittest.TestCase):
 		self.assertEqual(obj_ut, [['100', 'not good', 2, -1, 0],
 			['100', 'not very good', 4, -1, 0]])
 
+	def test_do_run_same_as_from_hits(self):
+		"""Tests the span hits of do_run() give the same hits and
+		results as the token strings from_hits() runs on"""
+		test = sentiment.LibraryRun(self.text3, self.lib, end_threshold=0.5)
+		test.do_run()
+		self.assertEqual(test.get_hits(), [('not good', 2, -1, 0, True),
+			('not very good', 4, -1, 0, True)])
+		target = sentiment.LibraryRun.from_hits('100', 7, test.get_hits(),
+			self.lib, test.matcher, end_threshold=0.5)
+		for simple in (True, False):
+			self.assertEqual(test.get_result_rows(simple),
+				target.get_result_rows(simple))
+
+	def test_hit_table_views(self):
+		"""Tests the weighted and unweighted matches views of a run's
+		hit table"""
+		test = sentiment.LibraryRun(self.text3, self.lib, end_threshold=0.5)
+		test.do_run()
+		self.assertEqual(test.text_score, -1.25)
+		self.assertEqual(dict(test.matches_unweighted),
+			{'not good': [[2, -1, 0]], 'not very good': [[4, -1, 0]]})
+		self.assertEqual(dict(test.matches_weighted),
+			{'not good': [[2, -1, 0]], 'not very good': [[4, -1.5, 0]]})
+		test.matches_weighted['not good'][0][1] = 5
+		self.assertEqual(test.hit_table.weighted_score, [-1, -1.5])
+
+	def test_summary_only_same_as_full_run(self):
+		"""Tests summary_only runs make the same simple results without
+		keeping hits"""
+		lib = {'good': (1, 0), 'bad': (-2, 1), 'very good': (3, 2),
+			'not bad': (1, 3), 'terrib(le|ly)': (-3, 4)}
+		texts = [self.text1, self.text2, self.text3, ('101', ''),
+			('102', 'bad terribly good but not bad not really bad very good')]
+		for text in texts:
+			for end_weight in (1.5, 2, 1.3):
+				full = sentiment.LibraryRun(text, lib, end_weight=end_weight)
+				full.do_run()
+				summary = sentiment.LibraryRun(text, lib, end_weight=end_weight,
+					summary_only=True)
+				summary.do_run()
+				self.assertEqual(summary.get_results(), full.get_results())
+				self.assertEqual(summary.get_tally(), full.get_tally())
+				self.assertIsNone(summary.hit_table)
+		self.assertRaises(sentiment.SentimentException, summary.get_hits)
+		self.assertRaises(sentiment.SentimentException,
+			summary.get_results, simple=False)
+
 	def test_make_results_simple(self):
 		"""Tests that make_results_simple() correctly creates results"""
 		test = sentiment.LibraryRun(self.text3, self.lib)
@@ -271,9 +1513,145 @@ class TestLibraryRun(unittest.TestCase):
 		self.assertEqual(obj_ut, ['.text id\t.text score\tneg hits\t\
 pos hits\ttotal hits\ttotal wordcount\n', '100\t-1\t2\t0\t2\t7\n'])
 
+	def test_library_run_profile(self):
+		"""Tests a profiled LibraryRun records stage timings and counts"""
+		test = sentiment.LibraryRun(self.text3, self.lib, profile=True)
+		test.do_run()
+		test.get_result_rows()
+		obj_ut = test.get_profile()
+		self.assertEqual(sorted(obj_ut['seconds']),
+			['format', 'match', 'preprocess', 'score'])
+		self.assertEqual((obj_ut['words'], obj_ut['candidates'], obj_ut['hits']),
+			(7, 4, 2))
+
 	def test_get_results_verbose(self):
 		"""Tests that get_results() makes verbose results correctly"""
 		pass
 
+@unittest.skipIf(sentiment.numpy is None, "needs numpy")
+class TestBatchScoring(unittest.TestCase):
+	"""Tests for scoring many texts at once"""
+	def setUp(self):
+		"""Define commonly used test things"""
+		self.lib = {'good': (1, 0), 'bad': (-2, 1), 'very good': (3, 2)}
+		self.texts = [('100', 'today was not good not very good'),
+			('101', 'good good bad'), ('102', 'nothing to see here'),
+			('103', 'bad and not bad but very good'), ('104', 'very good')]
+
+	def test_score_hits_batch(self):
+		"""Tests score_hits_batch weights and averages each text's hits"""
+		obj_ut = sentiment.score_hits_batch([0, 0, 1, 1], [2, 4, 0, 3],
+			[-1, -1, 1, -2], [True, True, False, False], [7, 4, 3],
+			end_threshold=0.5)
+		self.assertEqual(obj_ut['text score'], [-1.25, -1.0, 0])
+		self.assertEqual(obj_ut['weighted score'].tolist(), [-1, -1.5, 1, -3])
+		self.assertEqual(obj_ut['neg hits'].tolist(), [2, 0, 0])
+		self.assertEqual(obj_ut['pos hits'].tolist(), [0, 2, 0])
+
+	def test_score_hits_batch_int_average(self):
+		"""Tests texts without weighted hits get an int average, as
+		score_text gives them"""
+		obj_ut = sentiment.score_hits_batch([0, 0, 0], [0, 1, 2],
+			[1, -2, -2], [False] * 3, [10])
+		self.assertEqual(obj_ut['text score'], [-1])
+		self.assertIsInstance(obj_ut['text score'][0], int)
+
+	def test_run_library_batch_same_as_library_run(self):
+		"""Tests run_library_batch gives each text the same simple results
+		as LibraryRun"""
+		matcher = sentiment.PhraseMatcher(self.lib)
+		targets = []
+		for text in self.texts:
+			run_instance = sentiment.LibraryRun(text, self.lib, matcher=matcher)
+			run_instance.do_run()
+			run_instance.make_results_simple()
+			targets.append(run_instance.results_simple)
+		obj_ut = sentiment.run_library_batch(self.texts, matcher)
+		self.assertEqual(obj_ut, targets)
+		self.assertEqual([type(r['.text score']) for r in obj_ut],
+			[type(r['.text score']) for r in targets])
+
+
+class TestSentimentService(unittest.TestCase):
+	"""Tests for the scoring service"""
+	def setUp(self):
+		"""Start a service on a free localhost port"""
+		tmp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp_dir)
+		self.library_filepath = os.path.join(tmp_dir, 'library.txt')
+		self.write_library('good\t1\nbad\t-1\n')
+		self.service = service.SentimentService(
+			self.library_filepath, batch_window=0.2)
+		self.server = service.ServiceServer(('127.0.0.1', 0), self.service)
+		server_thread = threading.Thread(target=self.server.serve_forever)
+		server_thread.daemon = True
+		server_thread.start()
+		self.addCleanup(self.service.close)
+		self.addCleanup(self.server.server_close)
+		self.addCleanup(self.server.shutdown)
+
+	def write_library(self, lines):
+		with open(self.library_filepath, 'w') as lib_file:
+			lib_file.write(lines)
+
+	def request(self, request):
+		"""Sends one request on a new connection, outputs the response"""
+		conn = socket.create_connection(self.server.server_address)
+		try:
+			conn_file = conn.makefile('rw')
+			conn_file.write(json.dumps(request) + '\n')
+			conn_file.flush()
+			return json.loads(conn_file.readline())
+		finally:
+			conn.close()
+
+	def test_score_texts(self):
+		"""Tests single texts and batches score like LibraryRun"""
+		library = sentiment.get_library_from_file(self.library_filepath)
+		run_instance = sentiment.LibraryRun(
+			('1', 'good not bad'), library)
+		run_instance.do_run()
+		run_instance.make_results_simple()
+		expected = run_instance.results_simple
+
+		self.assertEqual(self.request({'id': '1', 'text': 'Good, not BAD!'}),
+			{'result': expected})
+		response = self.request({'texts': [['1', 'good not bad'], ['2', '']]})
+		self.assertEqual(response['results'][0], expected)
+		self.assertEqual(response['results'][1]['total hits'], 0)
+		self.assertIn('error', self.request({'id': '1'}))
+
+	def test_micro_batches(self):
+		"""Tests requests arriving together are scored in one batch"""
+		responses = []
+		threads = [threading.Thread(target=lambda i=i: responses.append(
+			self.request({'id': str(i), 'text': 'good'})))
+			for i in range(5)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(sorted(response['result']['.text id']
+			for response in responses), ['0', '1', '2', '3', '4'])
+		self.assertLess(len(self.service.batch_sizes), 5)
+		self.assertEqual(sum(self.service.batch_sizes), 5)
+
+	def test_reload(self):
+		"""Tests reloading swaps the library in"""
+		self.assertEqual(self.request({'text': 'good'})['result']['.text score'], 1)
+		self.write_library('good\t-3\n')
+		self.assertIn('reloaded', self.request({'reload': True}))
+		self.assertEqual(self.request({'text': 'good'})['result']['.text score'], -3)
+
+	def test_reload_rejects_filepath(self):
+		"""Tests clients can't reload from a file of their choosing"""
+		other_filepath = os.path.join(
+			os.path.dirname(self.library_filepath), 'other.txt')
+		with open(other_filepath, 'w') as lib_file:
+			lib_file.write('good\t-3\n')
+		self.assertIn('error', self.request({'reload': other_filepath}))
+		self.assertEqual(self.request({'text': 'good'})['result']['.text score'], 1)
+
+
 if __name__ == '__main__':
-	unittest.main()
\ No newline at end of file
+	unittest.main()
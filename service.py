@@ -0,0 +1,246 @@
+"""A long-running scoring service that keeps the library loaded
+
+Clients connect over TCP and send one JSON request per line, getting
+one JSON response line back for each:
+
+	{"id": "1", "text": "raw text"}       -> {"result": {...}}
+	{"texts": [["1", "raw"], ["2", "raw"]]} -> {"results": [{...}, ...]}
+	{"reload": true}                        -> {"reloaded": "<library hash>"}
+
+Results are the simple result dicts of LibraryRun.make_results_simple().
+Texts arriving within batch_window seconds of each other, from any
+connection, are scored together in one batch. Reloading swaps the
+library in one step, so batches already running finish with the old one.
+The library file itself is only set on the command line; a reload
+request rereads it, as SIGHUP does.
+
+usage: python service.py library.txt --port 8765
+"""
+
+import argparse
+import json
+import Queue
+import signal
+import SocketServer
+import sys
+import threading
+import time
+
+import sentiment
+
+
+class _PendingRequest(object):
+	"""Texts of one request waiting to be scored, and their results"""
+	def __init__(self, texts):
+		self.texts = texts
+		self.results = None
+		self.error = None
+		self.done = threading.Event()
+
+
+class SentimentService(object):
+	"""Scores texts with a library loaded once, grouping requests into
+	micro-batches on a single scoring thread
+
+	compiled_library_filepath = compiled library file to load the
+	library through (see sentiment.load_library())
+	batch_window = seconds to wait for more requests after the first
+	one of a batch arrives
+	max_batch = max number of texts in a batch
+	normalizer = TextNormalizer to clean texts with
+	"""
+	def __init__(self, library_filepath, compiled_library_filepath=None,
+		         batch_window=0.005, max_batch=500, normalizer=None,
+		         end_weight=1.5, end_threshold=0.75):
+		self.library_filepath = library_filepath
+		self.compiled_library_filepath = compiled_library_filepath
+		self.batch_window = batch_window
+		self.max_batch = max_batch
+		self.normalizer = normalizer or sentiment.TextNormalizer()
+		self.end_weight = end_weight
+		self.end_threshold = end_threshold
+		self.batch_sizes = [] # number of texts in each batch scored
+		self.library = None
+		self.reload_library()
+
+		self.pending = Queue.Queue()
+		self.scorer = threading.Thread(target=self.run_batches)
+		self.scorer.daemon = True
+		self.scorer.start()
+
+	def reload_library(self, library_filepath=None):
+		"""Loads the library file (library_filepath if given) and swaps
+		it in for the next batch. Outputs the library file hash as hex"""
+		if library_filepath is None:
+			library_filepath = self.library_filepath
+		if self.compiled_library_filepath is not None:
+			library, matcher = sentiment.load_library(
+				library_filepath, self.compiled_library_filepath)
+		else:
+			library = sentiment.get_library_from_file(library_filepath)
+			matcher = sentiment.PhraseMatcher(library)
+		# a single assignment, so a batch sees the old or new library whole
+		self.library = (library, matcher)
+		self.library_filepath = library_filepath
+		return sentiment.get_library_hash(library_filepath).encode('hex')
+
+	def score(self, texts):
+		"""Scores raw (text_id, text) pairs, waiting for the batch they
+		are put in. Outputs list of simple result dicts"""
+		request = _PendingRequest(texts)
+		self.pending.put(request)
+		request.done.wait()
+		if request.error is not None:
+			raise request.error
+		return request.results
+
+	def close(self):
+		"""Stops the scoring thread once queued requests are scored"""
+		self.pending.put(None)
+		self.scorer.join()
+
+	def get_batch(self):
+		"""Waits for a request, then gathers the requests arriving within
+		batch_window or until max_batch texts. Outputs list of
+		_PendingRequest, None once closed"""
+		request = self.pending.get()
+		if request is None:
+			return None
+		batch = [request]
+		num_texts = len(request.texts)
+		deadline = time.time() + self.batch_window
+		while num_texts < self.max_batch:
+			timeout = deadline - time.time()
+			if timeout <= 0:
+				break
+			try:
+				request = self.pending.get(timeout=timeout)
+			except Queue.Empty:
+				break
+			if request is None:
+				self.pending.put(None) # stop after this batch
+				break
+			batch.append(request)
+			num_texts += len(request.texts)
+		return batch
+
+	def run_batches(self):
+		"""Scores batches of requests until closed"""
+		while True:
+			batch = self.get_batch()
+			if batch is None:
+				return
+			library, matcher = self.library
+			texts = []
+			for request in batch:
+				try:
+					texts.extend(self.clean_texts(request.texts))
+				except Exception as exc:
+					request.error = exc
+			try:
+				results = self.score_batch(texts, library, matcher)
+			except Exception as exc:
+				results = None
+				for request in batch:
+					request.error = request.error or exc
+			self.batch_sizes.append(len(texts))
+
+			start = 0
+			for request in batch:
+				if request.error is None:
+					end = start + len(request.texts)
+					request.results = results[start:end]
+					start = end
+				request.done.set()
+
+	def clean_texts(self, texts):
+		"""Cleans raw (text_id, text) pairs like TextNormalizer.clean_row()"""
+		return [(text_id, self.normalizer.normalize(text))
+			for text_id, text in texts]
+
+	def score_batch(self, texts, library, matcher):
+		"""Scores cleaned texts, with sentiment.run_library_batch() if
+		NumPy is available. Outputs list of simple result dicts"""
+		if sentiment.numpy is not None:
+			return sentiment.run_library_batch(texts, matcher,
+				self.end_weight, self.end_threshold)
+		results = []
+		for text in texts:
+			run_instance = sentiment.LibraryRun(text, library,
+				self.end_weight, self.end_threshold, matcher=matcher,
+				summary_only=True)
+			run_instance.do_run()
+			run_instance.make_results_simple()
+			results.append(run_instance.results_simple)
+		return results
+
+
+class ServiceRequestHandler(SocketServer.StreamRequestHandler):
+	"""Handles one connection of JSON request lines"""
+	def handle(self):
+		for line in iter(self.rfile.readline, ''):
+			if not line.strip():
+				continue
+			self.wfile.write(json.dumps(self.handle_request(line)) + '\n')
+			self.wfile.flush()
+
+	def handle_request(self, line):
+		"""Runs one JSON request line, outputs the response dict"""
+		service = self.server.service
+		try:
+			request = json.loads(line)
+			if 'reload' in request:
+				if request['reload'] is not True:
+					raise sentiment.SentimentException(
+						"reload only takes true, the library file is set "
+						"when the service starts")
+				return {'reloaded': service.reload_library()}
+			if 'texts' in request:
+				return {'results': service.score(
+					[(text_id, text) for text_id, text in request['texts']])}
+			return {'result': service.score(
+				[(request.get('id'), request['text'])])[0]}
+		except Exception as exc:
+			return {'error': '%s: %s' % (type(exc).__name__, exc)}
+
+
+class ServiceServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	"""TCP server handing each connection its own thread, all of them
+	sharing one SentimentService"""
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, service):
+		SocketServer.TCPServer.__init__(self, address, ServiceRequestHandler)
+		self.service = service
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('library', help='library file to score with')
+	parser.add_argument('--compiled-library',
+		help='compiled library file to load the library through')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8765)
+	parser.add_argument('--batch-window', type=float, default=0.005,
+		help='seconds to gather requests into a batch (default 0.005)')
+	parser.add_argument('--max-batch', type=int, default=500)
+	args = parser.parse_args(argv)
+
+	service = SentimentService(args.library, args.compiled_library,
+		args.batch_window, args.max_batch)
+	server = ServiceServer((args.host, args.port), service)
+	# SIGHUP reloads the library file in place
+	signal.signal(signal.SIGHUP, lambda *_: threading.Thread(
+		target=service.reload_library).start())
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		service.close()
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())